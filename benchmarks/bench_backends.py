@@ -0,0 +1,71 @@
+"""
+Accuracy against speed of the backends PDFProcessor can run Nougat with (see mm_pdf/utils/backend_utils.py).
+Every backend transcribes the same fixture pages, and its output is compared to the output of the first backend
+(float32 torch by default) by normalized Levenshtein distance: the edit distance between the two texts over the length
+of the longer one, so 0 is identical output and 1 nothing in common.
+
+Example:
+    python -m benchmarks.bench_backends --pdf paper_cache/some_paper.pdf --pages 8 --backends torch int8 onnx
+"""
+import argparse
+import json
+import statistics
+import time
+import Levenshtein
+import torch
+
+from mm_pdf.pdf_processing import PDFProcessor
+from mm_pdf.utils.pdf_utils import iter_pdf_pages
+from benchmarks.bench_batching import synthetic_pages
+
+def normalized_distance(a : str, b : str) -> float:
+    return Levenshtein.distance(a, b) / max(len(a), len(b), 1)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model", default = "facebook/nougat-base")
+    parser.add_argument("--pdf", default = None, help = "PDF to take pages from. Synthetic pages are used if not given.")
+    parser.add_argument("--pages", type = int, default = 8)
+    parser.add_argument("--backends", nargs = "+", default = ["torch", "int8", "onnx"], help = "The first backend is the reference")
+    parser.add_argument("--max-tokens", type = int, default = 2048)
+    parser.add_argument("--batch-size", type = int, default = 4)
+    parser.add_argument("--threads", type = int, default = None, help = "Torch threads, all cores if not given")
+    parser.add_argument("--onnx-path", default = None, help = "Folder to keep the ONNX export in between runs")
+    args = parser.parse_args()
+
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+    pages = list(iter_pdf_pages(args.pdf, last_page = args.pages)) if args.pdf else synthetic_pages(args.pages)
+
+    reference = None
+    reference_seconds = None
+    for backend in args.backends:
+        pdf_processor = PDFProcessor(
+            device = "cpu",
+            max_tokens_per_page = args.max_tokens,
+            batch_size = args.batch_size,
+            model_name = args.model,
+            backend = backend,
+            onnx_path = args.onnx_path
+        )
+        # Warmup so one-off costs don't count
+        pdf_processor.call_nougat(pages[:1])
+
+        start = time.perf_counter()
+        outputs = pdf_processor.call_nougat(pages)
+        elapsed = time.perf_counter() - start
+
+        if reference is None:
+            reference, reference_seconds = outputs, elapsed
+        distances = [normalized_distance(output, ref) for output, ref in zip(outputs, reference)]
+        print(json.dumps({
+            "backend" : backend,
+            "pages" : len(pages),
+            "seconds" : round(elapsed, 3),
+            "pages_per_sec" : round(len(pages) / elapsed, 3),
+            "speedup" : round(reference_seconds / elapsed, 3),
+            "edit_distance_mean" : round(statistics.mean(distances), 4),
+            "edit_distance_max" : round(max(distances), 4),
+            "identical_pages" : sum(distance == 0 for distance in distances)
+        }))
+        del pdf_processor
@@ -0,0 +1,65 @@
+"""
+Measures Nougat throughput (pages/sec) of PDFProcessor.call_nougat at different batch sizes.
+Runs on CPU by default so it can be used on machines without a GPU, either with the real
+facebook/nougat-base weights or with any smaller checkpoint that has a Nougat processor.
+
+Example:
+    python -m benchmarks.bench_batching --pdf paper_cache/some_paper.pdf --batch-sizes 1 4 8 16
+"""
+import argparse
+import json
+import time
+from PIL import Image, ImageDraw
+
+from mm_pdf.pdf_processing import PDFProcessor
+from mm_pdf.utils.pdf_utils import iter_pdf_pages
+
+def synthetic_pages(n_pages : int, size = (816, 1056)):
+    """
+    Creates simple pages of text so the benchmark can run without any PDFs
+    """
+    pages = []
+    for i in range(n_pages):
+        img = Image.new("RGB", size, "white")
+        draw = ImageDraw.Draw(img)
+        # Vary the amount of text so pages finish decoding at different times
+        for line in range(10 + (i * 7) % 40):
+            draw.text((60, 60 + line * 20), f"Line {line} of page {i}: the quick brown fox jumps over the lazy dog.", fill = "black")
+        pages.append(img)
+    return pages
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model", default = "facebook/nougat-base")
+    parser.add_argument("--device", default = "cpu")
+    parser.add_argument("--pdf", default = None, help = "PDF to take pages from. Synthetic pages are used if not given.")
+    parser.add_argument("--pages", type = int, default = 16)
+    parser.add_argument("--batch-sizes", type = int, nargs = "+", default = [1, 4, 8, 16])
+    parser.add_argument("--max-tokens", type = int, default = 512)
+    parser.add_argument("--decode-window", type = int, default = 128)
+    args = parser.parse_args()
+
+    pages = list(iter_pdf_pages(args.pdf, last_page = args.pages)) if args.pdf else synthetic_pages(args.pages)
+
+    pdf_processor = PDFProcessor(
+        device = args.device,
+        max_tokens_per_page = args.max_tokens,
+        model_name = args.model,
+        decode_window = args.decode_window
+    )
+
+    # Warmup so one-off costs don't count towards the first batch size
+    pdf_processor.call_nougat(pages[:1])
+
+    for batch_size in args.batch_sizes:
+        pdf_processor.batch_size = batch_size
+        start = time.perf_counter()
+        pdf_processor.call_nougat(pages)
+        elapsed = time.perf_counter() - start
+
+        print(json.dumps({
+            "batch_size" : batch_size,
+            "pages" : len(pages),
+            "seconds" : round(elapsed, 3),
+            "pages_per_sec" : round(len(pages) / elapsed, 3)
+        }))
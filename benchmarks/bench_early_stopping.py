@@ -0,0 +1,129 @@
+"""
+Counts the decoding steps PDFProcessor.generate spends on a fixture set of pages with and without stopping pages
+that repeat themselves (RepetitionStoppingCriteria) and per page token budgets (estimate_token_budget).
+Decoding is replayed from scripted token sequences rather than run through Nougat, so the benchmark is
+deterministic and runs anywhere: most pages end with eos after a few hundred to a few thousand tokens, and every
+loop_every-th page falls into a loop of a repeated line that never ends, as Nougat is known to do.
+
+Example:
+    python -m benchmarks.bench_early_stopping --pages 64 --max-tokens 8192
+"""
+import argparse
+import json
+import random
+import types
+import torch
+from PIL import Image
+
+from mm_pdf.pdf_processing import PDFProcessor
+from mm_pdf.utils.generation_utils import estimate_token_budget
+from mm_pdf.utils.trace_utils import NULL_TRACER
+
+EOS, PAD, START = 2, 1, 0
+
+def make_fixtures(n_pages : int, loop_every : int, seed : int = 0):
+    """
+    Returns the token sequence every page decodes to and the size of its text layer. Looping pages are given as
+    (prefix, unit), they decode to the prefix followed by unit repeated forever.
+    """
+    rng = random.Random(seed)
+    fixtures = []
+    for i in range(n_pages):
+        length = rng.randint(200, 2500)
+        prefix = [rng.randint(3, 50000) for _ in range(length)]
+        n_chars = length * 3 # Roughly 3 characters of text layer per token
+        if loop_every and i % loop_every == loop_every - 1:
+            unit = [rng.randint(3, 50000) for _ in range(rng.randint(1, 40))]
+            fixtures.append(((prefix[:length // 2], unit), n_chars))
+        else:
+            fixtures.append((prefix + [EOS], n_chars))
+    return fixtures
+
+class ReplayModel:
+    """
+    Stands in for the VisionEncoderDecoderModel, decoding each page to its fixture and honoring stopping criteria
+    the same way transformers does. Counts forward passes (steps) and tokens computed over all rows (row_steps).
+    """
+    dtype = torch.float32
+
+    def __init__(self, fixtures):
+        self.fixtures = fixtures
+        self.generation_config = types.SimpleNamespace(eos_token_id = EOS, pad_token_id = PAD, decoder_start_token_id = START)
+        self.steps = 0
+        self.row_steps = 0
+
+    def token(self, page : int, position : int) -> int:
+        tokens = self.fixtures[page][0]
+        if isinstance(tokens, tuple):
+            prefix, unit = tokens
+            return prefix[position] if position < len(prefix) else unit[(position - len(prefix)) % len(unit)]
+        return tokens[position]
+
+    def encoder(self, pixel_values):
+        return types.SimpleNamespace(last_hidden_state = pixel_values)
+
+    def generate(self, encoder_outputs, decoder_input_ids, max_new_tokens, stopping_criteria = (), **kwargs):
+        pages = encoder_outputs.last_hidden_state[:, 0].long().tolist()
+        ids = decoder_input_ids
+        done = torch.zeros(len(pages), dtype = torch.bool)
+        for _ in range(max_new_tokens):
+            self.steps += 1
+            self.row_steps += len(pages)
+            position = ids.shape[1] - 1
+            next_tokens = torch.tensor([PAD if done[row] else self.token(page, position) for row, page in enumerate(pages)])
+            ids = torch.cat([ids, next_tokens[:, None]], dim = 1)
+            done |= next_tokens == EOS
+            for criterion in stopping_criteria:
+                done |= criterion(ids, None)
+            if done.all():
+                break
+        return ids
+
+def run(fixtures, max_tokens : int, decode_window : int, batch_size : int, stop_repetition : bool, adaptive_budget : bool) -> dict:
+    model = ReplayModel(fixtures)
+    # Only the attributes generate uses, so no weights are loaded
+    pdf_processor = object.__new__(PDFProcessor)
+    pdf_processor.model = model
+    pdf_processor.max_tokens_per_page = max_tokens
+    pdf_processor.decode_window = decode_window
+    pdf_processor.stop_repetition = stop_repetition
+    pdf_processor.tracer = NULL_TRACER
+
+    blank = Image.new("RGB", (8, 8), "white")
+    n_truncated = 0
+    n_tokens = 0
+    for start in range(0, len(fixtures), batch_size):
+        pages = list(range(start, min(start + batch_size, len(fixtures))))
+        budgets = None
+        if adaptive_budget:
+            budgets = [estimate_token_budget(blank, max_tokens, fixtures[page][1]) for page in pages]
+        outputs, truncated = pdf_processor.generate(torch.tensor([[float(page)] for page in pages]), budgets)
+        n_truncated += sum(truncated)
+        n_tokens += sum(((output != PAD) & (output != START)).sum().item() for output in outputs)
+
+    return {
+        "stop_repetition" : stop_repetition,
+        "adaptive_budget" : adaptive_budget,
+        "decode_steps" : model.steps,
+        "row_steps" : model.row_steps,
+        "output_tokens" : n_tokens,
+        "truncated_pages" : n_truncated
+    }
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--pages", type = int, default = 64)
+    parser.add_argument("--loop-every", type = int, default = 8, help = "Every n-th page loops forever, 0 for none")
+    parser.add_argument("--max-tokens", type = int, default = 8192)
+    parser.add_argument("--decode-window", type = int, default = 512)
+    parser.add_argument("--batch-size", type = int, default = 8)
+    args = parser.parse_args()
+
+    fixtures = make_fixtures(args.pages, args.loop_every)
+    baseline = None
+    for stop_repetition, adaptive_budget in ((False, False), (True, False), (False, True), (True, True)):
+        result = run(fixtures, args.max_tokens, args.decode_window, args.batch_size, stop_repetition, adaptive_budget)
+        if baseline is None:
+            baseline = result
+        result["row_steps_saved"] = round(1 - result["row_steps"] / baseline["row_steps"], 3)
+        print(json.dumps(result))
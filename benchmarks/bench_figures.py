@@ -0,0 +1,50 @@
+"""
+Compares per-document figure extraction latency of running PDFFigures2 through sbt once per PDF
+(how load_figures used to work) against a FigureExtractor that runs the assembly jar once over a batch of PDFs.
+
+Example:
+    python -m benchmarks.bench_figures --pdf-dir paper_cache --limit 20
+"""
+import argparse
+import json
+import os
+import time
+
+from mm_pdf.utils.pdf_utils import FigureExtractor
+
+def time_per_document(pdf_paths, extractor : FigureExtractor, batched : bool):
+    """
+    Returns total seconds taken to get the figures for every PDF and the number of figures found
+    """
+    start = time.perf_counter()
+    if batched:
+        extractor.extract(pdf_paths)
+    n_figures = sum(len(extractor(path)) for path in pdf_paths)
+    elapsed = time.perf_counter() - start
+    extractor.close()
+    return elapsed, n_figures
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--pdf-dir", default = "./paper_cache")
+    parser.add_argument("--limit", type = int, default = 10)
+    parser.add_argument("--pdffigures-dir", default = "./pdffigures2")
+    parser.add_argument("--jar", default = None, help = "Path to the pdffigures2 assembly jar. Looked for in pdffigures-dir if not given.")
+    args = parser.parse_args()
+
+    pdf_paths = sorted(os.path.join(args.pdf_dir, p) for p in os.listdir(args.pdf_dir) if p.endswith(".pdf"))[:args.limit]
+
+    runs = {
+        "sbt_per_document" : (FigureExtractor(args.pdffigures_dir, use_sbt = True), False),
+        "jar_batched" : (FigureExtractor(args.pdffigures_dir, jar_path = args.jar), True),
+    }
+
+    for name, (extractor, batched) in runs.items():
+        elapsed, n_figures = time_per_document(pdf_paths, extractor, batched)
+        print(json.dumps({
+            "mode" : name,
+            "documents" : len(pdf_paths),
+            "figures" : n_figures,
+            "seconds" : round(elapsed, 3),
+            "seconds_per_document" : round(elapsed / max(len(pdf_paths), 1), 3)
+        }))
@@ -0,0 +1,103 @@
+"""
+Scaling of ReplicaPool (see mm_pdf/replica_pool.py) with the number of replicas. The same documents, a long book and
+a few short papers so that work stealing matters, are transcribed in process first and then by pools of every
+replica count given, printing a JSON line per run with throughput, speedup over the in process run and parallel
+efficiency (speedup per replica). On Linux the memory only each replica holds is reported too, which stays far below
+the size of the model as long as the weights are shared.
+
+Nougat is replaced by a stub that multiplies matrices for every decoding step to keep the CPU busy like the real
+decoder (see benchmarks/synthetic.py). Pass --model with a checkpoint to time the real model instead.
+
+Example:
+    python -m benchmarks.bench_replicas --replicas 1 2 4 8
+    python -m benchmarks.bench_replicas --model facebook/nougat-base --book-pages 40 --max-tokens 1024
+"""
+import argparse
+import json
+import os
+import shutil
+import tempfile
+import time
+
+from mm_pdf.pdf_processing import PDFProcessor
+from mm_pdf.replica_pool import ReplicaPool, available_cores
+from mm_pdf.utils.figure_utils import FigureRegistry
+from mm_pdf.utils.pdf_utils import load_pdf
+from benchmarks.synthetic import synthetic_pdf, stub_nougat
+
+def private_memory_mb(pid : int) -> float:
+    """
+    Memory only this process holds (not shared with any other process), in megabytes. None if it can't be read.
+    """
+    try:
+        with open(f"/proc/{pid}/status", "r") as f:
+            fields = dict(line.split(":", 1) for line in f)
+    except OSError:
+        return None
+    return int(fields["RssAnon"].split()[0]) / 1024
+
+def transcribe(pdf_processor : PDFProcessor, documents : list) -> float:
+    start = time.perf_counter()
+    for pages in documents:
+        pdf_processor.process(pages, FigureRegistry())
+    return time.perf_counter() - start
+
+if __name__ == "__main__":
+    cores = len(available_cores())
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--replicas", type = int, nargs = "+", default = [n for n in (1, 2, 4, 8, 16, 32, 64) if n <= cores])
+    parser.add_argument("--book-pages", type = int, default = 48, help = "Pages of the long document")
+    parser.add_argument("--docs", type = int, default = 4, help = "Number of short documents")
+    parser.add_argument("--pages", type = int, default = 4, help = "Pages of every short document")
+    parser.add_argument("--batch-size", type = int, default = 2)
+    parser.add_argument("--model", default = None, help = "Nougat checkpoint to time instead of the stub")
+    parser.add_argument("--max-tokens", type = int, default = 2048)
+    parser.add_argument("--step-matmul", type = int, default = 256, help = "Size of the matrix the stub multiplies per decoding step")
+    parser.add_argument("--no-pin", action = "store_true", help = "Don't pin replicas to their own cores")
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix = "mm_pdf_replicas_")
+    documents = []
+    for doc, n_pages in enumerate([args.book_pages] + [args.pages] * args.docs):
+        path = os.path.join(work_dir, f"doc{doc}.pdf")
+        synthetic_pdf(path, n_pages, seed = doc)
+        documents.append(load_pdf(path))
+    n_pages = sum(len(pages) for pages in documents)
+
+    if args.model is None:
+        model, processor = stub_nougat(step_matmul = args.step_matmul)
+        pdf_processor = PDFProcessor(device = "cpu", batch_size = args.batch_size, max_tokens_per_page = args.max_tokens,
+                                     model = model, processor = processor)
+    else:
+        pdf_processor = PDFProcessor(device = "cpu", batch_size = args.batch_size, max_tokens_per_page = args.max_tokens,
+                                     model_name = args.model)
+
+    # Warmup so one-off costs don't count
+    pdf_processor.call_nougat(documents[0][:1])
+    in_process_seconds = transcribe(pdf_processor, documents)
+    print(json.dumps({"replicas" : 0, "threads_per_replica" : cores, "pages" : n_pages, "seconds" : round(in_process_seconds, 3),
+                      "pages_per_sec" : round(n_pages / in_process_seconds, 3)}))
+
+    for n_replicas in args.replicas:
+        start = time.perf_counter()
+        with ReplicaPool(pdf_processor, n_replicas, pin_threads = not args.no_pin) as pool:
+            pdf_processor.replicas = pool
+            pdf_processor.call_nougat(documents[0][:n_replicas * args.batch_size]) # Warmup
+            startup_seconds = time.perf_counter() - start
+            seconds = transcribe(pdf_processor, documents)
+            memory = [private_memory_mb(process.pid) for process in pool.processes]
+        pdf_processor.replicas = None
+
+        print(json.dumps({
+            "replicas" : n_replicas,
+            "threads_per_replica" : max(1, cores // n_replicas),
+            "pages" : n_pages,
+            "seconds" : round(seconds, 3),
+            "pages_per_sec" : round(n_pages / seconds, 3),
+            "speedup" : round(in_process_seconds / seconds, 3),
+            "efficiency" : round(in_process_seconds / seconds / n_replicas, 3),
+            "startup_seconds" : round(startup_seconds, 3),
+            "private_mb_per_replica" : round(max(memory), 1) if None not in memory else None
+        }))
+
+    shutil.rmtree(work_dir, ignore_errors = True)
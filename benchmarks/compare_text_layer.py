@@ -0,0 +1,86 @@
+"""
+Compares the text layer fast path against Nougat on real PDFs. Every page goes through Nougat, and for the pages
+TextLayerRouter would let through the text layer output is compared against Nougat's by word error rate (word level
+Levenshtein distance over the number of words Nougat read). Also reports why pages were sent to Nougat and the
+speedup of routing, from the time Nougat takes per page against the time the router takes.
+
+Example:
+    python -m benchmarks.compare_text_layer --pdf-dir paper_cache --limit 10 --device cuda
+"""
+import argparse
+import json
+import os
+import re
+import statistics
+import time
+
+from mm_pdf.pdf_processing import PDFProcessor
+from mm_pdf.utils.pdf_utils import iter_pdf_pages
+from mm_pdf.utils.routing_utils import TextLayerRouter
+
+def words(text : str):
+    """
+    Words of a text with markdown and LaTeX markup, punctuation and case removed
+    """
+    text = re.sub(r"\\[()\[\]]|[#*_`]", " ", text.lower())
+    return re.findall(r"\w+", text)
+
+def word_error_rate(hypothesis : str, reference : str) -> float:
+    """
+    Word level Levenshtein distance between two texts, relative to the length of the reference
+    """
+    hyp, ref = words(hypothesis), words(reference)
+    previous = list(range(len(hyp) + 1))
+    for i, ref_word in enumerate(ref, 1):
+        current = [i] + [0] * len(hyp)
+        for j, hyp_word in enumerate(hyp, 1):
+            current[j] = min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (ref_word != hyp_word))
+        previous = current
+    return previous[-1] / max(1, len(ref))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--pdf-dir", default = "./paper_cache")
+    parser.add_argument("--limit", type = int, default = 10)
+    parser.add_argument("--model", default = "facebook/nougat-base")
+    parser.add_argument("--device", default = "cpu")
+    parser.add_argument("--max-tokens", type = int, default = 4096)
+    args = parser.parse_args()
+
+    pdf_paths = sorted(os.path.join(args.pdf_dir, p) for p in os.listdir(args.pdf_dir) if p.endswith(".pdf"))[:args.limit]
+    pdf_processor = PDFProcessor(device = args.device, max_tokens_per_page = args.max_tokens, model_name = args.model)
+    router = TextLayerRouter()
+
+    n_pages = 0
+    nougat_seconds = 0
+    router_seconds = 0
+    routed_seconds = 0 # Time Nougat spent on pages the router would have let through
+    error_rates = []
+    for pdf_path in pdf_paths:
+        pages = list(iter_pdf_pages(pdf_path))
+        n_pages += len(pages)
+
+        start = time.perf_counter()
+        fast = [router(page.info.get("text")) for page in pages]
+        router_seconds += time.perf_counter() - start
+
+        for page, text_layer in zip(pages, fast):
+            start = time.perf_counter()
+            nougat = pdf_processor.call_nougat(page)
+            elapsed = time.perf_counter() - start
+            nougat_seconds += elapsed
+            if text_layer is not None:
+                routed_seconds += elapsed
+                error_rates.append(word_error_rate(text_layer, nougat))
+
+    routed_time = nougat_seconds - routed_seconds + router_seconds
+    print(json.dumps({
+        "documents" : len(pdf_paths),
+        **router.stats(),
+        "routed_fraction" : round(len(error_rates) / max(1, n_pages), 3),
+        "word_error_rate_mean" : round(statistics.mean(error_rates), 4) if error_rates else None,
+        "word_error_rate_median" : round(statistics.median(error_rates), 4) if error_rates else None,
+        "nougat_seconds" : round(nougat_seconds, 3),
+        "routed_seconds" : round(routed_time, 3),
+        "speedup" : round(nougat_seconds / routed_time, 3) if routed_time else None
+    }, indent = 2))
@@ -0,0 +1,188 @@
+"""
+Per stage benchmarks of the pipeline on synthetic PDFs (see benchmarks/synthetic.py), with regression checks against
+a stored baseline. Stages are timed separately, each over every document, and the median of several repeats is kept:
+load_pdf, load_figures, call_nougat, soft_extract_from_dict, PDFObject.save, detach_captions, read_dataset and
+read_dataset_2. load_figures needs PDFFigures2 and java, and is skipped without them.
+
+Nougat is replaced by a stub that returns the text layer of every page, so the benchmark measures the pipeline around
+the model. Pass --model with a checkpoint to time the real model instead.
+
+Results are written as JSON. With --baseline, every stage that got more than --tolerance slower than in the baseline
+is reported and the exit code is 1. Baselines are machine specific, create one with --save-baseline.
+
+Example:
+    python -m benchmarks.run_benchmarks --save-baseline benchmarks/baseline.json
+    python -m benchmarks.run_benchmarks --baseline benchmarks/baseline.json
+"""
+import argparse
+import json
+import os
+import platform
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+from PIL import Image
+
+import detach_captions
+import read_dataset
+import read_dataset_2
+from mm_pdf.pdf_processing import PDFProcessor, find_image_identifiers, soft_extract_from_dict
+from mm_pdf.utils.figure_utils import FigureRegistry
+from mm_pdf.utils.pdf_utils import FigureExtractor, load_pdf, load_figures
+from benchmarks.synthetic import synthetic_pdf, stub_nougat
+
+def timed(fn, repeats : int, setup = None) -> list:
+    """
+    Seconds taken by each of repeats calls of fn. setup is called untimed before every call.
+    """
+    times = []
+    for _ in range(repeats):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return times
+
+def figures_available(extractor : FigureExtractor) -> bool:
+    if extractor.use_sbt:
+        return shutil.which("sbt") is not None and os.path.isdir(extractor.pdffigures_dir)
+    return shutil.which("java") is not None
+
+def stand_in_figures(pages) -> FigureRegistry:
+    """
+    A plain image for every caption in the text layer of the pages, for when PDFFigures2 can't run
+    """
+    registry = FigureRegistry()
+    for page_idx, page in enumerate(pages):
+        for label in find_image_identifiers(page.info.get("text", "").replace("\r\n", " ")):
+            registry.add(label, Image.new("RGB", (300, 200), "gray"), page_idx)
+    return registry
+
+def compare(results : dict, baseline : dict, tolerance : float) -> list:
+    """
+    Stages that got more than tolerance slower than in the baseline
+    """
+    if results["config"] != baseline.get("config"):
+        print("Warning: the baseline was run with a different configuration", file = sys.stderr)
+    regressions = []
+    for stage, result in results["stages"].items():
+        before = baseline["stages"].get(stage, {}).get("seconds")
+        if result.get("seconds") is None or not before:
+            continue
+        ratio = result["seconds"] / before
+        result["baseline_ratio"] = round(ratio, 3)
+        if ratio > 1 + tolerance:
+            regressions.append(stage)
+    return regressions
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--docs", type = int, default = 4)
+    parser.add_argument("--pages", type = int, default = 6, help = "Pages of the first document, every next one has 4 more")
+    parser.add_argument("--repeats", type = int, default = 3)
+    parser.add_argument("--seed", type = int, default = 0)
+    parser.add_argument("--model", default = None, help = "Nougat checkpoint to time instead of the stub")
+    parser.add_argument("--device", default = "cpu")
+    parser.add_argument("--step-ms", type = float, default = 0, help = "Time the stub takes per decoding step")
+    parser.add_argument("--workers", type = int, default = 2, help = "Processes for detach_captions")
+    parser.add_argument("--output", default = "benchmark_results.json")
+    parser.add_argument("--baseline", default = None, help = "Results to compare against")
+    parser.add_argument("--tolerance", type = float, default = 0.25, help = "Largest slowdown against the baseline that isn't a regression")
+    parser.add_argument("--save-baseline", default = None, help = "Also write the results here, to use as a baseline")
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix = "mm_pdf_bench_")
+    pdf_paths = []
+    for doc in range(args.docs):
+        pdf_paths.append(os.path.join(work_dir, f"doc{doc}.pdf"))
+        synthetic_pdf(pdf_paths[-1], args.pages + 4 * doc, seed = args.seed + doc)
+
+    figure_extractor = FigureExtractor(work_dir = os.path.join(work_dir, "figures"))
+    if args.model is None:
+        model, processor = stub_nougat(args.step_ms / 1000)
+        pdf_processor = PDFProcessor(device = "cpu", figure_extractor = figure_extractor, model = model, processor = processor)
+    else:
+        pdf_processor = PDFProcessor(device = args.device, model_name = args.model, figure_extractor = figure_extractor)
+
+    stages = {}
+    pages = {path : load_pdf(path) for path in pdf_paths}
+    n_pages = sum(len(doc_pages) for doc_pages in pages.values())
+    def record(stage, times, units, unit = "page"):
+        stages[stage] = {
+            "seconds" : round(statistics.median(times), 5),
+            "min_seconds" : round(min(times), 5),
+            "units" : units,
+            "unit" : unit,
+            "seconds_per_unit" : round(statistics.median(times) / units, 6)
+        }
+
+    record("load_pdf", timed(lambda: [load_pdf(path) for path in pdf_paths], args.repeats), n_pages)
+
+    if figures_available(figure_extractor):
+        record("load_figures", timed(lambda: [load_figures(path, figure_extractor) for path in pdf_paths], args.repeats), len(pdf_paths), "document")
+    else:
+        stages["load_figures"] = {"seconds" : None, "skipped" : "PDFFigures2 is not available"}
+
+    texts = {}
+    def transcribe():
+        for path in pdf_paths:
+            texts[path] = pdf_processor.call_nougat(pages[path])
+    record("call_nougat", timed(transcribe, args.repeats), n_pages)
+
+    figures = {path : stand_in_figures(pages[path]) for path in pdf_paths}
+    def match_figures():
+        for path in pdf_paths:
+            labels = {entry.label : entry.image for entry in figures[path].entries}
+            for text in texts[path]:
+                soft_extract_from_dict(labels, find_image_identifiers(text))
+    record("soft_extract_from_dict", timed(match_figures, args.repeats), n_pages)
+
+    pdf_objs = {path : pdf_processor.process(pages[path], stand_in_figures(pages[path])) for path in pdf_paths}
+    ds_path = os.path.join(work_dir, "dataset")
+    def clear_dataset():
+        shutil.rmtree(ds_path, ignore_errors = True)
+    def save():
+        for doc, path in enumerate(pdf_paths):
+            pdf_objs[path].save(os.path.join(ds_path, f"doc{doc}"), complete = True)
+    record("PDFObject.save", timed(save, args.repeats, clear_dataset), n_pages)
+
+    record("read_dataset", timed(lambda: read_dataset.read_dataset(ds_path), args.repeats), n_pages)
+
+    detached_path = os.path.join(work_dir, "detached")
+    def copy_dataset():
+        shutil.rmtree(detached_path, ignore_errors = True)
+        shutil.copytree(ds_path, detached_path)
+    record("detach_captions", timed(lambda: detach_captions.process_folder(detached_path, args.workers), args.repeats, copy_dataset), n_pages)
+
+    record("read_dataset_2", timed(lambda: read_dataset_2.read_dataset(detached_path), args.repeats), n_pages)
+
+    results = {
+        "config" : {
+            "docs" : args.docs, "pages" : args.pages, "seed" : args.seed, "model" : args.model or "stub",
+            "step_ms" : args.step_ms, "workers" : args.workers
+        },
+        "machine" : {"python" : platform.python_version(), "platform" : platform.platform(), "cpus" : os.cpu_count()},
+        "stages" : stages
+    }
+
+    regressions = []
+    if args.baseline is not None:
+        with open(args.baseline, "r") as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+
+    for path in (args.output, args.save_baseline):
+        if path is not None:
+            with open(path, "w") as f:
+                json.dump(results, f, indent = 2)
+    for stage, result in stages.items():
+        print(f"{stage:24} {result['seconds'] if result['seconds'] is not None else result['skipped']}"
+              + (f"  ({result['baseline_ratio']}x baseline)" if "baseline_ratio" in result else ""))
+
+    figure_extractor.close()
+    shutil.rmtree(work_dir, ignore_errors = True)
+    if regressions:
+        print(f"Regressions over {args.tolerance:.0%}: {', '.join(regressions)}", file = sys.stderr)
+        sys.exit(1)
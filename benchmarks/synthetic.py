@@ -0,0 +1,182 @@
+"""
+Fixtures for benchmarking the pipeline without any downloaded PDFs or model weights:
+- synthetic_pdf writes a born-digital PDF of prose, tables and figures (drawn as vector bar charts, captioned the way
+    Nougat and PDFFigures2 expect) from a seed, so every run benchmarks the same documents
+- stub_nougat returns a model and processor that stand in for Nougat in PDFProcessor. The stub "reads" a page by
+    returning its text layer, a token at a time through the same windowed generate as the real model, and can be made
+    to sleep or multiply matrices for every decoding step to model the cost of the real decoder.
+"""
+from PIL import Image
+from typing import List, Tuple
+import random
+import types
+import time
+import re
+import torch
+
+PAGE_SIZE = (612, 792) # Letter, in PDF points
+WORDS = ("the model page document figure table results training data language learning method we show that our "
+         "approach improves over previous work on several benchmarks using fewer parameters and less compute").split()
+
+def escape(text : str) -> str:
+    return text.replace("\\", "\\\\").replace("(", "\\(").replace(")", "\\)")
+
+def write_pdf(path : str, pages : List[List[str]]):
+    """
+    Write a PDF whose pages are given as lists of content stream operators, with Helvetica available as /F1
+    """
+    objects = [
+        b"<< /Type /Catalog /Pages 2 0 R >>",
+        f"<< /Type /Pages /Kids [{' '.join(f'{4 + 2 * i} 0 R' for i in range(len(pages)))}] /Count {len(pages)} >>".encode(),
+        b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>"
+    ]
+    for i, operators in enumerate(pages):
+        objects.append((
+            f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 {PAGE_SIZE[0]} {PAGE_SIZE[1]}] "
+            f"/Resources << /Font << /F1 3 0 R >> >> /Contents {5 + 2 * i} 0 R >>"
+        ).encode())
+        stream = "\n".join(operators).encode("latin-1", errors = "replace")
+        objects.append(b"<< /Length %d >>\nstream\n" % len(stream) + stream + b"\nendstream")
+
+    data = b"%PDF-1.4\n"
+    offsets = []
+    for number, obj in enumerate(objects, 1):
+        offsets.append(len(data))
+        data += b"%d 0 obj\n" % number + obj + b"\nendobj\n"
+    xref = len(data)
+    data += b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1)
+    data += b"".join(b"%010d 00000 n \n" % offset for offset in offsets)
+    data += b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (len(objects) + 1, xref)
+    with open(path, "wb") as f:
+        f.write(data)
+
+def text_line(x : float, y : float, text : str, size : int = 10) -> str:
+    return f"BT /F1 {size} Tf {x} {y} Td ({escape(text)}) Tj ET"
+
+def sentence(rng : random.Random, n_words : int) -> str:
+    return " ".join(rng.choice(WORDS) for _ in range(n_words)).capitalize() + "."
+
+def synthetic_pdf(path : str, n_pages : int, seed : int = 0, table_prob : float = 0.3, figure_prob : float = 0.3):
+    """
+    Write a PDF of n_pages pages of paragraphs, with a captioned table or figure on some of them
+    """
+    rng = random.Random(seed)
+    n_figures = n_tables = 0
+    pages = []
+    for page in range(n_pages):
+        operators = []
+        y = 740
+        if page == 0:
+            operators.append(text_line(72, y, sentence(rng, 6)[:-1], 16))
+            y -= 36
+        while y > 120:
+            kind = rng.random()
+            if kind < table_prob and y > 260:
+                n_tables += 1
+                operators.append(text_line(72, y, f"Table {n_tables}: {sentence(rng, 8)}"))
+                y -= 18
+                operators.append(f"72 {y + 12} m 540 {y + 12} l S")
+                for _ in range(6):
+                    cells = [rng.choice(WORDS)] + [f"{rng.uniform(0, 100):.1f}" for _ in range(3)]
+                    for column, cell in enumerate(cells):
+                        operators.append(text_line(72 + 120 * column, y, cell))
+                    y -= 14
+                operators.append(f"72 {y + 10} m 540 {y + 10} l S")
+                y -= 18
+            elif kind < table_prob + figure_prob and y > 300:
+                n_figures += 1
+                operators.append(f"72 {y - 160} m 72 {y} l 340 {y - 160} m 72 {y - 160} l S")
+                for bar in range(6):
+                    height = rng.uniform(20, 150)
+                    operators.append(f"0.5 g {90 + bar * 40} {y - 160} 24 {height:.1f} re f 0 g")
+                y -= 176
+                operators.append(text_line(72, y, f"Figure {n_figures}: {sentence(rng, 10)}"))
+                y -= 24
+            else:
+                paragraph = " ".join(sentence(rng, rng.randint(8, 20)) for _ in range(rng.randint(3, 6)))
+                while paragraph and y > 100:
+                    line = paragraph[:95].rsplit(" ", 1)[0] if len(paragraph) > 95 else paragraph
+                    operators.append(text_line(72, y, line))
+                    paragraph = paragraph[len(line):].strip()
+                    y -= 12
+                y -= 12
+        operators.append(text_line(300, 40, str(page + 1)))
+        pages.append(operators)
+    write_pdf(path, pages)
+
+class StubTokenizer:
+    """
+    Word level tokenizer that gives every new word the next id. Ids 0, 1 and 2 are start, padding and end of sequence.
+    """
+    def __init__(self):
+        self.ids = {}
+        self.words = ["<s>", "<pad>", "</s>"]
+
+    def encode(self, text : str) -> List[int]:
+        ids = []
+        for word in re.findall(r"\S+|\n", text.replace("\r\n", "\n")):
+            if word not in self.ids:
+                self.ids[word] = len(self.words)
+                self.words.append(word)
+            ids.append(self.ids[word])
+        return ids
+
+    def decode(self, ids : List[int]) -> str:
+        return " ".join(self.words[i] for i in ids if i > 2).replace(" \n ", "\n")
+
+class StubProcessor:
+    """
+    Stands in for NougatProcessor. Pages are "preprocessed" to the index of their tokenized text layer.
+    """
+    def __init__(self, tokenizer : StubTokenizer):
+        self.tokenizer = tokenizer
+        self.sequences = []
+
+    def __call__(self, imgs : List[Image.Image], **kwargs):
+        indices = []
+        for img in imgs:
+            indices.append([float(len(self.sequences))])
+            self.sequences.append(self.tokenizer.encode(img.info.get("text", "")) + [2])
+        return types.SimpleNamespace(pixel_values = torch.tensor(indices))
+
+    def batch_decode(self, outputs, skip_special_tokens : bool = True) -> List[str]:
+        return [self.tokenizer.decode(output.tolist()) for output in outputs]
+
+    def post_process_generation(self, text : str, fix_markdown : bool = False) -> str:
+        return text
+
+class StubModel:
+    """
+    Stands in for the VisionEncoderDecoderModel, generating the sequences its StubProcessor prepared
+
+    :param step_seconds: Time every decoding step takes, 0 to only measure the overhead around the model
+    :param step_matmul: Size of a square matrix multiplied with itself for every decoding step, to keep the CPU busy
+        the way the real decoder does rather than sleeping. 0 for none.
+    """
+    dtype = torch.float32
+
+    def __init__(self, processor : StubProcessor, step_seconds : float = 0, step_matmul : int = 0):
+        self.processor = processor
+        self.step_seconds = step_seconds
+        self.step_matmul = step_matmul
+        self.generation_config = types.SimpleNamespace(eos_token_id = 2, pad_token_id = 1, decoder_start_token_id = 0)
+
+    def encoder(self, pixel_values):
+        return types.SimpleNamespace(last_hidden_state = pixel_values)
+
+    def generate(self, encoder_outputs, decoder_input_ids, max_new_tokens, **kwargs):
+        position = decoder_input_ids.shape[1] - 1
+        rows = [self.processor.sequences[int(index)][position:position + max_new_tokens]
+                for index in encoder_outputs.last_hidden_state[:, 0].tolist()]
+        steps = max(len(row) for row in rows)
+        time.sleep(self.step_seconds * steps)
+        if self.step_matmul:
+            matrix = torch.ones(self.step_matmul, self.step_matmul) / self.step_matmul
+            for _ in range(steps):
+                matrix = matrix @ matrix
+        new_tokens = torch.tensor([row + [1] * (steps - len(row)) for row in rows], dtype = torch.long).reshape(len(rows), steps)
+        return torch.cat([decoder_input_ids, new_tokens], dim = 1)
+
+def stub_nougat(step_seconds : float = 0, step_matmul : int = 0) -> Tuple[StubModel, StubProcessor]:
+    processor = StubProcessor(StubTokenizer())
+    return StubModel(processor, step_seconds, step_matmul), processor
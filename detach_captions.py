@@ -1,73 +1,80 @@
 """
 This script is a utility that disentangles figure/table captions from dataset
+Can be run any number of times on the same dataset: documents that are done are marked and skipped, and pages
+of a document that was interrupted midway are not detached twice. Documents that are still being written (or whose
+writer was interrupted) are left for a later run, as pages added after they were detached would never be.
+Alternatively set detach_captions in write_dataset.py to detach captions as pages are written.
 """
+from concurrent.futures import ProcessPoolExecutor
 import os
-import re
 import json
-from typing import Dict, List
 
-def extract_captions(page_text : str):
-    """
-    Separate page text from any captions near end
-
-    :param page_text: The full text from the page
-    """
-    text = page_text
-    
-    figure_table_pattern = re.compile(r"(Figure|Table) \d+: ")
-    matches = list(figure_table_pattern.finditer(text))
-
-    captions = [] # List of dictionaries
+from mm_pdf.utils.data_utils import split_captions, atomic_write, DocumentManifest, DETACHED_MARKER
+from mm_pdf.utils.index_utils import DatasetIndex, INDEX_FILENAME
 
-    for match in reversed(matches):
-        caption = text[match.start():]
-        text = text[:match.start()]
-        
-        id = int(caption[caption.find(" "):caption.find(":")]) # the number is between space and colon: Figure X:
-        captions.append({"id": id, "caption": caption})
-
-    return text, captions
+num_workers = os.cpu_count() # Documents processed at once
 
 def process_document(doc_path):
     """
     Process a single document into its corresponding components.
+    Returns whether the document needed processing, or None if it isn't complete yet.
     """
+    if os.path.exists(os.path.join(doc_path, DETACHED_MARKER)):
+        return False
+    # Documents written before manifests were kept have neither file and are complete
+    manifest_files = (DocumentManifest.filename, DocumentManifest.journal_filename)
+    if any(os.path.exists(os.path.join(doc_path, fname)) for fname in manifest_files) and not DocumentManifest(doc_path).complete:
+        return None
 
     files = os.listdir(doc_path)
-    files = [os.path.join(doc_path, fp) for fp in files]
-
-    # Sort so that digits stay in order
-    def custom_sort_key(file_path):
-        basename = os.path.basename(file_path)
-        digits = int(basename[:8])
-        is_txt = basename.endswith(".txt")
-        return (digits, is_txt)
+    # Only page text, skips the manifest and any temporary files from an interrupted write
+    files = sorted(fp for fp in files if fp[:8].isdigit() and fp.endswith(".txt"))
 
-    files.sort(key=custom_sort_key)
+    for file in files: # Iterating through every page of a document
+        with open(os.path.join(doc_path, file), 'r') as f:
+            text_content = f.read()
+        media_path = os.path.join(doc_path, f"{file[:8]}-media.json")
 
-    for file in files: # Iterating through every file for a document
-        if file.endswith(".txt"):
-            with open(file, 'r') as f:
-                text_content = f.read()
-                text_content, captions = extract_captions(text_content)
+        if os.path.exists(media_path):
+            # Captions were already written by an interrupted run, but the text may not have been shortened yet.
+            # Detaching again would find no captions and overwrite them.
+            with open(media_path, 'r') as f:
+                text_length = json.load(f).get("text_length") # Missing in files from before it was recorded
+            if text_length is not None and len(text_content) > text_length:
+                atomic_write(os.path.join(doc_path, file), text_content[:text_length].encode(errors = "ignore"))
+            continue
 
-                # Write the modified text back to the file
-                with open(file, 'w') as f:
-                    f.write(text_content)
+        text_content, media = split_captions(text_content)
+        # Captions go first so that they're never lost, see above for a crash between the two writes
+        atomic_write(media_path, json.dumps(media).encode())
+        atomic_write(os.path.join(doc_path, file), text_content.encode(errors = "ignore"))
 
-                # Write the captions to a json file
-                with open(os.path.join(doc_path, f"{os.path.basename(file)[:8]}-media.json"), 'w') as f:
-                    json.dump({"figures": [c for c in captions if "Figure" in c["caption"]],
-                               "tables": [c for c in captions if "Table" in c["caption"]]}, f)
+    open(os.path.join(doc_path, DETACHED_MARKER), "w").close()
+    return True
 
-def process_folder(folder_path):
+def process_folder(folder_path, num_workers = num_workers):
     """
-    Process all documents in a folder.
+    Process all documents in a folder, several at a time.
     """
-    document_paths = os.listdir(folder_path)
+    # Hidden entries hold bookkeeping from writing the dataset (claims, worker manifests), not documents
+    document_paths = [p for p in os.listdir(folder_path) if not p.startswith(".") and os.path.isdir(os.path.join(folder_path, p))]
+    # Keep the index in step with the new media files and shortened pages
+    index = DatasetIndex(folder_path) if os.path.isfile(os.path.join(folder_path, INDEX_FILENAME)) else None
+
+    n_processed = n_incomplete = 0
+    with ProcessPoolExecutor(num_workers) as pool:
+        full_paths = [os.path.join(folder_path, doc_path) for doc_path in document_paths]
+        # Documents are small, so send several to a worker at once
+        for doc_path, processed in zip(document_paths, pool.map(process_document, full_paths, chunksize = 16)):
+            if processed is None:
+                n_incomplete += 1
+            elif processed:
+                n_processed += 1
+                if index is not None:
+                    index.add_folder(doc_path, os.path.join(folder_path, doc_path))
 
-    for doc_path in document_paths: # Iterating through documents
-        process_document(os.path.join(folder_path, doc_path))
+    n_done = len(document_paths) - n_processed - n_incomplete
+    print(f"Detached captions of {n_processed} documents, {n_done} were already done and {n_incomplete} are not complete yet")
 
 if __name__ == "__main__":
     process_folder("output_dataset")
@@ -0,0 +1,410 @@
+from typing import Iterator, Optional, Union
+from PIL import Image
+import pypdfium2 as pdfium
+import socketserver
+import itertools
+import threading
+import tempfile
+import socket
+import select
+import base64
+import queue
+import json
+import time
+import io
+import os
+
+from mm_pdf.pdf_processing import PDFProcessor, find_image_identifiers
+from mm_pdf.utils.figure_utils import FigureRegistry
+from mm_pdf.utils.pdf_utils import iter_pdf_pages, pdfium_lock, crop_figures, render_pending
+
+"""
+Long running service around a PDFProcessor, so that Nougat is loaded once rather than by every run. Clients connect to
+a Unix socket and send requests as lines of JSON, results are streamed back page by page as lines of JSON as well.
+Pages of every request from every client go through one queue, so pages from several small requests are decoded in
+the same batch.
+
+Requests (a connection can send any number of them):
+    {"id" : "a", "path" : "/abs/path/paper.pdf"}         PDF the daemon can read
+    {"id" : "b", "pdf" : "[base64 of the PDF's bytes]"}  PDF sent along with the request
+    Optional fields: "first_page" and "last_page" (0 indexed, last_page excluded) to only transcribe part of the PDF,
+    "figures" : true to extract figures with PDFFigures2 and return the ones found on every page.
+    A request without an id gets a number.
+Responses, tagged with the id of their request:
+    {"type" : "accepted", "id" : "a", "pages" : 12}
+    {"type" : "page", "id" : "a", "page" : 0, "text" : "...", "truncated" : false, "route" : "nougat", "figures" : {"figure1" : "[base64 PNG]"}}
+    {"type" : "done", "id" : "a", "pages" : 12}
+    {"type" : "error", "id" : "a", "error" : "..."}    Ends the request, pages that weren't sent yet never will be
+Pages of a request are sent in order, but pages of different requests on the same connection can interleave.
+A client that disconnects cancels its requests: no more of their pages are rendered and queued pages are dropped.
+"""
+
+class Connection:
+    """
+    Write side of a client connection, shared by the thread reading requests and the thread decoding pages
+    """
+    def __init__(self, wfile):
+        self.wfile = wfile
+        self.lock = threading.Lock()
+        self.closed = False
+        self.requests = []
+
+    def send(self, message : dict):
+        data = (json.dumps(message) + "\n").encode()
+        with self.lock:
+            if self.closed:
+                return
+            try:
+                self.wfile.write(data)
+                self.wfile.flush()
+                return
+            except OSError:
+                pass
+        self.close()
+
+    def close(self):
+        """
+        The client went away. Its requests are finished right away, the rest of their pages are skipped.
+        """
+        with self.lock:
+            self.closed = True
+        for request in list(self.requests):
+            request.finish()
+
+    def watch(self, sock : socket.socket, stop : threading.Event):
+        """
+        Close the connection as soon as the client hangs up, rather than once sending it the next page fails.
+        Only a client closing its socket counts, not one that is done sending requests (shutdown(SHUT_WR)).
+        Runs on its own thread until stop is set.
+        """
+        poller = select.poll()
+        poller.register(sock, select.POLLHUP)
+        while not stop.is_set():
+            if poller.poll(100):
+                self.close()
+                return
+
+class Request:
+    def __init__(self, request_id, connection : Connection, figures : bool = False):
+        self.id = request_id
+        self.connection = connection
+        connection.requests.append(self)
+        self.figures = figures
+        self.registry = FigureRegistry()
+        self.n_pages = self.remaining = 0
+        self.failed = False
+        self.done = threading.Event()
+        self.tmp_path = None # Copy of a PDF sent along with the request, kept until the request is done
+
+    @property
+    def cancelled(self) -> bool:
+        return self.failed or self.connection.closed
+
+    def send(self, message : dict):
+        self.connection.send({"id" : self.id, **message})
+
+    def fail(self, error : str):
+        if not self.failed:
+            self.failed = True
+            self.send({"type" : "error", "error" : error})
+        self.finish()
+
+    def page_done(self):
+        self.remaining -= 1
+        if self.remaining == 0 and not self.failed:
+            self.send({"type" : "done", "pages" : self.n_pages})
+            self.finish()
+
+    def finish(self):
+        if self.tmp_path is not None:
+            try:
+                os.remove(self.tmp_path)
+            except FileNotFoundError:
+                pass # Already removed by another thread finishing the request
+        self.done.set()
+
+def describe(error : Exception) -> str:
+    return f"{type(error).__name__}: {error}"
+
+def encode_image(img : Image.Image) -> str:
+    buffer = io.BytesIO()
+    img.save(buffer, format = "PNG")
+    return base64.b64encode(buffer.getvalue()).decode()
+
+class DaemonHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        connection = Connection(self.wfile)
+        stop = threading.Event()
+        watcher = threading.Thread(target = connection.watch, args = (self.connection, stop), daemon = True)
+        watcher.start()
+        try:
+            for line in self.rfile:
+                if not line.strip():
+                    continue
+                try:
+                    message = json.loads(line)
+                except ValueError:
+                    connection.send({"type" : "error", "id" : None, "error" : "Requests must be JSON"})
+                    continue
+                self.server.pdf_daemon.submit(message, connection)
+            # The connection is closed once this returns, so wait until everything that was asked for has been sent.
+            # Requests of a client that went away are finished by the watcher.
+            for request in connection.requests:
+                request.done.wait()
+        finally:
+            stop.set()
+            watcher.join()
+
+class PDFDaemon:
+    """
+    Serves a PDFProcessor on a Unix socket, see the top of this file
+
+    :param pdf_processor: PDFProcessor to transcribe pages with. Its router, cache, dedup, page classifier and replicas
+        are used like in PDFProcessor.process.
+    :param socket_path: Where to create the socket. A socket left over from an earlier daemon is replaced.
+    :param max_wait: Seconds to wait for more pages to fill a batch once the first page of a batch has arrived
+    :param queue_size: Maximum number of rendered pages waiting to be decoded. Clients rendering more pages wait.
+        Defaults to four batches.
+    """
+    def __init__(self, pdf_processor : PDFProcessor, socket_path : str, max_wait : float = 0.05, queue_size : int = None):
+        self.pdf_processor = pdf_processor
+        self.socket_path = socket_path
+        self.max_wait = max_wait
+        self.pages = queue.Queue(queue_size if queue_size is not None else 4 * pdf_processor.batch_size)
+        self.render_lock = pdfium_lock # pdfium is not thread safe
+        self.figure_lock = threading.Lock()
+        self.ids = itertools.count()
+        self.stopping = threading.Event()
+        self.n_batches = self.n_pages = self.n_mixed_batches = self.n_dropped = 0
+
+    def submit(self, message : dict, connection : Connection) -> Request:
+        """
+        Render the pages of a request and queue them for decoding. Called from the thread of the request's connection.
+        Pages are queued as they are rendered, so the bounded queue holds back clients that render faster than
+        Nougat decodes, and pdfium is only locked for one page at a time so clients take turns rendering.
+        Rendering stops once the request is cancelled, even while waiting for room in the queue.
+        """
+        request = Request(message.get("id", next(self.ids)), connection, bool(message.get("figures")))
+        first_page = message.get("first_page", 0)
+        try:
+            if "path" in message:
+                pdf = message["path"]
+                if not os.path.isfile(pdf):
+                    raise FileNotFoundError(f"No such file: {pdf}")
+            else:
+                pdf = base64.b64decode(message["pdf"])
+            with self.render_lock:
+                document = pdfium.PdfDocument(pdf)
+                n_pages = len(document)
+                document.close()
+            last_page = n_pages if message.get("last_page") is None else min(message["last_page"], n_pages)
+
+            if request.figures:
+                if isinstance(pdf, bytes):
+                    # PDFFigures2 reads PDFs from disk, and figures that aren't cropped from pages are rendered from it
+                    with tempfile.NamedTemporaryFile(suffix = ".pdf", delete = False) as f:
+                        f.write(pdf)
+                    pdf = request.tmp_path = f.name
+                with self.figure_lock:
+                    request.registry = self.pdf_processor.figure_extractor(pdf)
+        except Exception as e:
+            request.fail(describe(e))
+            return request
+
+        request.n_pages = request.remaining = max(0, last_page - first_page)
+        request.send({"type" : "accepted", "pages" : request.n_pages})
+        if request.n_pages == 0:
+            request.send({"type" : "done", "pages" : 0})
+            request.finish()
+            return request
+
+        # Takes the render lock around every call into pdfium itself
+        pages = iter_pdf_pages(pdf, first_page, last_page)
+        try:
+            for page_idx in range(first_page, last_page):
+                if request.cancelled:
+                    break
+                img = next(pages)
+                # Figures PDFFigures2 didn't render are cropped from their page, unless an earlier page already took
+                # them, in which case they are rendered from the PDF
+                crop_figures(request.registry, page_idx, img)
+                while not request.cancelled: # Blocks while the queue is full
+                    try:
+                        self.pages.put((request, page_idx, img), timeout = 0.5)
+                        break
+                    except queue.Full:
+                        pass
+        except Exception as e:
+            request.fail(describe(e))
+        finally:
+            pages.close()
+        if request.cancelled:
+            request.finish() # None of its pages may be queued, which is otherwise where it would be finished
+        return request
+
+    def next_batch(self) -> list:
+        """
+        Wait for a page, then take up to a batch of pages that arrive within max_wait of it
+        """
+        batch = []
+        while not batch and not self.stopping.is_set():
+            try:
+                batch.append(self.pages.get(timeout = 0.5))
+            except queue.Empty:
+                pass
+        deadline = time.monotonic() + self.max_wait
+        while batch and len(batch) < self.pdf_processor.batch_size:
+            try:
+                batch.append(self.pages.get(timeout = max(0, deadline - time.monotonic())))
+            except queue.Empty:
+                break
+        return batch
+
+    def decode(self, batch : list):
+        for request, _, _ in batch:
+            if request.cancelled:
+                request.finish()
+                self.n_dropped += 1
+        batch = [(request, page_idx, img) for request, page_idx, img in batch if not request.cancelled]
+        if not batch:
+            return
+        self.n_batches += 1
+        self.n_pages += len(batch)
+        self.n_mixed_batches += len({id(request) for request, _, _ in batch}) > 1
+
+        tracer = self.pdf_processor.tracer
+        # A page that fails only fails its own request, the rest of the batch goes on
+        routes = []
+        for request, page_idx, img in batch:
+            try:
+                if self.pdf_processor.page_classifier is not None:
+                    routes.append(self.pdf_processor.page_classifier(img, request.registry.regions(page_idx)))
+                else:
+                    routes.append(None)
+            except Exception as e:
+                request.fail(describe(e))
+                routes.append(None)
+        batch = [(page, route) for page, route in zip(batch, routes) if not page[0].cancelled]
+        try:
+            with tracer.span("daemon_batch", pages = len(batch)):
+                transcribed = iter(self.pdf_processor.transcribe([img for (_, _, img), route in batch if route is None]))
+        except Exception as e:
+            for (request, _, _), _ in batch:
+                request.fail(describe(e))
+            return
+
+        for (request, page_idx, img), route in batch:
+            read = route is None
+            if read:
+                text, truncated, route, tokens = next(transcribed)
+            else:
+                text, truncated, tokens = "", False, 0
+            if request.cancelled:
+                continue
+            try:
+                if read:
+                    img_ids, imgs = request.registry.take_all(find_image_identifiers(text), page_idx)
+                else:
+                    img_ids, imgs = request.registry.take_page(page_idx)
+                imgs = render_pending(imgs)
+                tracer.event("page", doc = request.id, page = page_idx, route = route, truncated = truncated, tokens = tokens, figures = len(imgs))
+                message = {"type" : "page", "page" : page_idx, "text" : text, "truncated" : truncated, "route" : route}
+                if request.figures:
+                    message["figures"] = {label : encode_image(fig) for label, fig in zip(img_ids, imgs)}
+                request.send(message)
+                request.page_done()
+            except Exception as e:
+                request.fail(describe(e))
+
+    def decode_loop(self):
+        while not self.stopping.is_set():
+            batch = self.next_batch()
+            if not batch:
+                continue
+            try:
+                self.decode(batch)
+            except Exception as e:
+                # Whatever went wrong, the other clients are still served
+                for request, _, _ in batch:
+                    request.fail(describe(e))
+
+    def start(self):
+        """
+        Start listening and decoding on background threads
+        """
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+        self.server = socketserver.ThreadingUnixStreamServer(self.socket_path, DaemonHandler)
+        self.server.daemon_threads = True
+        self.server.pdf_daemon = self
+        self.decode_thread = threading.Thread(target = self.decode_loop, daemon = True)
+        self.decode_thread.start()
+        self.server_thread = threading.Thread(target = self.server.serve_forever, daemon = True)
+        self.server_thread.start()
+
+    def stats(self) -> dict:
+        return {
+            "batches" : self.n_batches,
+            "pages" : self.n_pages,
+            "mixed_batches" : self.n_mixed_batches, # Batches holding pages of more than one request
+            "pages_per_batch" : round(self.n_pages / self.n_batches, 2) if self.n_batches else None,
+            "dropped_pages" : self.n_dropped # Pages of failed or disconnected requests that were never decoded
+        }
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.stopping.set()
+        self.decode_thread.join()
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+class DaemonClient:
+    """
+    Client of a PDFDaemon
+
+    :param socket_path: Socket the daemon listens on
+    :param timeout: Seconds to wait for the daemon to answer before giving up, forever if None
+    """
+    def __init__(self, socket_path : str, timeout : float = None):
+        self.socket_path = socket_path
+        self.timeout = timeout
+
+    def transcribe(self, pdf : Union[str, bytes], figures : bool = False, first_page : int = 0,
+                   last_page : Optional[int] = None) -> Iterator[dict]:
+        """
+        Transcribe a PDF, yielding the page messages of the daemon as they arrive (see the top of this file).
+        Figures are decoded to PIL images.
+
+        :param pdf: Path to a PDF, which the daemon reads itself, or the bytes of one
+        """
+        request = {"id" : 0, "first_page" : first_page, "last_page" : last_page, "figures" : figures}
+        if isinstance(pdf, bytes):
+            request["pdf"] = base64.b64encode(pdf).decode()
+        else:
+            request["path"] = os.path.abspath(pdf)
+
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.settimeout(self.timeout)
+            sock.connect(self.socket_path)
+            sock.sendall((json.dumps(request) + "\n").encode())
+            sock.shutdown(socket.SHUT_WR) # No more requests on this connection
+            for line in sock.makefile("rb"):
+                message = json.loads(line)
+                if message["type"] == "error":
+                    raise RuntimeError(message["error"])
+                if message["type"] == "done":
+                    return
+                if message["type"] == "page":
+                    if "figures" in message:
+                        message["figures"] = {label : Image.open(io.BytesIO(base64.b64decode(data)))
+                                              for label, data in message["figures"].items()}
+                    yield message
+        raise ConnectionError("The daemon closed the connection before the request was done")
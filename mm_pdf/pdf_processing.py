@@ -1,12 +1,22 @@
-from transformers import NougatProcessor, VisionEncoderDecoderModel
+from transformers import NougatProcessor
 from PIL import Image
-from typing import Iterable
+from typing import Iterable, Iterator, List, Optional, Tuple, Union
+from itertools import islice
+import time
 import re
 import os
 import torch
 
-from mm_pdf.utils.data_utils import PDFPage, PDFObject
-from mm_pdf.utils.pdf_utils import load_pdf, load_figures
+from mm_pdf.utils.data_utils import PDFPage, PDFObject, PageSink
+from mm_pdf.utils.pdf_utils import iter_pdf_pages, load_figures, FigureExtractor, crop_figures, render_pending
+from mm_pdf.utils.cache_utils import PageCache
+from mm_pdf.utils.dedup_utils import PageDeduplicator, hamming
+from mm_pdf.utils.figure_utils import FigureRegistry
+from mm_pdf.utils.generation_utils import RepetitionStoppingCriteria, estimate_token_budget
+from mm_pdf.utils.routing_utils import TextLayerRouter, ROUTE_NOUGAT, ROUTE_TEXT_LAYER
+from mm_pdf.utils.page_classifier import PageClassifier
+from mm_pdf.utils.backend_utils import load_model, default_device
+from mm_pdf.utils.trace_utils import Tracer, NULL_TRACER
 
 def find_image_identifiers(text : str) -> Iterable[str]:
     """
@@ -49,88 +59,391 @@ def soft_extract_from_dict(d, keys):
         (i.e. "Figure 1.2:" is read as "Figure 2:", which gives identifier "figure2")
     - PDFFigures is able to correctly identify figures with decimals
     - so mismatch between "figure2" and "figure1.2"
-    - This function implements a soft solution where if the key doesn't exist, we look for the first similar key
-    - This will likely cause issues when looking at anything that isn't a large PDF
+    - If the key doesn't exist, a similar key is looked for using a FigureRegistry (see mm_pdf/utils/figure_utils.py)
+    Without page numbers the registry can't tell apart several similar keys, PDFProcessor.process uses one directly.
     """
-
-    return_keys = []
-    return_values = []
-    
-    # figure1.2 -> figure2
-    def delete_numbers_before_decimal(s):
-        decimal_index = s.find('.')
-        if decimal_index != -1:
-            non_digit_index = re.search("\d", s).start()
-            s = s[:non_digit_index] + s[decimal_index+1:]
-        return s
-    
-    for k in keys: # iterate through provided keys
-        if k in d:
-            return_keys.append(k)
-            return_values.append(d[k])
-            del d[k]
-        else:
-            for k_i in d.keys(): # iterate through dict
-                if delete_numbers_before_decimal(k_i) == k:
-                    return_keys.append(k)
-                    return_values.append(d[k_i])
-                    del d[k_i]
-                    break # found a match for key, break from looking through dict and onto next key
-    
+    registry = FigureRegistry.from_dict({k : k for k in d})
+    return_keys, matched = registry.take_all(keys)
+    return_values = [d.pop(k) for k in matched]
     return return_keys, return_values
-                
+
+def estimate_batch_size(model, device, max_new_tokens : int, dtype : torch.dtype = None, max_batch_size : int = 16, memory_fraction : float = 0.8) -> int:
+    """
+    Estimate how many pages can be decoded together without running out of memory.
+    The dominant cost of decoding is the decoders key/value cache, which grows linearly in both batch size and
+    number of generated tokens, so we budget for the worst case of every page using its full token budget.
+
+    :param model: The VisionEncoderDecoderModel that will be used
+    :param device: Device the model lives on
+    :param max_new_tokens: Token budget per page
+    :param dtype: Dtype the model runs in, model.dtype if None
+    :param max_batch_size: Upper bound on the returned batch size
+    :param memory_fraction: Fraction of the free memory we allow ourselves to use
+    """
+    if str(device).startswith("cuda") and torch.cuda.is_available():
+        free_bytes, _ = torch.cuda.mem_get_info(torch.device(device))
+    else:
+        free_bytes = os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+
+    dec_config = model.config.decoder
+    n_tokens = min(max_new_tokens, getattr(dec_config, "max_position_embeddings", max_new_tokens))
+    bytes_per_value = torch.finfo(dtype if dtype is not None else model.dtype).bits // 8
+    # Self attention keys and values for every layer and token
+    bytes_per_page = 2 * dec_config.decoder_layers * dec_config.d_model * n_tokens * bytes_per_value
+    # Logits over the vocabulary are also materialized at every step
+    bytes_per_page += dec_config.vocab_size * 4
+
+    return max(1, min(max_batch_size, int(free_bytes * memory_fraction) // bytes_per_page))
 
 class PDFProcessor:
     """
     Wrapper around Nougat to encapsulate processing a single PDF page into text and images
 
-    :param device: Device to run Nougat on
+    :param device: Device to run Nougat on. GPU if there is one when None.
     :param max_tokens_per_page: How many tokens to attempt to parse from each page. Should normally be set very high to ensure entire page is read.
+    :param batch_size: How many pages to decode together with a single call to generate. Set to "auto" to pick a batch size based on free memory.
+    :param model_name: Name or path of the Nougat checkpoint to load
+    :param dtype: Torch dtype to run Nougat in with the torch backend. Defaults to float16 on GPU and float32 on CPU.
+    :param decode_window: Number of tokens to generate before pages that have already finished are dropped from the batch.
+        Set to None to decode every batch with one call to generate.
+    :param figure_extractor: FigureExtractor used to get figures from PDFs. A new one is created if None.
+    :param cache: PageCache that is checked before running Nougat on a page. Transcriptions are not cached if None.
+    :param dedup: PageDeduplicator used to reuse the transcription of near duplicate pages. Checked after the cache.
+    :param stop_repetition: Stop decoding a page as soon as it is stuck repeating itself, see RepetitionStoppingCriteria
+    :param adaptive_budget: Give every page its own token budget based on how much text it holds, up to max_tokens_per_page.
+        See estimate_token_budget.
+    :param router: TextLayerRouter that decides which pages can use their text layer instead of going through Nougat.
+        Every page goes through Nougat if None.
+    :param page_classifier: PageClassifier that finds blank and figure only pages, which process leaves empty rather
+        than transcribing. Every page is transcribed if None.
+    :param backend: How to run Nougat: "torch", "int8" (CPU only) or "onnx", see backend_utils
+    :param onnx_path: Folder to save the ONNX export of the model to and load it from with the onnx backend
+    :param model: Model to use instead of loading model_name, i.e. the stub from benchmarks/synthetic.py
+    :param processor: Processor to use along with model instead of loading the one of model_name
+    :param tracer: Tracer recording the time spent preprocessing, encoding and decoding, and every transcribed page.
+        Nothing is recorded if None.
     """
-    def __init__(self, device = 'cuda', max_tokens_per_page = 20000):
+    def __init__(self, device = None, max_tokens_per_page = 20000, batch_size = 8, model_name = "facebook/nougat-base", dtype = None, decode_window = 512,
+                 figure_extractor : FigureExtractor = None, cache : PageCache = None, dedup : PageDeduplicator = None,
+                 stop_repetition : bool = True, adaptive_budget : bool = False, router : TextLayerRouter = None,
+                 page_classifier : PageClassifier = None, backend : str = "torch", onnx_path : str = None, model = None, processor = None,
+                 tracer : Tracer = None):
+        if device is None:
+            device = default_device()
         self.device = device
-        self.processor = NougatProcessor.from_pretrained("facebook/nougat-base")
-        self.model = VisionEncoderDecoderModel.from_pretrained("facebook/nougat-base", torch_dtype = torch.float16).to(device)
+        self.model_name = model_name
+        self.backend = backend
+        self.processor = processor if processor is not None else NougatProcessor.from_pretrained(model_name)
+        self.model = model if model is not None else load_model(model_name, backend, device, dtype, onnx_path)
+        self.dtype = getattr(self.model, "dtype", torch.float32) # ONNX Runtime models run in float32
         self.max_tokens_per_page = max_tokens_per_page
+        self.decode_window = decode_window
+
+        if batch_size == "auto":
+            batch_size = estimate_batch_size(self.model, device, max_tokens_per_page, self.dtype)
+        self.batch_size = batch_size
+
+        self.figure_extractor = figure_extractor if figure_extractor is not None else FigureExtractor()
+        self.cache = cache
+        self.dedup = dedup
+        self.stop_repetition = stop_repetition
+        self.adaptive_budget = adaptive_budget
+        self.router = router
+        self.page_classifier = page_classifier
+        self.tracer = tracer if tracer is not None else NULL_TRACER
+        self.replicas = None # ReplicaPool decoding pages in other processes, see mm_pdf/replica_pool.py
+
+    def __getstate__(self) -> dict:
+        """
+        Pickled for ReplicaPool, whose replicas only decode pages. Everything that is shared with other processes
+        through files, or only used around decoding (figures, cache, dedup, routing, tracing), stays behind.
+        """
+        state = self.__dict__.copy()
+        for name in ("figure_extractor", "cache", "dedup", "router", "page_classifier", "replicas"):
+            state[name] = None
+        del state["tracer"]
+        return state
+
+    def __setstate__(self, state : dict):
+        self.__dict__.update(state)
+        self.tracer = NULL_TRACER
+
+    def cache_settings(self) -> dict:
+        """
+        Settings that change what Nougat outputs for a page, used as part of cache keys
+        """
+        return {
+            "model_name" : self.model_name,
+            "backend" : self.backend,
+            "dtype" : str(self.dtype),
+            "max_tokens_per_page" : self.max_tokens_per_page,
+            "stop_repetition" : self.stop_repetition,
+            "adaptive_budget" : self.adaptive_budget
+        }
 
     @torch.no_grad()
-    def call_nougat(self, img : Image.Image):
-        pixel_values = self.processor(img, data_format = "channels_first", return_tensors = "pt").pixel_values.to(self.device).half()
-        
-        outputs = self.model.generate(
-            pixel_values,
-            min_length = 1,
-            max_new_tokens = self.max_tokens_per_page
-        )
+    def generate(self, pixel_values : torch.Tensor, budgets : Optional[List[int]] = None) -> Tuple[List[torch.Tensor], List[bool]]:
+        """
+        Decode a batch of preprocessed pages. Generation runs in windows of decode_window tokens and after each
+        window any page that has produced an end of sequence token, got stuck repeating itself or used up its budget
+        is removed from the batch, so that short pages do not keep paying for decoding steps while long pages finish.
+        Returns a list with the generated token ids for each page, and whether each page was truncated (stopped
+        before producing an end of sequence token). Repetitions are cut from truncated pages.
+
+        :param budgets: Maximum number of tokens to generate for each page. max_tokens_per_page for every page if None.
+        """
+        with self.tracer.span("encode", pages = pixel_values.shape[0]):
+            encoder_outputs = self.model.encoder(pixel_values = pixel_values)
+        eos_token_id = self.model.generation_config.eos_token_id
+        start_token_id = self.model.generation_config.decoder_start_token_id
+        if budgets is None:
+            budgets = [self.max_tokens_per_page] * pixel_values.shape[0]
+        stopper = RepetitionStoppingCriteria() if self.stop_repetition else None
+
+        decoder_input_ids = torch.full((pixel_values.shape[0], 1), start_token_id, dtype = torch.long, device = pixel_values.device)
+        active = list(range(pixel_values.shape[0])) # Index of each row of decoder_input_ids in the original batch
+        results = [None] * len(active)
+        truncated = [False] * len(active)
+
+        start = time.perf_counter()
+        generated = windows = 0
+        while active:
+            window = max(budgets[page_idx] for page_idx in active) - generated
+            if self.decode_window is not None:
+                window = min(window, self.decode_window)
+
+            kwargs = {}
+            if stopper is not None:
+                stopper.reset()
+                kwargs["stopping_criteria"] = [stopper]
+            outputs = self.model.generate(
+                encoder_outputs = encoder_outputs,
+                decoder_input_ids = decoder_input_ids,
+                min_length = 1,
+                max_new_tokens = window,
+                forced_eos_token_id = None, # Otherwise eos is forced at the end of every window
+                **kwargs
+            )
+            new_tokens = outputs[:, decoder_input_ids.shape[1]:]
+            generated += window
+            windows += 1
+
+            finished = (new_tokens == eos_token_id).any(dim = 1)
+            if stopper is not None and stopper.stopped is not None:
+                finished |= stopper.stopped.to(finished.device)
+            finished |= torch.tensor([generated >= budgets[page_idx] for page_idx in active], device = finished.device)
+            if new_tokens.shape[1] < window:
+                finished[:] = True # generate stopped early because every page hit eos or a repetition
 
-        sequence = self.processor.batch_decode(outputs, skip_special_tokens = True)[0]
-        sequence = self.processor.post_process_generation(sequence, fix_markdown = False)
+            for row, page_idx in enumerate(active):
+                if finished[row]:
+                    sequence = outputs[row][:1 + budgets[page_idx]] # Rows sharing a window can overshoot their budget
+                    truncated[page_idx] = not (sequence == eos_token_id).any().item()
+                    if truncated[page_idx] and stopper is not None:
+                        sequence = stopper.trim(sequence, self.model.generation_config.pad_token_id)
+                    results[page_idx] = sequence
 
-        return sequence
+            keep = (~finished).nonzero(as_tuple = True)[0]
+            active = [active[row] for row in keep.tolist()]
+            decoder_input_ids = outputs[keep]
+            encoder_outputs.last_hidden_state = encoder_outputs.last_hidden_state[keep]
 
-    def __call__(self, pdf_path : str, ignore_images : bool = False) -> PDFObject:
+        if self.tracer.enabled:
+            seconds = time.perf_counter() - start
+            tokens = sum(self.count_tokens(sequence) for sequence in results)
+            self.tracer.event("decode", seconds, pages = len(results), windows = windows, tokens = tokens,
+                              tokens_per_second = round(tokens / seconds, 2) if seconds else None)
+            self.tracer.count("tokens_generated", tokens)
+        return results, truncated
+
+    def count_tokens(self, sequence : torch.Tensor) -> int:
+        """
+        Number of tokens generated in a sequence returned by generate, not counting the start token and padding
+        """
+        return int((sequence != self.model.generation_config.pad_token_id).sum().item()) - 1
+
+    @torch.no_grad()
+    def decode_pages(self, batch : List[Image.Image]) -> List[Tuple[str, bool, int]]:
+        """
+        Run a batch of at most batch_size page images through Nougat. Returns the text of every page, whether it was
+        truncated and the number of tokens generated for it.
+        """
+        with self.tracer.span("preprocess", pages = len(batch)):
+            pixel_values = self.processor(batch, data_format = "channels_first", return_tensors = "pt").pixel_values
+            pixel_values = pixel_values.to(self.device, self.dtype)
+
+        budgets = None
+        if self.adaptive_budget:
+            budgets = [estimate_token_budget(img, self.max_tokens_per_page) for img in batch]
+
+        outputs, truncated = self.generate(pixel_values, budgets)
+        texts = [self.processor.post_process_generation(text, fix_markdown = False)
+                 for text in self.processor.batch_decode(outputs, skip_special_tokens = True)]
+        return list(zip(texts, truncated, [self.count_tokens(output) for output in outputs]))
+
+    @torch.no_grad()
+    def transcribe(self, imgs : List[Image.Image]) -> List[Tuple[str, bool, str, int]]:
+        """
+        Transcribe a list of page images to markdown. Pages the router lets through use their text layer, and pages
+        found in the cache, or near duplicates of pages seen before, are not run through Nougat either. The rest are
+        decoded in batches of batch_size pages, spread over the replicas if there are any.
+        Returns the text of every page, whether it was truncated, the route it took (see routing_utils) and the number
+        of tokens Nougat generated for it (0 for pages that didn't go through Nougat). Truncated pages are not cached.
+        """
+        settings = self.cache_settings()
+        sequences = [None] * len(imgs)
+        truncated = [False] * len(imgs)
+        routes = [ROUTE_NOUGAT] * len(imgs)
+        tokens = [0] * len(imgs)
+        if self.router is not None:
+            for i, img in enumerate(imgs):
+                sequences[i] = self.router(img.info.get("text"))
+                if sequences[i] is not None:
+                    routes[i] = ROUTE_TEXT_LAYER
+        if self.cache is not None:
+            sequences = [self.cache.get(img, settings) if sequence is None else sequence for img, sequence in zip(imgs, sequences)]
+        todo = [i for i, sequence in enumerate(sequences) if sequence is None]
+
+        copies = {} # Index of a page to the index of a duplicate of it in this call
+        if self.dedup is not None:
+            hashes = {i : self.dedup.hash(imgs[i]) for i in todo}
+            unique = []
+            for i in todo:
+                match = self.dedup.find(hashes[i], settings)
+                if match is not None:
+                    sequences[i], page_id, distance = match
+                    self.dedup.record_reuse(hashes[i], distance, imgs[i].info.get("doc"), imgs[i].info.get("page"), page_id)
+                    continue
+                # Duplicates within the same call aren't in the index yet
+                j = None
+                if self.dedup.usable(hashes[i]):
+                    j = next((j for j in unique if hamming(hashes[i], hashes[j]) <= self.dedup.threshold), None)
+                if j is not None:
+                    copies[i] = j
+                    self.dedup.record_reuse(hashes[i], hamming(hashes[i], hashes[j]), imgs[i].info.get("doc"), imgs[i].info.get("page"),
+                                            matched_doc = imgs[j].info.get("doc"), matched_page = imgs[j].info.get("page"))
+                else:
+                    unique.append(i)
+            todo = unique
+
+        if todo:
+            batches = [[imgs[i] for i in todo[start:start+self.batch_size]] for start in range(0, len(todo), self.batch_size)]
+            if self.replicas is not None:
+                # Replicas don't trace, so only the time spent waiting on them and their output are recorded
+                with self.tracer.span("replicas", pages = len(todo)) as span:
+                    decoded = self.replicas.map(batches)
+                    span["tokens"] = sum(n_tokens for batch in decoded for _, _, n_tokens in batch)
+                self.tracer.count("tokens_generated", span["tokens"])
+            else:
+                decoded = [self.decode_pages(batch) for batch in batches]
+
+            for i, (sequence, cut, n_tokens) in zip(todo, (page for batch in decoded for page in batch)):
+                sequences[i] = sequence
+                truncated[i] = cut
+                tokens[i] = n_tokens
+                if cut: # Another run with other settings might get the whole page
+                    continue
+                if self.cache is not None:
+                    self.cache.put(imgs[i], settings, sequences[i])
+                if self.dedup is not None:
+                    self.dedup.add(hashes[i], settings, sequences[i], imgs[i].info.get("doc"), imgs[i].info.get("page"))
+
+        for i, j in copies.items():
+            sequences[i] = sequences[j]
+            truncated[i] = truncated[j]
+            if self.cache is not None and not truncated[i]:
+                self.cache.put(imgs[i], settings, sequences[i])
+
+        return list(zip(sequences, truncated, routes, tokens))
+
+    def call_nougat(self, imgs : Union[Image.Image, List[Image.Image]]) -> Union[str, List[str]]:
+        """
+        Transcribe one page image, or a list of page images, to markdown. See transcribe.
         """
-        Given path to PDF file returns PDFObject representation
+        single = isinstance(imgs, Image.Image)
+        if single:
+            imgs = [imgs]
+        sequences = [text for text, _, _, _ in self.transcribe(imgs)]
+        return sequences[0] if single else sequences
+
+
+    def process(self, page_imgs : Iterable[Image.Image], figs : Union[FigureRegistry, dict], first_page : int = 0,
+                sink : PageSink = None) -> PageSink:
+        """
+        Transcribe already rasterized pages and attach figures to the pages that reference them. Pages that are blank
+        or only hold figures (see page_classifier) are left empty, with the figures on them attached.
+        Pages are pulled from page_imgs one batch at a time, so it can be a lazy iterator.
+
+        :param page_imgs: Images of the pages in order
+        :param figs: Figures as returned by load_figures, or a dictionary of label to image. Matched figures are used up.
+        :param first_page: Page of the PDF the first image is of, so figures are matched to the pages closest to them
+        :param sink: Where every page goes as soon as it is done, i.e. a FolderSink to write pages out as they come.
+            A PDFObject holding every page is returned if None.
         """
-        # pdf pages as images
-        page_imgs : Iterable[Image.Image] = load_pdf(pdf_path)
-        # Dictionary of all figures from the PDF 
-        figs : dict = {} if ignore_images else load_figures(pdf_path)
+        page_imgs = iter(page_imgs)
+        sink = sink if sink is not None else PDFObject(first_page = first_page)
+        registry = figs if isinstance(figs, FigureRegistry) else FigureRegistry.from_dict(figs)
+        page_idx = first_page
+        # Enough pages to keep every replica busy
+        round_size = self.batch_size * (len(self.replicas) if self.replicas is not None else 1)
 
-        pdf_obj = PDFObject()
+        while True:
+            batch = list(islice(page_imgs, round_size))
+            if not batch:
+                break
 
-        for i, page_img in enumerate(page_imgs):
-            raw_text = self.call_nougat(page_img)
-            img_ids = find_image_identifiers(raw_text)
+            # Figures PDFFigures2 didn't render are cut out of the pages they are on
+            for i, img in enumerate(batch):
+                crop_figures(registry, page_idx + i, img)
 
-            img_ids, imgs = soft_extract_from_dict(figs, img_ids)
+            # Blank and figure only pages are left empty, with the figures on them attached
+            skipped = [None] * len(batch)
+            if self.page_classifier is not None:
+                with self.tracer.span("classify", pages = len(batch)):
+                    skipped = [self.page_classifier(img, registry.regions(page_idx + i)) for i, img in enumerate(batch)]
+            transcribed = iter(self.transcribe([img for img, route in zip(batch, skipped) if route is None]))
 
-            pdf_obj.add_page(
-                PDFPage(
-                    raw_text,
-                    img_ids,
-                    imgs
+            for img, route in zip(batch, skipped):
+                if route is None:
+                    raw_text, truncated, route, tokens = next(transcribed)
+                    img_ids, imgs = registry.take_all(find_image_identifiers(raw_text), page_idx)
+                else:
+                    raw_text, truncated, tokens = "", False, 0
+                    img_ids, imgs = registry.take_page(page_idx)
+                imgs = render_pending(imgs)
+
+                if self.tracer.enabled:
+                    # Pages are rendered ahead of time, possibly in another process, so only the time it took is known
+                    if "render_seconds" in img.info:
+                        self.tracer.event("rasterize", img.info["render_seconds"], page = page_idx)
+                    self.tracer.event("page", page = page_idx, route = route, truncated = truncated, tokens = tokens, figures = len(imgs))
+                    self.tracer.count("pages", route = route)
+
+                sink.add(
+                    PDFPage(
+                        raw_text,
+                        img_ids,
+                        imgs,
+                        truncated,
+                        route
+                    ),
+                    page_idx
                 )
-            )
+                page_idx += 1
+
+        return sink
+
+    def __call__(self, pdf_path : str, ignore_images : bool = False, first_page : int = 0, last_page : int = None,
+                 sink : PageSink = None) -> PageSink:
+        """
+        Given path to PDF file returns PDFObject representation, or the sink its pages were added to (see process)
+
+        :param first_page: Index of the first page to process. Page numbers stay those of the whole document.
+        :param last_page: Index one past the last page to process, the end of the document if None
+        """
+        # pdf pages as images, rendered lazily so only one batch of pages is held in memory at a time
+        page_imgs : Iterator[Image.Image] = iter_pdf_pages(pdf_path, first_page, last_page)
+        # All figures from the PDF, so figures on pages outside of the range can still be matched
+        figs = FigureRegistry() if ignore_images else load_figures(pdf_path, self.figure_extractor)
 
-        return pdf_obj
+        return self.process(page_imgs, figs, first_page, sink)
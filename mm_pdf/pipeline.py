@@ -0,0 +1,285 @@
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from collections import deque
+from typing import Callable, Iterable, Tuple
+import multiprocessing
+import threading
+import queue
+import time
+import os
+
+from mm_pdf.pdf_processing import PDFProcessor
+from mm_pdf.utils import pdf_utils
+from mm_pdf.utils.data_utils import DocumentManifest, PDFPage, PageSink, FolderSink, DETACHED_MARKER
+from mm_pdf.utils.packed_utils import ShardWriter, ShardSink
+from mm_pdf.utils.figure_utils import FigureRegistry
+from mm_pdf.utils.trace_utils import peak_rss
+
+"""
+Staged producer/consumer pipeline for writing a dataset. Every stage runs concurrently and is connected to the
+next by a bounded queue, so figure extraction and rasterization of the next documents overlap with Nougat
+decoding the current one while memory stays bounded:
+1. Figures: runs PDFFigures2 over a group of PDFs at once (one thread), and splits large PDFs into ranges of pages
+2. Rasterize: renders the pages of each PDF or range straight from the original file (process pool, pdfium is not thread safe)
+3. Inference: runs Nougat on the pages (caller's thread, which owns the model)
+4. Write: saves every page as soon as Nougat is done with it, encoding images along the way (thread pool).
+    Pages go either to a folder per document or, given a ShardWriter, into packed tar shards. Finished pages are
+    never held until the rest of their document is done, so memory doesn't grow with the length of documents.
+Every stage records to the tracer of the PDFProcessor, with the document it is working on bound to its events.
+"""
+
+_DONE = object() # Sentinel marking the end of a stage's output
+
+def doc_id(output_dir : str) -> str:
+    return os.path.basename(os.path.normpath(output_dir))
+
+class PipelineItem:
+    """
+    A single PDF (or range of pages of a large PDF) moving through the pipeline
+
+    :param output_dir: Where the document this item belongs to is saved
+    :param pdf_path: Path to the PDF
+    :param manifest: Manifest of the document this item belongs to
+    :param first_page: Index of the first page to process
+    :param last_page: Index one past the last page to process
+    :param is_first: Whether this is the first item of its document. Figures are extracted for the first item and
+        shared with the rest.
+    """
+    def __init__(self, output_dir : str, pdf_path : str, manifest : DocumentManifest, first_page : int = 0,
+                 last_page : int = None, is_first : bool = True):
+        self.output_dir = output_dir
+        self.pdf_path = pdf_path
+        self.manifest = manifest
+        self.first_page = first_page
+        self.last_page = last_page
+        self.is_first = is_first
+
+        self.figs = None
+        self.pages = None
+
+class WriterSink(PageSink):
+    """
+    Hands every page of an item to the writer threads of a pipeline as soon as Nougat is done with it, so pages are
+    encoded and written while the next ones are read
+    """
+    def __init__(self, pipeline : "WritePipeline", item : PipelineItem):
+        super().__init__(item.first_page)
+        self.pipeline = pipeline
+        self.doc = doc_id(item.output_dir)
+        self.sink = pipeline.document_sink(item)
+
+    def write_page(self, page_idx : int, page : PDFPage):
+        self.pipeline.submit_write(self.sink, self.doc, page_idx, page)
+
+class WritePipeline:
+    """
+    Runs PDFs through figure extraction, rasterization, Nougat and saving with the stages overlapped
+
+    :param pdf_processor: PDFProcessor used for inference
+    :param chunk_size: PDFs with more pages than this are processed in ranges of this many pages
+    :param figure_batch_size: How many PDFs to run through a single PDFFigures2 invocation
+    :param rasterize_workers: Number of processes rendering pages
+    :param writer_workers: Number of threads saving pages
+    :param queue_size: Maximum number of items waiting between two stages. Bounds memory since
+        each waiting item holds the pages of a whole PDF or range. At most queue_size batches of finished pages
+        wait to be written.
+    :param ignore_images: Skip figure extraction
+    :param on_complete: Called with the manifest of every document once it has been fully written
+    :param shard_writer: If given, pages are packed into its tar shards rather than saved to output_dir. output_dir then
+        only holds the documents manifest and its name is used as the document id in the shards.
+    :param detach_captions: Write captions to media files as pages are saved rather than leaving them in the text
+    """
+    def __init__(self, pdf_processor : PDFProcessor, chunk_size : int = 50, figure_batch_size : int = 8,
+                 rasterize_workers : int = 2, writer_workers : int = 2, queue_size : int = 4, ignore_images : bool = False,
+                 on_complete : Callable[[DocumentManifest], None] = None,
+                 shard_writer : ShardWriter = None, detach_captions : bool = False):
+        self.pdf_processor = pdf_processor
+        self.chunk_size = chunk_size
+        self.figure_batch_size = figure_batch_size
+        self.rasterize_workers = rasterize_workers
+        self.writer_workers = writer_workers
+        self.queue_size = queue_size
+        self.ignore_images = ignore_images
+        self.on_complete = on_complete
+        self.shard_writer = shard_writer
+        self.detach_captions = detach_captions
+        self.tracer = pdf_processor.tracer
+        self.started = {} # Document folder to when the pipeline started on it
+        self.lock = threading.Lock()
+
+    def split(self, pdf_path : str, output_dir : str) -> Iterable[PipelineItem]:
+        """
+        Turn a PDF into pipeline items, one per range of chunk_size pages. Pages that were already written
+        by an earlier run (according to the documents manifest) are skipped, splitting a range around them.
+        """
+        manifest = DocumentManifest(output_dir)
+        if manifest.complete:
+            return []
+        manifest.n_pages = pdf_utils.get_pdf_page_length(pdf_path)
+        if self.tracer.enabled:
+            self.started[manifest.path] = time.perf_counter()
+
+        items = []
+        for range_start in range(0, manifest.n_pages, self.chunk_size):
+            range_end = min(range_start + self.chunk_size, manifest.n_pages)
+            first_page = manifest.next_page(range_start)
+            while first_page < range_end:
+                last_page = first_page + 1
+                while last_page < range_end and last_page not in manifest.pages_done:
+                    last_page += 1
+                items.append(PipelineItem(output_dir, pdf_path, manifest, first_page, last_page, not items))
+                first_page = manifest.next_page(last_page)
+
+        # Every page was written by an earlier run that stopped before marking the document complete
+        if not items:
+            self.finish(manifest)
+        return items
+
+    def finish(self, manifest : DocumentManifest):
+        if self.detach_captions and self.shard_writer is None:
+            # Lets detach_captions.py know there's nothing left to do for this document
+            open(os.path.join(manifest.path, DETACHED_MARKER), "w").close()
+        manifest.mark_complete()
+        if self.tracer.enabled:
+            started = self.started.pop(manifest.path, None)
+            self.tracer.event("document", time.perf_counter() - started if started is not None else None,
+                              doc = doc_id(manifest.path), pages = manifest.n_pages, peak_rss_bytes = peak_rss()["self"])
+            self.tracer.count("documents")
+            self.tracer.write_summary()
+        if self.on_complete is not None:
+            self.on_complete(manifest)
+
+    def check_complete(self, manifest : DocumentManifest):
+        """
+        Finish a document if every one of its pages has been committed. Pages are committed by writer threads in any order.
+        """
+        with self.lock:
+            done = not manifest.complete and manifest.all_done()
+            if done:
+                manifest.complete = True # Claim it so no other writer finishes it too
+        if done:
+            self.finish(manifest)
+
+    def document_sink(self, item : PipelineItem) -> PageSink:
+        if self.shard_writer is None:
+            return FolderSink(item.output_dir, item.manifest, self.detach_captions, self.check_complete)
+        # Pages only count as written once their shard is closed, which may complete any document in that shard
+        return ShardSink(self.shard_writer, doc_id(item.output_dir), item.manifest, self.detach_captions, self.check_complete)
+
+    def save(self, sink : PageSink, doc : str, page_idx : int, page : PDFPage):
+        with self.tracer.bind(doc = doc), self.tracer.span("save", page = page_idx):
+            sink.write_page(page_idx, page)
+
+    def submit_write(self, sink : PageSink, doc : str, page_idx : int, page : PDFPage):
+        """
+        Queue a page for the writer threads. Blocks while too many pages are waiting to be written.
+        """
+        if self.write_errors:
+            raise self.write_errors[0]
+        self.write_slots.acquire()
+        future = self.writer_pool.submit(self.save, sink, doc, page_idx, page)
+        future.add_done_callback(self.write_done)
+
+    def write_done(self, future):
+        if future.exception() is not None:
+            self.write_errors.append(future.exception())
+        self.write_slots.release()
+
+    def figure_stage(self, jobs : Iterable[Tuple[str, str]], out_queue : queue.Queue):
+        # Every item of a document is added to the same group, so figures are extracted once per document
+        group = []
+        def flush():
+            if not self.ignore_images:
+                self.pdf_processor.figure_extractor.extract([item.pdf_path for item in group if item.is_first])
+            for item in group:
+                if item.is_first:
+                    with self.tracer.span("load_figures", doc = doc_id(item.output_dir)) as span:
+                        figs = FigureRegistry() if self.ignore_images else self.pdf_processor.figure_extractor(item.pdf_path)
+                        span["figures"] = len(figs.entries)
+                # Pages are numbered within the whole document, so the items of a document share its figures and
+                # figures can be matched to pages of other items
+                item.figs = figs
+                out_queue.put(item) # Blocks while the next stage is backed up
+            group.clear()
+
+        for pdf_path, output_dir in jobs:
+            group.extend(self.split(pdf_path, output_dir))
+            if len(group) >= self.figure_batch_size:
+                flush()
+        flush()
+
+    def rasterize_stage(self, in_queue : queue.Queue, out_queue : queue.Queue):
+        # Spawn rather than fork, forking a process that has already initialized torch isn't safe
+        with ProcessPoolExecutor(self.rasterize_workers, mp_context = multiprocessing.get_context("spawn")) as pool:
+            in_flight = deque()
+            while True:
+                item = in_queue.get()
+                if item is _DONE:
+                    break
+                if isinstance(item, BaseException):
+                    raise item
+                in_flight.append((item, pool.submit(pdf_utils.load_pdf, item.pdf_path, first_page = item.first_page, last_page = item.last_page)))
+                # Keep every worker busy without rendering arbitrarily far ahead
+                if len(in_flight) >= self.rasterize_workers:
+                    item, future = in_flight.popleft()
+                    item.pages = future.result()
+                    out_queue.put(item)
+
+            for item, future in in_flight:
+                item.pages = future.result()
+                out_queue.put(item)
+
+    def run_stage(self, stage, *args):
+        """
+        Run a stage on its own thread. Signals the end of its output (or the exception it raised) on its output queue,
+        which is always the last argument.
+        """
+        out_queue = args[-1]
+        def target():
+            try:
+                stage(*args)
+                out_queue.put(_DONE)
+            except BaseException as e:
+                out_queue.put(e)
+        thread = threading.Thread(target = target, daemon = True)
+        thread.start()
+        return thread
+
+    def __call__(self, jobs : Iterable[Tuple[str, str]]):
+        """
+        Process every (pdf_path, output_dir) pair in jobs. Documents already marked complete are skipped and
+        interrupted documents only redo the pages they hadn't written.
+        """
+        figure_queue = queue.Queue(self.queue_size)
+        page_queue = queue.Queue(self.queue_size)
+
+        figure_thread = self.run_stage(self.figure_stage, jobs, figure_queue)
+        raster_thread = self.run_stage(self.rasterize_stage, figure_queue, page_queue)
+
+        # Bounds pages waiting to be written
+        self.write_slots = threading.BoundedSemaphore(self.queue_size * self.pdf_processor.batch_size)
+        self.write_errors = []
+
+        with ThreadPoolExecutor(self.writer_workers) as self.writer_pool:
+            while True:
+                with self.tracer.span("wait_for_pages"): # Time inference is starved by the earlier stages
+                    item = page_queue.get()
+                if item is _DONE:
+                    break
+                if isinstance(item, BaseException):
+                    raise item
+
+                with self.tracer.bind(doc = doc_id(item.output_dir)), self.tracer.span("inference", pages = len(item.pages)):
+                    self.pdf_processor.process(item.pages, item.figs, item.first_page, WriterSink(self, item))
+                item.pages = item.figs = None
+
+        # Surface errors from writing
+        if self.write_errors:
+            raise self.write_errors[0]
+
+        # Documents whose last pages are in the final, partially filled shard
+        if self.shard_writer is not None:
+            for manifest in self.shard_writer.flush():
+                self.check_complete(manifest)
+
+        figure_thread.join()
+        raster_thread.join()
@@ -0,0 +1,148 @@
+from typing import List, Optional, Sequence, Tuple
+from PIL import Image
+import torch.multiprocessing as mp
+import traceback
+import queue
+import os
+import torch
+
+from mm_pdf.pdf_processing import PDFProcessor
+
+"""
+Several replicas of a PDFProcessor decoding pages side by side on CPU. A single generate loop only keeps a few cores
+busy, so on machines with many cores it is faster to run several smaller ones:
+- Replicas are spawned processes (forking a process that has already initialized torch isn't safe). The weights are
+    moved to shared memory before the replicas are started and torch passes them to every replica as a handle to that
+    memory, so the machine holds one copy of the model however many replicas there are. int8 weights are packed in a
+    way that can't be shared, each replica gets its own copy of those (a quarter of the size of float32 weights).
+- Every replica is pinned to its own slice of the cores and runs as many torch threads as it has cores, so replicas
+    don't compete for cores and torch doesn't oversubscribe them
+- Work is handed out a batch of pages at a time from a single queue that every idle replica takes from, so the pages
+    of a long book are spread over every replica rather than a replica per document
+Routing, the cache and deduplication still happen in the main process (see PDFProcessor.transcribe), only the pages
+that need Nougat are sent to the replicas.
+"""
+
+def split_cores(cores : Sequence[int], n_replicas : int) -> List[List[int]]:
+    """
+    Split cores into n_replicas contiguous groups whose sizes differ by at most one. Groups share cores if there are
+    fewer cores than replicas.
+    """
+    if len(cores) < n_replicas:
+        return [[cores[i % len(cores)]] for i in range(n_replicas)]
+    size, extra = divmod(len(cores), n_replicas)
+    groups = []
+    start = 0
+    for i in range(n_replicas):
+        end = start + size + (i < extra)
+        groups.append(list(cores[start:end]))
+        start = end
+    return groups
+
+def available_cores() -> List[int]:
+    if hasattr(os, "sched_getaffinity"):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count()))
+
+def replica_worker(pdf_processor : PDFProcessor, cores : Optional[List[int]], threads : int, tasks, results):
+    """
+    Decode batches of pages from tasks until a None task arrives. Results (or the traceback of the error a batch
+    raised) are put on results along with the id of their task.
+    """
+    if cores is not None and hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, cores)
+    torch.set_num_threads(threads)
+
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+        task_id, batch = task
+        try:
+            results.put((task_id, pdf_processor.decode_pages(batch), None))
+        except Exception:
+            results.put((task_id, None, traceback.format_exc()))
+
+class ReplicaPool:
+    """
+    Processes decoding pages with copies of a PDFProcessor that share its weights, see the top of this file.
+    Attach it to the processor it was created from to have transcribe use it: pdf_processor.replicas = ReplicaPool(pdf_processor, 4)
+
+    :param pdf_processor: PDFProcessor to replicate. Its model must be on CPU and can't be an ONNX Runtime model.
+    :param n_replicas: Number of processes
+    :param threads_per_replica: Torch threads each replica uses. The cores available divided between the replicas if None.
+    :param pin_threads: Pin every replica to its own cores
+    :param poll_seconds: How often to check that the replicas are still alive while waiting for their results
+    """
+    def __init__(self, pdf_processor : PDFProcessor, n_replicas : int, threads_per_replica : int = None,
+                 pin_threads : bool = True, poll_seconds : float = 5):
+        if pdf_processor.backend == "onnx":
+            raise ValueError("ONNX Runtime sessions can't be shared between processes, use the torch or int8 backend with replicas")
+        if str(pdf_processor.device) != "cpu":
+            raise ValueError(f"Replicas run on CPU, the model is on {pdf_processor.device}")
+        self.poll_seconds = poll_seconds
+
+        cores = available_cores()
+        groups = split_cores(cores, n_replicas)
+        if threads_per_replica is None:
+            threads_per_replica = max(1, len(cores) // n_replicas)
+        if isinstance(pdf_processor.model, torch.nn.Module):
+            pdf_processor.model.share_memory()
+
+        context = mp.get_context("spawn")
+        self.tasks = context.Queue()
+        self.results = context.Queue()
+        self.processes = []
+        for group in groups:
+            process = context.Process(
+                target = replica_worker,
+                args = (pdf_processor, group if pin_threads else None, threads_per_replica, self.tasks, self.results),
+                daemon = True
+            )
+            process.start()
+            self.processes.append(process)
+        self.next_task = 0
+
+    def __len__(self) -> int:
+        return len(self.processes)
+
+    def get_result(self) -> Tuple[int, list, Optional[str]]:
+        while True:
+            try:
+                return self.results.get(timeout = self.poll_seconds)
+            except queue.Empty:
+                # A replica that was killed (i.e. out of memory) never answers for the batch it held
+                dead = [process.pid for process in self.processes if not process.is_alive()]
+                if dead:
+                    raise RuntimeError(f"Replicas {dead} exited while decoding")
+
+    def map(self, batches : List[List[Image.Image]]) -> List[List[Tuple[str, bool, int]]]:
+        """
+        Decode batches of pages on the replicas, see PDFProcessor.decode_pages. Returns the results in the order of batches.
+        """
+        first_task = self.next_task
+        for batch in batches:
+            self.tasks.put((self.next_task, batch))
+            self.next_task += 1
+
+        decoded = {}
+        while len(decoded) < len(batches):
+            task_id, result, error = self.get_result()
+            if task_id < first_task:
+                continue # Left over from a call that raised
+            if error is not None:
+                raise RuntimeError(f"A replica failed to decode a batch:\n{error}")
+            decoded[task_id] = result
+        return [decoded[first_task + i] for i in range(len(batches))]
+
+    def close(self):
+        for _ in self.processes:
+            self.tasks.put(None)
+        for process in self.processes:
+            process.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
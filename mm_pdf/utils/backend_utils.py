@@ -0,0 +1,60 @@
+from transformers import VisionEncoderDecoderModel
+import os
+import torch
+
+"""
+Backends Nougat can be run with. All of them expose what PDFProcessor uses of a VisionEncoderDecoderModel
+(encoder, generate, config, generation_config and dtype), so the rest of the processor is the same for every backend:
+- torch: the model as is, in float16 on GPU and float32 on CPU unless a dtype is given
+- int8: dynamic int8 quantization of every linear layer (weights are stored in int8, activations are quantized on the
+    fly). CPU only, roughly halves the time spent in the linear layers which dominate decoding on CPU.
+- onnx: the encoder and the decoder (with its key/value cache) exported to ONNX and run with ONNX Runtime through
+    optimum. The export is slow, so it is saved to onnx_path and reused when given.
+"""
+
+BACKENDS = ("torch", "int8", "onnx")
+
+def default_device() -> str:
+    return "cuda" if torch.cuda.is_available() else "cpu"
+
+def load_model(model_name : str, backend : str = "torch", device : str = None, dtype : torch.dtype = None, onnx_path : str = None):
+    """
+    Load a Nougat checkpoint for one of BACKENDS
+
+    :param device: Device to run on, GPU if there is one when None. int8 only runs on CPU.
+    :param dtype: Torch dtype for the torch backend. Defaults to float16 on GPU and float32 on CPU.
+    :param onnx_path: Folder the ONNX export is saved to and loaded from, for the onnx backend. Exported every time if None.
+    """
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown backend {backend}, expected one of {BACKENDS}")
+    if device is None:
+        device = default_device()
+
+    if backend == "onnx":
+        try:
+            from optimum.onnxruntime import ORTModelForVision2Seq
+        except ImportError:
+            raise ImportError("The onnx backend needs optimum with ONNX Runtime, install it with `pip install optimum[onnxruntime]`")
+        provider = "CUDAExecutionProvider" if str(device).startswith("cuda") else "CPUExecutionProvider"
+        if onnx_path is not None and os.path.isdir(onnx_path):
+            return ORTModelForVision2Seq.from_pretrained(onnx_path, use_cache = True, provider = provider)
+        model = ORTModelForVision2Seq.from_pretrained(model_name, export = True, use_cache = True, provider = provider)
+        if onnx_path is not None:
+            model.save_pretrained(onnx_path)
+        return model
+
+    if backend == "int8":
+        if str(device) != "cpu":
+            raise ValueError("The int8 backend only runs on CPU")
+        model = VisionEncoderDecoderModel.from_pretrained(model_name, torch_dtype = torch.float32)
+        return quantize_int8(model)
+
+    if dtype is None:
+        dtype = torch.float16 if str(device).startswith("cuda") else torch.float32
+    return VisionEncoderDecoderModel.from_pretrained(model_name, torch_dtype = dtype).to(device).eval()
+
+def quantize_int8(model : VisionEncoderDecoderModel) -> VisionEncoderDecoderModel:
+    """
+    Dynamically quantize the linear layers of a float32 model on CPU
+    """
+    return torch.ao.quantization.quantize_dynamic(model.eval(), {torch.nn.Linear}, dtype = torch.qint8)
@@ -0,0 +1,137 @@
+from PIL import Image
+from typing import Optional
+import threading
+import hashlib
+import sqlite3
+import json
+import time
+
+class PageCache:
+    """
+    Persistent cache of Nougat transcriptions stored in a SQLite file.
+    - Entries are keyed by a hash of the rasterized page pixels together with the settings that affect Nougat's
+        output (model name, dtype, token budget), so the same page reached through a different URL, chunking or run
+        is only transcribed once
+    - Changing any of the settings makes every lookup miss, invalidate() can then be used to drop the stale entries
+    - Total size of the stored text is bounded by max_bytes, least recently used entries are evicted first
+
+    :param path: Path to the SQLite file, created if it doesn't exist. Processes on the same machine can share it,
+        but not machines sharing a network filesystem (SQLite locking doesn't work across them), give each its own.
+    :param max_bytes: Maximum size in bytes of all cached text
+    """
+    def __init__(self, path : str = "./nougat_cache.sqlite", max_bytes : int = 2**30):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread = False)
+        self.conn.execute("PRAGMA journal_mode=WAL") # Lets several processes on this machine share one cache
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS pages ("
+            "key TEXT PRIMARY KEY, settings TEXT NOT NULL, text TEXT NOT NULL, "
+            "size INTEGER NOT NULL, last_access REAL NOT NULL)"
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS pages_last_access ON pages (last_access)")
+        self.conn.commit()
+
+        # Running total so that the table only needs to be summed when it might be over budget
+        self.total_bytes = self.size()
+
+    @staticmethod
+    def settings_key(settings : dict) -> str:
+        """
+        Stable fingerprint for a dictionary of model settings
+        """
+        return hashlib.sha256(json.dumps(settings, sort_keys = True, default = str).encode()).hexdigest()[:16]
+
+    @staticmethod
+    def image_key(img : Image.Image) -> str:
+        """
+        Hash of a page's pixels. Size and mode are included so differently shaped pages with the same bytes don't collide.
+        """
+        h = hashlib.sha256(f"{img.mode}{img.size}".encode())
+        h.update(img.tobytes())
+        return h.hexdigest()
+
+    def key(self, img : Image.Image, settings : dict) -> str:
+        return self.image_key(img) + self.settings_key(settings)
+
+    def get(self, img : Image.Image, settings : dict) -> Optional[str]:
+        """
+        Returns cached text for page or None if it isn't cached
+        """
+        key = self.key(img, settings)
+        with self.lock:
+            row = self.conn.execute("SELECT text FROM pages WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.conn.execute("UPDATE pages SET last_access = ? WHERE key = ?", (time.time(), key))
+            self.conn.commit()
+        return row[0]
+
+    def put(self, img : Image.Image, settings : dict, text : str):
+        """
+        Store the text for a page, evicting the least recently used pages if the cache grows too large
+        """
+        key = self.key(img, settings)
+        size = len(text.encode())
+        with self.lock:
+            # Replacing a page frees the size of its old text
+            row = self.conn.execute("SELECT size FROM pages WHERE key = ?", (key,)).fetchone()
+            self.conn.execute(
+                "INSERT OR REPLACE INTO pages (key, settings, text, size, last_access) VALUES (?, ?, ?, ?, ?)",
+                (key, self.settings_key(settings), text, size, time.time())
+            )
+            self.total_bytes += size - (row[0] if row is not None else 0)
+            if self.total_bytes > self.max_bytes:
+                self.evict()
+            self.conn.commit()
+
+    def size(self) -> int:
+        """
+        Total size in bytes of cached text
+        """
+        return self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM pages").fetchone()[0]
+
+    def evict(self):
+        # Recount since other processes may be writing to the same cache
+        total = self.size()
+        # Walk from the least recently used page until enough has been freed
+        to_delete = []
+        for key, size in self.conn.execute("SELECT key, size FROM pages ORDER BY last_access"):
+            if total <= self.max_bytes:
+                break
+            to_delete.append((key,))
+            total -= size
+        self.conn.executemany("DELETE FROM pages WHERE key = ?", to_delete)
+        self.total_bytes = total
+
+    def invalidate(self, settings : dict = None):
+        """
+        Remove cached pages.
+
+        :param settings: If given, only pages cached under any other settings are removed (i.e. stale entries left
+            behind after the model settings changed). Otherwise the whole cache is cleared.
+        """
+        with self.lock:
+            if settings is None:
+                self.conn.execute("DELETE FROM pages")
+            else:
+                self.conn.execute("DELETE FROM pages WHERE settings != ?", (self.settings_key(settings),))
+            self.conn.commit()
+            self.total_bytes = self.size()
+
+    def stats(self) -> dict:
+        return {
+            "hits" : self.hits,
+            "misses" : self.misses,
+            "entries" : self.conn.execute("SELECT COUNT(*) FROM pages").fetchone()[0],
+            "bytes" : self.size()
+        }
+
+    def close(self):
+        self.conn.close()
@@ -1,7 +1,152 @@
-from typing import Iterable
+from abc import ABC, abstractmethod
+from typing import Callable, Iterable, Tuple
+import threading
+import json
+import re
+import io
 import os
 from PIL import Image
 
+def atomic_write(path : str, data : bytes):
+    """
+    Write data to path such that path either keeps its old contents or holds all of data, even if the process dies midway.
+    Data goes to a temporary file in the same folder which is then renamed over path.
+    """
+    tmp_path = f"{path}.{os.getpid()}-{threading.get_ident()}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+CAPTION_PATTERN = re.compile(r"(Figure|Table) (\d+): ")
+DETACHED_MARKER = "captions.detached" # Left in a documents folder once every page has had its captions detached
+
+def split_captions(page_text : str) -> Tuple[str, dict]:
+    """
+    Separate figure and table captions from the end of a page. Everything from the first "Figure X: " or "Table X: "
+    on is taken to be captions, each running until the next one.
+    Returns the remaining text and the contents of the pages media file:
+    {"figures" : [{"id" : X, "caption" : ...}], "tables" : [...], "text_length" : length of the remaining text}
+    """
+    matches = list(CAPTION_PATTERN.finditer(page_text))
+    ends = [match.start() for match in matches[1:]] + [len(page_text)]
+    text = page_text[:matches[0].start()] if matches else page_text
+
+    media = {"figures" : [], "tables" : [], "text_length" : len(text)}
+    for match, end in zip(matches, ends):
+        key = "figures" if match.group(1) == "Figure" else "tables"
+        media[key].append({"id" : int(match.group(2)), "caption" : page_text[match.start():end]})
+    return text, media
+
+class DocumentManifest:
+    """
+    Record of which pages of a document have been written, kept as manifest.json in the documents folder.
+    Updated after every page so an interrupted run can resume from the first unfinished page,
+    and a document only counts as done once it has been marked complete.
+    Committed pages are appended to manifest.journal, which is folded into manifest.json (written atomically) once it
+    holds half as many pages as the manifest, so pages cost the same to commit however long the document is.
+
+    :param path: Folder of the document
+    """
+    filename = "manifest.json"
+    journal_filename = "manifest.journal"
+
+    def __init__(self, path : str):
+        self.path = path
+        self.lock = threading.Lock()
+
+        self.n_pages = None
+        self.pages_done = set()
+        self.truncated = set() # Pages whose transcription was cut off before Nougat finished reading them
+        self.routes = {} # Page to how it was transcribed, see routing_utils
+        self.complete = False
+        self.journal_entries = 0 # Pages in the journal that aren't in manifest.json yet
+
+        manifest_path = os.path.join(path, self.filename)
+        if os.path.isfile(manifest_path):
+            with open(manifest_path, "r") as f:
+                manifest = json.load(f)
+            self.n_pages = manifest["n_pages"]
+            self.pages_done = set(manifest["pages_done"])
+            self.truncated = set(manifest.get("truncated", []))
+            self.routes = {int(page) : route for page, route in manifest.get("routes", {}).items()}
+            self.complete = manifest["complete"]
+
+        journal_path = os.path.join(path, self.journal_filename)
+        if os.path.isfile(journal_path):
+            with open(journal_path, "r") as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError: # Partially written last line of an interrupted run
+                        continue
+                    self.record(entry["page"], entry["truncated"], entry["route"])
+                    self.journal_entries += 1
+
+    def save(self):
+        os.makedirs(self.path, exist_ok = True)
+        manifest = {
+            "n_pages" : self.n_pages,
+            "pages_done" : sorted(self.pages_done),
+            "truncated" : sorted(self.truncated),
+            "routes" : {str(page) : self.routes[page] for page in sorted(self.routes)},
+            "complete" : self.complete
+        }
+        atomic_write(os.path.join(self.path, self.filename), json.dumps(manifest).encode())
+        # Everything in the journal is in manifest.json now. Replaying it again after a crash right here is harmless.
+        try:
+            os.remove(os.path.join(self.path, self.journal_filename))
+        except FileNotFoundError:
+            pass
+        self.journal_entries = 0
+
+    def record(self, page_idx : int, truncated : bool = False, route : str = None):
+        self.pages_done.add(page_idx)
+        if truncated:
+            self.truncated.add(page_idx)
+        if route is not None:
+            self.routes[page_idx] = route
+
+    def commit_page(self, page_idx : int, truncated : bool = False, route : str = None):
+        """
+        Mark a page as written. Should only be called once all of the pages files are in place.
+
+        :param truncated: Whether the pages transcription was truncated, see PDFPage
+        :param route: How the page was transcribed, see PDFPage
+        """
+        with self.lock:
+            self.record(page_idx, truncated, route)
+            os.makedirs(self.path, exist_ok = True)
+            entry = json.dumps({"page" : page_idx, "truncated" : truncated, "route" : route})
+            with open(os.path.join(self.path, self.journal_filename), "a") as f:
+                f.write(entry + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+            self.journal_entries += 1
+            # The first page gets n_pages into manifest.json, after that the journal at most doubles the manifest
+            if 2 * self.journal_entries >= len(self.pages_done):
+                self.save()
+
+    def mark_complete(self):
+        with self.lock:
+            self.complete = True
+            self.save()
+
+    def all_done(self) -> bool:
+        """
+        Whether every page of the document has been committed
+        """
+        return self.n_pages is not None and len(self.pages_done) >= self.n_pages
+
+    def next_page(self, start : int = 0) -> int:
+        """
+        Index of the first page at or after start that hasn't been written yet
+        """
+        while start in self.pages_done:
+            start += 1
+        return start
+
 class PDFPage:
     """
     Object to represent a single page from any PDF
@@ -9,41 +154,142 @@ class PDFPage:
     :param text: The text on the page (MD format)
     :param image_identifiers: List of identifiers for the image (i.e. figure1, table1, etc.)
     :param images: The images on that page
+    :param truncated: Whether Nougat was stopped before it finished the page, because it ran out of tokens or got stuck
+        repeating itself. Recorded in the manifest of the document.
+    :param route: How the text was transcribed: "nougat", "text_layer", or "blank" and "figure_only" for pages that
+        were left empty (see routing_utils). Recorded in the manifest of the document.
     """
-    def __init__(self, text : str, image_identifiers : Iterable[str], images : Iterable[Image.Image]):
+    def __init__(self, text : str, image_identifiers : Iterable[str], images : Iterable[Image.Image], truncated : bool = False,
+                 route : str = "nougat"):
         self.text = text
         self.image_identifiers = image_identifiers
         self.images = images
+        self.truncated = truncated
+        self.route = route
         
-class PDFObject:
+def save_page(path : str, page_idx : int, page : PDFPage, manifest : DocumentManifest, detach_captions : bool = False):
+    """
+    Write a page into the folder of its document (see PDFObject.save) and commit it to the manifest
+    """
+    page_id = str(page_idx).zfill(8)
+    for (id, img) in zip(page.image_identifiers, page.images):
+        img_bytes = io.BytesIO()
+        img.save(img_bytes, format = "PNG")
+        atomic_write(f"{path}/{page_id}-{id}.png", img_bytes.getvalue())
+    text = page.text
+    if detach_captions:
+        text, media = split_captions(text)
+        atomic_write(f"{path}/{page_id}-media.json", json.dumps(media).encode())
+    atomic_write(f"{path}/{page_id}.txt", text.encode(errors = "ignore"))
+    manifest.commit_page(page_idx, page.truncated, page.route)
+
+class PageSink(ABC):
+    """
+    Where the pages of a document go as they are transcribed. PDFProcessor.process hands every page to add as soon as
+    it is done, so a sink that writes pages out right away keeps memory use the same however long the document is.
+    Only counts of what went through the sink are kept.
+    Subclasses implement write_page.
+
+    :param first_page: Index in the full document of the first page added
+    """
+    def __init__(self, first_page : int = 0):
+        self.first_page = first_page
+        self.n_pages = 0
+        self.n_figures = 0
+        self.truncated = [] # Pages whose transcription was truncated, see PDFPage
+        self.routes = {} # Route to the number of pages transcribed that way, see PDFPage
+
+    def add(self, page : PDFPage, page_idx : int = None):
+        """
+        :param page_idx: Index of the page in the full document, the page after the last one added if None
+        """
+        if page_idx is None:
+            page_idx = self.first_page + self.n_pages
+        self.n_pages += 1
+        self.n_figures += len(page.images)
+        if page.truncated:
+            self.truncated.append(page_idx)
+        self.routes[page.route] = self.routes.get(page.route, 0) + 1
+        self.write_page(page_idx, page)
+
+    @abstractmethod
+    def write_page(self, page_idx : int, page : PDFPage):
+        pass
+
+class FolderSink(PageSink):
+    """
+    Writes every page into the folder of its document as soon as it is added, see PDFObject.save for the layout
+
+    :param path: Folder of the document
+    :param manifest: Manifest to commit pages to. The manifest already in path is used if None.
+    :param detach_captions: See PDFObject.save
+    :param on_commit: Called with the manifest after every page committed to it, from the thread that added the page
     """
-    Object to represent a PDF file with figure locations and images embedded appropriately
+    def __init__(self, path : str, manifest : DocumentManifest = None, detach_captions : bool = False,
+                 on_commit : Callable[[DocumentManifest], None] = None, first_page : int = 0):
+        super().__init__(first_page)
+        os.makedirs(path, exist_ok = True)
+        self.path = path
+        self.manifest = manifest if manifest is not None else DocumentManifest(path)
+        self.detach_captions = detach_captions
+        self.on_commit = on_commit
+
+    def write_page(self, page_idx : int, page : PDFPage):
+        save_page(self.path, page_idx, page, self.manifest, self.detach_captions)
+        if self.on_commit is not None:
+            self.on_commit(self.manifest)
+
+class PDFObject(PageSink):
+    """
+    Object to represent a PDF file with figure locations and images embedded appropriately.
+    Holds every page in memory, prefer a sink that writes pages out (FolderSink, packed_utils.ShardSink) for long documents.
     """
-    def __init__(self, pages = []):
-        self.pages = pages
+    def __init__(self, pages = None, first_page : int = 0):
+        super().__init__(first_page)
+        # A fresh list for every object, a mutable default argument would be shared by every PDFObject
+        self.pages = []
+        for page in pages or []:
+            self.add(page)
 
     def add_page(self, page : PDFPage):
+        self.add(page)
+
+    def write_page(self, page_idx : int, page : PDFPage):
         self.pages.append(page)
     
-    def save(self, path : str):
+    def save(self, path : str, start_page : int = None, manifest : DocumentManifest = None, detach_captions : bool = False,
+             complete : bool = False):
         """
         Saves to path given in the following manner: 
         - each page is given an 8-digit ID
         - The text from the page is saved as [id].txt
         - each image is saved as [id]-[photoid].txt 
+        - every file is written atomically, and once a pages files are all written it is committed to the manifest
+
+        :param start_page: Index in the full document of the first page in this object, used for page IDs.
+            The first_page of the object if None.
+        :param manifest: Manifest to commit pages to. The manifest already in path is used if None.
+        :param detach_captions: Move captions from the text into [id]-media.json as it is written, the same as running
+            detach_captions.py on the dataset afterwards
+        :param complete: The object holds every page of the document, so mark it complete once they are saved.
+            detach_captions.py leaves documents that aren't complete for a later run.
         """
         os.makedirs(path, exist_ok=True)
+        if manifest is None:
+            manifest = DocumentManifest(path)
+
+        if start_page is None:
+            start_page = self.first_page
         for i, page in enumerate(self.pages):
-            page_id = str(i).zfill(8)
-            with open(f"{path}/{page_id}.txt", "w", errors = "ignore") as text_file:
-                text_file.write(page.text)
-            for (id, img) in zip(page.image_identifiers, page.images):
-                img.save(f"{path}/{page_id}-{id}.png")
+            save_page(path, start_page + i, page, manifest, detach_captions)
+        if complete:
+            manifest.n_pages = max(manifest.pages_done, default = -1) + 1
+            manifest.mark_complete()
 
 def join_pdf_objects(ls : Iterable[PDFObject]) -> PDFObject:
     """
     Join multiple PDF objects by appending pages. May not account for multiple figures
-    having the same identifiers.
+    having the same identifiers. Holds every page of every object, for long documents add the pages to a sink instead.
     """
     return PDFObject([page for obj in ls for page in obj.pages])
 
@@ -0,0 +1,177 @@
+from PIL import Image
+from typing import List, Optional, Tuple
+import numpy as np
+import threading
+import sqlite3
+import json
+import time
+
+from mm_pdf.utils.cache_utils import PageCache
+
+def page_hash(img : Image.Image, hash_size : int = 16) -> int:
+    """
+    Perceptual (difference) hash of a page: the page is shrunk to hash_size x (hash_size + 1) by averaging and every
+    bit records whether a cell is brighter than its left neighbour. Small changes such as a different arXiv stamp or
+    rendering noise only flip a few of the hash_size**2 bits.
+    """
+    gray = img.convert("L").resize((hash_size + 1, hash_size), Image.BOX)
+    pixels = np.asarray(gray, dtype = np.int16)
+    bits = (pixels[:, 1:] > pixels[:, :-1]).flatten()
+    return int.from_bytes(np.packbits(bits).tobytes(), "big")
+
+def hamming(a : int, b : int) -> int:
+    return bin(a ^ b).count("1")
+
+class PageDeduplicator:
+    """
+    Persistent index of the perceptual hashes of every transcribed page, so that near duplicate pages (other
+    versions of a paper, repeated front matter or licence pages) reuse an earlier transcription instead of going
+    through Nougat again. Unlike PageCache, which only reuses exact pixel matches, pages within threshold bits
+    of each other count as the same page.
+    - Lookups use LSH: the hash is split into threshold + 1 bands, and any two hashes within threshold bits of each
+        other agree exactly on at least one band, so only pages sharing a band have to be compared
+    - Only pages transcribed under the same settings are reused, see PDFProcessor.cache_settings
+    - Every reuse is counted, and appended to stats_path as soon as it happens along with the distance it was found at,
+        the document and page it happened on and the document and page whose transcription it reused
+    - Nearly empty pages (i.e. a lone chapter title or page number) hash almost the same whatever they say, so
+        pages with fewer than min_bits set bits are never treated as duplicates. They are quick to transcribe anyway.
+
+    :param path: Path to the SQLite file, created if it doesn't exist. Like PageCache, only processes on the same
+        machine can share it.
+    :param threshold: Maximum number of differing bits for two pages to count as duplicates
+    :param hash_size: Side of the hash grid, hashes have hash_size**2 bits
+    :param stats_path: JSON lines file every reused page is appended to. Not written if None.
+    :param min_bits: Pages whose hash has fewer set bits than this are never deduplicated
+    """
+    def __init__(self, path : str = "./page_dedup.sqlite", threshold : int = 6, hash_size : int = 16, stats_path : str = None,
+                 min_bits : int = 16):
+        self.path = path
+        self.threshold = threshold
+        self.hash_size = hash_size
+        self.min_bits = min_bits
+        self.stats_path = stats_path
+
+        n_bits = hash_size ** 2
+        n_bands = threshold + 1
+        # (shift, mask) of each band, spread as evenly as possible over the bits
+        edges = [n_bits * i // n_bands for i in range(n_bands + 1)]
+        self.bands = [(lo, (1 << (hi - lo)) - 1) for lo, hi in zip(edges[:-1], edges[1:])]
+
+        self.checked = 0
+        self.reused = 0
+        self.distances = {} # Distance to the number of pages reused at it
+        self.stats_file = open(stats_path, "a", buffering = 1) if stats_path is not None else None # Line buffered
+
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread = False)
+        self.conn.execute("PRAGMA journal_mode=WAL") # Lets several processes on this machine share one index
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS pages ("
+            "id INTEGER PRIMARY KEY, hash TEXT NOT NULL, settings TEXT NOT NULL, text TEXT NOT NULL, doc TEXT, page INTEGER)"
+        )
+        # Indexes from before pages were recorded along with where they came from
+        columns = {row[1] for row in self.conn.execute("PRAGMA table_info(pages)")}
+        for column, kind in (("doc", "TEXT"), ("page", "INTEGER")):
+            if column not in columns:
+                self.conn.execute(f"ALTER TABLE pages ADD COLUMN {column} {kind}")
+        # Bands are prefixed with the hash size and threshold so an index can be reopened with other parameters
+        self.conn.execute("CREATE TABLE IF NOT EXISTS bands (band TEXT NOT NULL, page_id INTEGER NOT NULL)")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS bands_band ON bands (band)")
+        self.conn.commit()
+
+    def hash(self, img : Image.Image) -> int:
+        return page_hash(img, self.hash_size)
+
+    def usable(self, h : int) -> bool:
+        """
+        Whether a page has enough content for its hash to tell it apart from other pages
+        """
+        return bin(h).count("1") >= self.min_bits
+
+    def band_keys(self, h : int) -> List[str]:
+        return [f"{self.hash_size}:{self.threshold}:{i}:{(h >> shift) & mask:x}" for i, (shift, mask) in enumerate(self.bands)]
+
+    def find(self, h : int, settings : dict) -> Optional[Tuple[str, int, int]]:
+        """
+        Closest earlier page within threshold bits of hash h that was transcribed under settings.
+        Returns (text, page_id, distance), or None if there is no such page.
+        """
+        if not self.usable(h):
+            return None
+        settings_key = PageCache.settings_key(settings)
+        band_keys = self.band_keys(h)
+        with self.lock:
+            self.checked += 1
+            rows = self.conn.execute(
+                "SELECT DISTINCT pages.id, pages.hash, pages.text FROM bands JOIN pages ON bands.page_id = pages.id "
+                f"WHERE bands.band IN ({','.join('?' * len(band_keys))}) AND pages.settings = ?",
+                (*band_keys, settings_key)
+            ).fetchall()
+
+        best = None
+        for page_id, other, text in rows:
+            distance = hamming(h, int(other, 16))
+            if distance <= self.threshold and (best is None or (distance, page_id) < (best[2], best[1])):
+                best = (text, page_id, distance)
+        return best
+
+    def add(self, h : int, settings : dict, text : str, doc : str = None, page : int = None):
+        """
+        Record the transcription of a page with hash h
+
+        :param doc: Document the page is from, see iter_pdf_pages
+        :param page: Index of the page in its document
+        """
+        if not self.usable(h):
+            return
+        with self.lock:
+            cursor = self.conn.execute(
+                "INSERT INTO pages (hash, settings, text, doc, page) VALUES (?, ?, ?, ?, ?)",
+                (f"{h:x}", PageCache.settings_key(settings), text, doc, page)
+            )
+            self.conn.executemany(
+                "INSERT INTO bands (band, page_id) VALUES (?, ?)", [(band, cursor.lastrowid) for band in self.band_keys(h)]
+            )
+            self.conn.commit()
+
+    def record_reuse(self, h : int, distance : int, doc : str = None, page : int = None, matched : Optional[int] = None,
+                     matched_doc : str = None, matched_page : int = None):
+        """
+        Count a page whose transcription was reused and append it to stats_path
+
+        :param doc: Document of the page, see iter_pdf_pages
+        :param page: Index of the page in its document
+        :param matched: Id of the page in the index it reused, None if it was a duplicate of a page in the same batch.
+            The document and page of the match are looked up from it when given.
+        :param matched_doc: Document of the page it reused
+        :param matched_page: Index of the page it reused in its document
+        """
+        with self.lock:
+            if matched is not None:
+                matched_doc, matched_page = self.conn.execute("SELECT doc, page FROM pages WHERE id = ?", (matched,)).fetchone()
+            self.reused += 1
+            self.distances[distance] = self.distances.get(distance, 0) + 1
+            if self.stats_file is not None:
+                self.stats_file.write(json.dumps({
+                    "doc" : doc,
+                    "page" : page,
+                    "matched_doc" : matched_doc,
+                    "matched_page" : matched_page,
+                    "matched_id" : matched,
+                    "distance" : distance,
+                    "hash" : f"{h:x}",
+                    "time" : time.time()
+                }) + "\n")
+
+    def stats(self) -> dict:
+        return {
+            "checked" : self.checked,
+            "reused" : self.reused,
+            "distances" : dict(sorted(self.distances.items())),
+            "indexed" : self.conn.execute("SELECT COUNT(*) FROM pages").fetchone()[0]
+        }
+
+    def close(self):
+        if self.stats_file is not None:
+            self.stats_file.close()
+        self.conn.close()
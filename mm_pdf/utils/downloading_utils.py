@@ -1,6 +1,11 @@
-import os
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Iterable, Iterator
+import urllib.parse
+import threading
+import requests
 import hashlib
-import urllib.request
+import time
+import os
 
 def url_to_filename(url : str):
     """
@@ -16,19 +21,161 @@ def get_id_without_ext(path : str):
     """
     return path[:path.find(".")]
 
-def download_if_not_present(paper_url : str, cache_dir = "./paper_cache"):
+PDF_MAGIC = b"%PDF-"
+RETRY_STATUSES = {408, 425, 429, 500, 502, 503, 504} # Statuses worth retrying, others fail straight away
+
+class InvalidPDFError(Exception):
     """
-    Given paper URL and cache folder checks if paper was already downloaded
+    Raised when a download finished but the response is not a PDF
+    """
+
+def is_pdf(path : str) -> bool:
     """
-    os.makedirs(cache_dir, exist_ok=True)
-    fp = url_to_filename(paper_url)
-    file_path = os.path.join(cache_dir, fp)
+    Check the magic bytes at the start of a file
+    """
+    with open(path, "rb") as f:
+        return f.read(len(PDF_MAGIC)) == PDF_MAGIC
+
+class Downloader:
+    """
+    Downloads PDFs into a cache folder concurrently.
+    - One pooled session is shared by all threads so connections to each host are reused
+    - Requests to the same host are spaced out to respect a rate limit
+    - Failed requests are retried with exponential backoff
+    - Data is streamed into [file].part and only renamed to [file] once complete and starting with %PDF, so the cache
+        never holds partial files. Interrupted downloads resume with a range request, conditional on the file not
+        having changed on the server in the meantime (If-Range).
+
+    :param cache_dir: Folder PDFs are downloaded into
+    :param max_workers: Number of downloads running at once
+    :param requests_per_second: Maximum rate of requests sent to any single host
+    :param max_retries: Number of times a download is retried before giving up
+    :param backoff: Seconds waited before the first retry, doubled for every retry after it
+    :param timeout: Seconds to wait for the server before a request counts as failed
+    """
+    def __init__(self, cache_dir : str = "./paper_cache", max_workers : int = 8, requests_per_second : float = 4,
+                 max_retries : int = 4, backoff : float = 1.0, timeout : float = 60):
+        self.cache_dir = cache_dir
+        self.max_workers = max_workers
+        self.min_interval = 1 / requests_per_second
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.timeout = timeout
+        os.makedirs(cache_dir, exist_ok=True)
+
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections = max_workers, pool_maxsize = max_workers)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+        self.host_lock = threading.Lock()
+        self.host_next_request = {} # host -> earliest time the next request to it may be sent
 
-    if not os.path.exists(file_path):
-        try:
-            urllib.request.urlretrieve(paper_url, file_path)
-        except:
-            raise Exception(f"Failed to retrieve PDF from URL {paper_url}, check if URL is valid.")
-    
-    return file_path
+    def wait_for_host(self, url : str):
+        """
+        Block until sending another request to the urls host stays within the rate limit
+        """
+        host = urllib.parse.urlparse(url).netloc
+        with self.host_lock:
+            now = time.monotonic()
+            send_at = max(now, self.host_next_request.get(host, now))
+            self.host_next_request[host] = send_at + self.min_interval
+        time.sleep(send_at - now)
 
+    def fetch_once(self, url : str, file_path : str):
+        """
+        Single attempt at downloading url to file_path, resuming from a .part file if there is one
+        """
+        part_path = file_path + ".part"
+        validator_path = part_path + ".validator" # ETag or Last-Modified of the partial download
+
+        headers = {}
+        offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+        if offset and os.path.exists(validator_path):
+            with open(validator_path, "r") as f:
+                headers["Range"] = f"bytes={offset}-"
+                headers["If-Range"] = f.read()
+
+        self.wait_for_host(url)
+        with self.session.get(url, headers = headers, stream = True, timeout = self.timeout) as response:
+            if response.status_code == 416: # Nothing left to fetch, the partial file holds everything
+                pass
+            else:
+                response.raise_for_status()
+                if response.status_code != 206: # Server sent the whole file, either fresh or because it changed
+                    offset = 0
+                    validator = response.headers.get("ETag") or response.headers.get("Last-Modified")
+                    if validator:
+                        with open(validator_path, "w") as f:
+                            f.write(validator)
+                    elif os.path.exists(validator_path):
+                        os.remove(validator_path)
+
+                with open(part_path, "ab" if offset else "wb") as f:
+                    for chunk in response.iter_content(chunk_size = 1 << 16):
+                        f.write(chunk)
+
+        if os.path.exists(validator_path):
+            os.remove(validator_path)
+        if not is_pdf(part_path):
+            os.remove(part_path)
+            raise InvalidPDFError(f"Response from {url} is not a PDF")
+        os.replace(part_path, file_path)
+
+    def fetch(self, url : str) -> str:
+        """
+        Download url into the cache unless it is already there, returns the path to the PDF
+        """
+        file_path = os.path.join(self.cache_dir, url_to_filename(url))
+        if os.path.exists(file_path):
+            if is_pdf(file_path):
+                return file_path
+            os.remove(file_path) # i.e. an error page saved by an older version
+
+        for attempt in range(self.max_retries + 1):
+            try:
+                self.fetch_once(url, file_path)
+                return file_path
+            except requests.HTTPError as e:
+                if e.response.status_code not in RETRY_STATUSES:
+                    raise
+                error = e
+            except (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError) as e:
+                error = e # The .part file is kept so the next attempt can resume
+            if attempt < self.max_retries:
+                time.sleep(self.backoff * 2 ** attempt)
+
+        raise Exception(f"Failed to retrieve PDF from URL {url} after {self.max_retries + 1} attempts: {error}")
+
+    def download_all(self, urls : Iterable[str]) -> Iterator[str]:
+        """
+        Download every URL, yielding paths to the PDFs as soon as they are available (not in the order of urls)
+        so they can be processed while the rest are downloading. URLs that fail are reported and skipped.
+        """
+        with ThreadPoolExecutor(self.max_workers) as pool:
+            futures = {}
+            cached = []
+            seen = set()
+            # Every download is submitted before anything is yielded, so downloads don't wait on the consumer
+            for url in urls:
+                file_path = os.path.join(self.cache_dir, url_to_filename(url))
+                if file_path in seen: # Two downloads of one URL would write to the same .part file
+                    continue
+                seen.add(file_path)
+                if os.path.exists(file_path) and is_pdf(file_path):
+                    cached.append(file_path)
+                else:
+                    futures[pool.submit(self.fetch, url)] = url
+
+            yield from cached
+            for future in as_completed(futures):
+                try:
+                    yield future.result()
+                except Exception as e:
+                    print(f"Skipping {futures[future]}: {e}")
+
+def download_if_not_present(paper_url : str, cache_dir = "./paper_cache"):
+    """
+    Given paper URL and cache folder checks if paper was already downloaded
+    """
+    return Downloader(cache_dir, max_workers = 1).fetch(paper_url)
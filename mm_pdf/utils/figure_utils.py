@@ -0,0 +1,186 @@
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+import re
+
+"""
+Matching of the figure/table identifiers Nougat reads from a page (i.e. "figure2") to the figures PDFFigures2
+extracted from the document (i.e. "figure1.2" found on page 4).
+Nougat regularly misreads labels, most commonly dropping the chapter from decimal labels ("Figure 1.2:" is read as
+"Figure 2:"), so labels are indexed three ways and looked up in order of how exact the match is:
+1. Exact: the label as PDFFigures2 gave it, lowercased ("figure1.2")
+2. Normalized: whitespace, trailing punctuation and leading zeros removed ("Figure 01." -> "figure1")
+3. Decimal stripped: everything up to the first decimal point of the number removed ("figure1.2" -> "figure2")
+When several unused figures match at the same level, the one closest to the page being read wins, with ties going
+to the earlier page and then to the order figures were added in.
+"""
+
+def normalize_label(label : str) -> str:
+    """
+    Canonical form of a figure or table label: "Figure 01.2." -> "figure1.2"
+    """
+    label = re.sub(r"\s+", "", label.lower()).rstrip(".:")
+    # Leading zeros of every number, but not a lone zero
+    return re.sub(r"(?<!\d)0+(?=\d)", "", label)
+
+def strip_decimal(label : str) -> Optional[str]:
+    """
+    Label with the part of its number before the first decimal point removed: "figure1.2" -> "figure2",
+    "figurea.1" -> "figure1". None if the label has no decimal point.
+    """
+    match = re.match(r"(figure|table)[^.]*\.(.+)", label)
+    if match is None:
+        return None
+    return match.group(1) + match.group(2)
+
+def page_identifier(label : str, taken : Iterable[str] = ()) -> str:
+    """
+    Identifier for a label, used to save figures that weren't matched to an identifier Nougat read. Where possible it
+    has the same form as the ones Nougat reads ("figure2", "table1") so readers of the dataset match it to its caption,
+    with decimal labels keeping the number after their decimal point like strip_decimal does ("figure1.2" -> "figure2").
+    Labels without a number, or whose identifier is already in taken, keep the label instead, with a "-2", "-3", ...
+    suffix where that is taken or a whole number too ("figure3.2" -> "figure3.2", "figure3" -> "figure3-2"). Captions
+    only have whole numbers, so these never get the caption of another figure.
+    """
+    label = normalize_label(label)
+    kind = "table" if label.startswith("table") else "figure"
+    match = re.search(r"(\d+)$", strip_decimal(label) or label)
+    if match is not None and f"{kind}{int(match.group(1))}" not in taken:
+        return f"{kind}{int(match.group(1))}"
+    base = label if label.startswith(kind) else kind + label
+    identifier, n = base, 1
+    while identifier in taken or re.fullmatch(r"(figure|table)\d+", identifier):
+        n += 1
+        identifier = f"{base}-{n}"
+    return identifier
+
+class FigureEntry:
+    """
+    A single figure or table from PDFFigures2
+
+    :param label: Lowercased label such as "figure1.2" or "table3"
+    :param image: The image (or anything else to hand back on a match)
+    :param page: Page of the PDF it was found on, None if unknown
+    :param order: Position it was added in, used to break ties deterministically
+    :param regions: Boxes (x1, y1, x2, y2) in PDF points the figure and its caption take up on the page
+    """
+    def __init__(self, label : str, image : Any, page : Optional[int], order : int, regions : List[Tuple[float, float, float, float]] = ()):
+        self.label = label
+        self.image = image
+        self.page = page
+        self.order = order
+        self.regions = list(regions)
+        self.used = False
+
+class FigureRegistry:
+    """
+    Every figure of a document indexed for matching against the identifiers Nougat reads from its pages.
+    Built once per document. Every figure is matched at most once. A lookup only looks at the figures sharing its
+    key rather than every figure of the document, and matched figures are dropped from the indexes as lookups go.
+    Figures are indexed by page as well, for the lookups made for every page.
+    """
+    def __init__(self):
+        self.entries : List[FigureEntry] = []
+        self.pages : Dict[Optional[int], List[FigureEntry]] = {}
+        self.exact : Dict[str, List[FigureEntry]] = {}
+        self.normalized : Dict[str, List[FigureEntry]] = {}
+        self.stripped : Dict[str, List[FigureEntry]] = {}
+
+    @classmethod
+    def from_dict(cls, figures : dict) -> "FigureRegistry":
+        """
+        Registry from a dictionary of label to image, as load_figures used to return, with unknown pages
+        """
+        registry = cls()
+        for label, image in figures.items():
+            registry.add(label, image)
+        return registry
+
+    def add(self, label : str, image : Any, page : Optional[int] = None, regions : List[Tuple[float, float, float, float]] = ()):
+        entry = FigureEntry(label.lower(), image, page, len(self.entries), regions)
+        self.entries.append(entry)
+        self.pages.setdefault(page, []).append(entry)
+        self.exact.setdefault(entry.label, []).append(entry)
+        self.normalized.setdefault(normalize_label(entry.label), []).append(entry)
+        stripped = strip_decimal(normalize_label(entry.label))
+        if stripped is not None:
+            self.stripped.setdefault(stripped, []).append(entry)
+
+    def __len__(self) -> int:
+        return sum(not entry.used for entry in self.entries)
+
+    def remaining(self) -> Dict[str, Any]:
+        """
+        Figures that were never matched, by label
+        """
+        return {entry.label : entry.image for entry in self.entries if not entry.used}
+
+    def on_page(self, page : int) -> List[FigureEntry]:
+        """
+        Every figure found on a page, whether it was matched or not
+        """
+        return self.pages.get(page, [])
+
+    def regions(self, page : int) -> List[Tuple[float, float, float, float]]:
+        """
+        Boxes taken up by every figure on a page and their captions, whether they were matched or not
+        """
+        return [region for entry in self.on_page(page) for region in entry.regions]
+
+    def take_page(self, page : int) -> Tuple[List[str], List[Any]]:
+        """
+        Take every unused figure on a page, for pages that aren't read by Nougat. Same form as take_all, with every
+        label turned into an identifier like the ones Nougat reads (see page_identifier).
+        """
+        entries = [entry for entry in self.on_page(page) if not entry.used]
+        identifiers = []
+        for entry in entries:
+            entry.used = True
+            identifiers.append(page_identifier(entry.label, identifiers))
+        return identifiers, [entry.image for entry in entries]
+
+    @staticmethod
+    def closest(candidates : List[FigureEntry], page : Optional[int]) -> Optional[FigureEntry]:
+        candidates[:] = [entry for entry in candidates if not entry.used]
+        best = None
+        best_key = None
+        for entry in candidates:
+            if entry.page is None: # Figures with a known page win over ones without
+                distance = float("inf")
+            elif page is None:
+                distance = 0
+            else:
+                distance = abs(entry.page - page)
+            key = (distance, entry.page if entry.page is not None else float("inf"), entry.order)
+            if best_key is None or key < best_key:
+                best, best_key = entry, key
+        return best
+
+    def take(self, identifier : str, page : Optional[int] = None) -> Optional[FigureEntry]:
+        """
+        Find the best unused figure for an identifier read on a page and mark it used. None if there is no match.
+        """
+        identifier = identifier.lower()
+        normalized = normalize_label(identifier)
+        for index, key in ((self.exact, identifier), (self.normalized, normalized), (self.stripped, normalized)):
+            if key not in index:
+                continue
+            entry = self.closest(index[key], page)
+            if entry is not None:
+                entry.used = True
+                return entry
+        return None
+
+    def take_all(self, identifiers : Iterable[str], page : Optional[int] = None) -> Tuple[List[str], List[Any]]:
+        """
+        Match every identifier read on a page. Returns the identifiers that matched and their images, in the same
+        form as extract_from_dict. Repeated identifiers are only matched once.
+        """
+        return_keys = []
+        return_values = []
+        for identifier in identifiers:
+            if identifier in return_keys:
+                continue
+            entry = self.take(identifier, page)
+            if entry is not None:
+                return_keys.append(identifier)
+                return_values.append(entry.image)
+        return return_keys, return_values
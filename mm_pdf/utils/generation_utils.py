@@ -0,0 +1,105 @@
+from transformers import StoppingCriteria
+from PIL import Image
+from typing import Optional
+import numpy as np
+import torch
+
+"""
+Keeping Nougat from spending its whole token budget on pages it has already finished reading:
+- Nougat is known to fall into loops where it repeats the same line or few tokens until it runs out of tokens.
+    RepetitionStoppingCriteria cuts those rows off as soon as the loop is long enough to be sure of it.
+- Most pages need far fewer tokens than the worst case, so estimate_token_budget gives each page a budget based
+    on how much text it holds, which bounds how long a page can loop for before being noticed.
+"""
+
+# Budget estimates are deliberately generous, truncating a page that needed more tokens loses content while a
+# budget that is too large only costs time on pages that loop in a way the repetition check doesn't catch.
+TOKENS_PER_CHAR = 1.0 # Per character in the text layer. LaTeX turns many single glyphs into several tokens.
+TOKENS_PER_INK = 40000 # Per unit of ink coverage, a dense page of text covers around 8% of the page
+MIN_TOKEN_BUDGET = 1024
+
+class RepetitionStoppingCriteria(StoppingCriteria):
+    """
+    Stops rows whose most recent tokens are a single unit of up to max_period tokens repeated back to back at least
+    min_repeats times, covering at least min_span tokens. Rows it stopped are kept in stopped until reset() is called.
+
+    :param max_period: Longest repeated unit that is looked for
+    :param min_repeats: Number of times a unit has to repeat in a row
+    :param min_span: Minimum number of tokens the repetition has to cover, so that short runs that are legitimately
+        repetitive (i.e. the rule under a table header) aren't cut off
+    :param check_every: Only check every check_every tokens, a check compares max_period shifted copies of the output
+    """
+    def __init__(self, max_period : int = 128, min_repeats : int = 4, min_span : int = 256, check_every : int = 16):
+        self.max_period = max_period
+        self.min_repeats = min_repeats
+        self.min_span = min_span
+        self.check_every = check_every
+        self.stopped = None
+
+    def reset(self):
+        self.stopped = None
+
+    def span(self, period : int) -> int:
+        return max(period * self.min_repeats, self.min_span)
+
+    def __call__(self, input_ids : torch.LongTensor, scores, **kwargs) -> torch.BoolTensor:
+        stop = torch.zeros(input_ids.shape[0], dtype = torch.bool, device = input_ids.device)
+        if input_ids.shape[1] % self.check_every:
+            return stop
+        for period in range(1, self.max_period + 1):
+            span = self.span(period)
+            if span > input_ids.shape[1]:
+                break # Spans only grow with the period
+            # A run is periodic if it equals itself shifted by the period
+            tail = input_ids[:, -span:]
+            stop |= (tail[:, period:] == tail[:, :-period]).all(dim = 1)
+
+        self.stopped = stop if self.stopped is None else self.stopped | stop
+        return stop
+
+    def trim(self, ids : torch.Tensor, pad_token_id : Optional[int] = None) -> torch.Tensor:
+        """
+        Cut the repetition from the end of a single sequence, keeping one copy of the repeated unit.
+        Returned unchanged if it doesn't end in a repetition.
+
+        :param pad_token_id: Padding after the repetition, added by generate once a row has stopped, is removed first
+        """
+        tokens = ids.tolist()
+        while pad_token_id is not None and tokens and tokens[-1] == pad_token_id:
+            tokens.pop()
+        ids = ids[:len(tokens)]
+        for period in range(1, self.max_period + 1):
+            span = self.span(period)
+            if span > len(tokens):
+                break
+            tail = tokens[-span:]
+            if tail[period:] == tail[:-period]:
+                # Walk back to where the loop starts
+                start = len(tokens) - span
+                while start > 0 and tokens[start - 1] == tokens[start - 1 + period]:
+                    start -= 1
+                return ids[:start + period]
+        return ids
+
+def ink_fraction(img : Image.Image, threshold : int = 128) -> float:
+    """
+    Fraction of a page covered by dark pixels. Computed on a reduced copy since only the rough amount matters.
+    """
+    gray = img.convert("L")
+    gray.thumbnail((512, 512))
+    return float((np.asarray(gray) < threshold).mean())
+
+def estimate_token_budget(img : Image.Image, max_tokens : int, n_chars : Optional[int] = None) -> int:
+    """
+    Number of tokens a page can be expected to need at most, between MIN_TOKEN_BUDGET and max_tokens.
+    Based on the length of the pages text layer if it has one, otherwise on how much of the page is covered in ink.
+
+    :param n_chars: Number of characters in the text layer of the page. Set by iter_pdf_pages in img.info["n_chars"].
+    """
+    if n_chars is None:
+        n_chars = img.info.get("n_chars")
+    if n_chars: # Scanned pages have an empty text layer
+        budget = n_chars * TOKENS_PER_CHAR
+    else:
+        budget = ink_fraction(img) * TOKENS_PER_INK
+    return int(min(max_tokens, max(MIN_TOKEN_BUDGET, budget)))
@@ -0,0 +1,172 @@
+from typing import Iterable, Optional, Tuple
+import threading
+import sqlite3
+import tarfile
+import os
+
+from mm_pdf.utils.packed_utils import member_filename
+
+"""
+Index of everything in a written dataset, kept as a SQLite file in the dataset folder so readers can find any
+document, page, figure or table without listing or parsing the directory tree. Two tables:
+    files: one row per file of a document (doc, name, page, kind, num, shard, member, offset, size)
+        - name is the file name as it would be in a documents folder, i.e. 00000003-figure2.png
+        - kind is one of "text", "figure", "table", "media" (detached captions)
+        - shard, member and offset locate the file inside of a tar shard for packed datasets, otherwise NULL
+    docs: one row per document with its number of pages, figures and tables
+SQLite can't be shared between machines over a network filesystem, so workers never write to the index of the dataset.
+Every worker writes its own fragment under [dataset]/.index-fragments, which are merged into the index once the
+workers are done (see merge_index_fragments), the same way worker manifests are merged.
+"""
+
+INDEX_FILENAME = ".index.sqlite" # Hidden so readers don't take it for a document
+FRAGMENT_DIR = ".index-fragments"
+
+def classify(name : str) -> Optional[Tuple[int, str, Optional[int]]]:
+    """
+    Page number, kind and figure/table number of a documents file from its name. None for anything that isn't
+    part of a page (i.e. the manifest or temporary files).
+    """
+    if not name[:8].isdigit() or name.endswith(".tmp"):
+        return None
+    page, suffix = int(name[:8]), name[8:]
+    if suffix == ".txt":
+        return (page, "text", None)
+    if suffix == "-media.json":
+        return (page, "media", None)
+    for kind in ("figure", "table"):
+        if suffix.startswith(f"-{kind}") and suffix.endswith(".png"):
+            num = suffix[len(kind) + 1:-4]
+            return (page, kind, int(num) if num.isdigit() else None)
+    return None
+
+class DatasetIndex:
+    """
+    Writes the index of a dataset, or the index fragment of a single worker. Safe to share between threads, but only
+    one process should write to a file at a time (see the top of this file).
+
+    :param ds_path: Folder of the dataset, the index is stored inside of it
+    :param worker: Write the fragment of this worker instead of the index itself
+    """
+    def __init__(self, ds_path : str, worker : str = None):
+        self.ds_path = ds_path
+        if worker is None:
+            self.path = os.path.join(ds_path, INDEX_FILENAME)
+        else:
+            self.path = os.path.join(ds_path, FRAGMENT_DIR, f"{worker}.sqlite")
+        os.makedirs(os.path.dirname(self.path), exist_ok = True)
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(self.path, check_same_thread = False, timeout = 60)
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS files ("
+            "doc TEXT NOT NULL, name TEXT NOT NULL, page INTEGER NOT NULL, kind TEXT NOT NULL, num INTEGER, "
+            "shard TEXT, member TEXT, offset INTEGER, size INTEGER NOT NULL, PRIMARY KEY (doc, name))"
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS files_kind ON files (kind)")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS docs ("
+            "doc TEXT PRIMARY KEY, n_pages INTEGER NOT NULL, n_figures INTEGER NOT NULL, n_tables INTEGER NOT NULL)"
+        )
+        self.conn.commit()
+
+    def add_files(self, rows : Iterable[tuple], replace_docs : Iterable[str] = ()):
+        """
+        Add rows of (doc, name, shard, member, offset, size) to the index and update the counts of their documents
+
+        :param replace_docs: Documents whose existing rows are dropped first
+        """
+        entries = []
+        for doc, name, shard, member, offset, size in rows:
+            info = classify(name)
+            if info is not None:
+                entries.append((doc, name, *info, shard, member, offset, size))
+        docs = set(replace_docs) | {entry[0] for entry in entries}
+
+        with self.lock:
+            self.conn.executemany("DELETE FROM files WHERE doc = ?", [(doc,) for doc in replace_docs])
+            self.conn.executemany("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", entries)
+            self.conn.executemany("DELETE FROM docs WHERE doc = ?", [(doc,) for doc in docs])
+            self.conn.executemany(
+                "INSERT INTO docs SELECT doc, SUM(kind = 'text'), SUM(kind = 'figure'), SUM(kind = 'table') "
+                "FROM files WHERE doc = ? GROUP BY doc",
+                [(doc,) for doc in docs]
+            )
+            self.conn.commit()
+
+    def add_folder(self, doc_id : str, doc_path : str = None):
+        """
+        Index (or re-index) a document saved as a folder
+        """
+        doc_path = doc_path or os.path.join(self.ds_path, doc_id)
+        rows = [(doc_id, entry.name, None, None, None, entry.stat().st_size) for entry in os.scandir(doc_path) if entry.is_file()]
+        self.add_files(rows, replace_docs = [doc_id])
+
+    def add_shard(self, shard_path : str):
+        """
+        Index every member of a closed tar shard. Shards are referred to by name relative to the dataset folder.
+        """
+        rows = []
+        with tarfile.open(shard_path, "r") as tar:
+            for member in tar.getmembers():
+                if member.isfile():
+                    doc_id, name = member_filename(member.name)
+                    rows.append((doc_id, name, os.path.basename(shard_path), member.name, member.offset_data, member.size))
+        self.add_files(rows)
+
+    def rebuild(self):
+        """
+        Drop the index and recreate it from what is in the dataset folder
+        """
+        with self.lock:
+            self.conn.execute("DELETE FROM files")
+            self.conn.execute("DELETE FROM docs")
+            self.conn.commit()
+        for entry in sorted(os.scandir(self.ds_path), key = lambda entry : entry.name):
+            if entry.name.startswith("."):
+                continue
+            if entry.is_dir():
+                self.add_folder(entry.name, entry.path)
+            elif entry.name.endswith(".tar"):
+                self.add_shard(entry.path)
+
+    def merge(self, fragment_path : str):
+        """
+        Add every document of an index fragment, replacing any rows this index already had for those documents
+        """
+        with self.lock:
+            self.conn.execute("ATTACH DATABASE ? AS fragment", (fragment_path,))
+            try:
+                self.conn.execute("DELETE FROM files WHERE doc IN (SELECT doc FROM fragment.docs)")
+                self.conn.execute("DELETE FROM docs WHERE doc IN (SELECT doc FROM fragment.docs)")
+                self.conn.execute("INSERT INTO files SELECT * FROM fragment.files WHERE doc IN (SELECT doc FROM fragment.docs)")
+                self.conn.execute("INSERT INTO docs SELECT * FROM fragment.docs")
+                self.conn.commit()
+            finally:
+                self.conn.execute("DETACH DATABASE fragment")
+
+    def stats(self) -> dict:
+        n_docs, n_pages, n_figures, n_tables = self.conn.execute(
+            "SELECT COUNT(*), COALESCE(SUM(n_pages), 0), COALESCE(SUM(n_figures), 0), COALESCE(SUM(n_tables), 0) FROM docs"
+        ).fetchone()
+        return {"docs" : n_docs, "pages" : n_pages, "figures" : n_figures, "tables" : n_tables}
+
+    def close(self):
+        self.conn.close()
+
+def merge_index_fragments(ds_path : str) -> dict:
+    """
+    Merge the index fragments of every worker into the index of the dataset. Fragments are merged oldest first, so
+    if a document was finished more than once (i.e. after a stale claim was taken over) the latest one is kept.
+    Fragments stay in place, merging again later picks up whatever the workers added since. Returns the stats of the index.
+    """
+    fragment_dir = os.path.join(ds_path, FRAGMENT_DIR)
+    fragments = []
+    if os.path.isdir(fragment_dir):
+        fragments = [entry.path for entry in os.scandir(fragment_dir) if entry.name.endswith(".sqlite")]
+    index = DatasetIndex(ds_path)
+    try:
+        for fragment_path in sorted(fragments, key = os.path.getmtime):
+            index.merge(fragment_path)
+        return index.stats()
+    finally:
+        index.close()
@@ -0,0 +1,231 @@
+from typing import Callable, List, Tuple
+import threading
+import tarfile
+import json
+import time
+import io
+import os
+
+from mm_pdf.utils.data_utils import PDFObject, PDFPage, PageSink, DocumentManifest, split_captions, atomic_write
+
+"""
+Packed output format: instead of a folder per document with a file per page and per figure, pages are appended
+to WebDataset style tar shards of roughly fixed size. Every page is one sample made of these members:
+    [doc]/[page_id].json            - metadata: document, page number, the figure identifiers on the page, whether it was truncated and its route
+    [doc]/[page_id].txt             - text of the page
+    [doc]/[page_id].[identifier].png - each figure or table on the page
+    [doc]/[page_id].media.json      - captions of the page, only when they are detached at write time
+Shards are named [prefix]-[n].tar and are only renamed into place once closed, so readers never see partial shards.
+Before a shard is renamed, the pages it commits (and its index rows) are written next to it as [shard].pending, which
+is removed once they are committed. A writer that died in between has them committed by the next ShardWriter with the
+same prefix, rather than the pages being written again into another shard.
+"""
+
+SHARD_PATTERN = "{prefix}-{index:06d}.tar"
+PENDING_SUFFIX = ".pending"
+
+def member_filename(member_name : str) -> Tuple[str, str]:
+    """
+    Split the name of a shard member into its document id and the name the file would have in a documents folder,
+    i.e. doc/00000003.figure2.png -> (doc, 00000003-figure2.png)
+    """
+    doc_id, name = member_name.split("/", 1)
+    if name.count(".") > 1:
+        name = name[:8] + name[8:].replace(".", "-", 1)
+    return doc_id, name
+
+def is_packed_dataset(ds_path : str) -> bool:
+    """
+    Whether a dataset folder holds tar shards rather than a folder per document
+    """
+    return os.path.isdir(ds_path) and any(fname.endswith(".tar") for fname in os.listdir(ds_path))
+
+class ShardWriter:
+    """
+    Appends pages to tar shards, starting a new shard whenever the current one grows past shard_size.
+    Pages are only committed to their documents manifest once the shard holding them has been closed.
+    Safe to use from several threads. Commits of shards left pending by an earlier writer are finished on creation.
+
+    :param path: Folder to write shards into
+    :param shard_size: Target size of each shard in bytes
+    :param prefix: Prefix of shard names. Must be unique per worker when several workers write to the same folder.
+    :param index: DatasetIndex that every shard is added to once closed
+    """
+    def __init__(self, path : str, shard_size : int = 2**30, prefix : str = "shard", index = None):
+        self.path = path
+        self.shard_size = shard_size
+        self.prefix = prefix
+        self.index = index
+        os.makedirs(path, exist_ok = True)
+
+        self.lock = threading.Lock()
+        self.shard_number = 0
+        self.tar = None
+        self.tmp_path = None
+        self.pending = [] # (manifest, page_idx, truncated, route) for pages in the open shard
+        self.rows = [] # DatasetIndex rows of the members of the open shard
+        self.recover()
+
+    def recover(self):
+        """
+        Commit the pages of shards that were renamed into place by an earlier writer that died before committing them.
+        Pending commits of shards that never got renamed are dropped, their pages weren't committed and get written again.
+        """
+        for fname in sorted(os.listdir(self.path)):
+            if not (fname.startswith(f"{self.prefix}-") and fname.endswith(PENDING_SUFFIX)):
+                continue
+            pending_path = os.path.join(self.path, fname)
+            if os.path.exists(pending_path[:-len(PENDING_SUFFIX)]):
+                with open(pending_path, "r") as f:
+                    pending = json.load(f)
+                manifests = {}
+                self.commit_shard(pending_path, [tuple(row) for row in pending["rows"]], [
+                    (manifests.setdefault(path, DocumentManifest(path)), page_idx, truncated, route)
+                    for path, page_idx, truncated, route in pending["pages"]
+                ])
+            else:
+                os.remove(pending_path)
+
+    def open_next(self):
+        # Never overwrite shards from an earlier run
+        while os.path.exists(os.path.join(self.path, SHARD_PATTERN.format(prefix = self.prefix, index = self.shard_number))):
+            self.shard_number += 1
+        self.tmp_path = os.path.join(self.path, SHARD_PATTERN.format(prefix = self.prefix, index = self.shard_number) + ".tmp")
+        self.tar = tarfile.open(self.tmp_path, "w")
+
+    def add_member(self, name : str, data : bytes):
+        info = tarfile.TarInfo(name)
+        info.size = len(data)
+        info.mtime = int(time.time())
+        self.tar.addfile(info, io.BytesIO(data))
+        if self.index is not None:
+            # The data ends the archive so far, padded to a whole number of blocks
+            offset = self.tar.offset - tarfile.BLOCKSIZE * -(-info.size // tarfile.BLOCKSIZE)
+            doc_id, fname = member_filename(name)
+            self.rows.append((doc_id, fname, os.path.basename(self.tmp_path[:-len(".tmp")]), name, offset, info.size))
+
+    def write_page(self, page : PDFPage, doc_id : str, page_idx : int, manifest : DocumentManifest = None,
+                   detach_captions : bool = False) -> List[DocumentManifest]:
+        """
+        Write a page as a sample. Images are encoded before taking the lock so several threads can encode at once.
+        Returns the manifests that had pages committed by a shard being closed during this call.
+
+        :param doc_id: Identifier of the document the page belongs to
+        :param page_idx: Index of the page in the full document
+        :param manifest: Manifest to commit the page to once it is in a closed shard
+        :param detach_captions: Move captions from the text into a media.json member (see PDFObject.save)
+        """
+        key = f"{doc_id}/{str(page_idx).zfill(8)}"
+        members = [(f"{key}.json", json.dumps({
+            "doc" : doc_id,
+            "page" : page_idx,
+            "image_identifiers" : list(page.image_identifiers),
+            "truncated" : page.truncated,
+            "route" : page.route
+        }).encode())]
+        text = page.text
+        if detach_captions:
+            text, media = split_captions(text)
+            members.append((f"{key}.media.json", json.dumps(media).encode()))
+        members.append((f"{key}.txt", text.encode(errors = "ignore")))
+        for (id, img) in zip(page.image_identifiers, page.images):
+            img_bytes = io.BytesIO()
+            img.save(img_bytes, format = "PNG")
+            members.append((f"{key}.{id}.png", img_bytes.getvalue()))
+
+        with self.lock:
+            if self.tar is None:
+                self.open_next()
+            for name, data in members:
+                self.add_member(name, data)
+            if manifest is not None:
+                self.pending.append((manifest, page_idx, page.truncated, page.route))
+            if self.tar.fileobj.tell() < self.shard_size:
+                return []
+            closed = self.close_shard()
+        return self.commit_shard(*closed)
+
+    def write_document(self, pdf_obj : PDFObject, doc_id : str, start_page : int = None, manifest : DocumentManifest = None,
+                       detach_captions : bool = False) -> List[DocumentManifest]:
+        """
+        Write every page of pdf_obj, see write_page. Returns the manifests that had pages committed during this call.
+
+        :param start_page: Index in the full document of the first page in pdf_obj, its first_page if None
+        """
+        if start_page is None:
+            start_page = pdf_obj.first_page
+        committed = []
+        for i, page in enumerate(pdf_obj.pages):
+            for committed_manifest in self.write_page(page, doc_id, start_page + i, manifest, detach_captions):
+                if committed_manifest not in committed:
+                    committed.append(committed_manifest)
+        return committed
+
+    def close_shard(self) -> Tuple[str, list, list]:
+        """
+        Close the open shard and move it into place. Must be called with the lock held.
+        Returns the path of its pending commit, its index rows and its pending pages, to pass to commit_shard once the
+        lock is released.
+        """
+        self.tar.close()
+        shard_path = self.tmp_path[:-len(".tmp")]
+        pending_path = shard_path + PENDING_SUFFIX
+        atomic_write(pending_path, json.dumps({
+            "rows" : self.rows,
+            "pages" : [(manifest.path, page_idx, truncated, route) for manifest, page_idx, truncated, route in self.pending]
+        }).encode())
+        os.replace(self.tmp_path, shard_path)
+        self.tar = None
+        closed = (pending_path, self.rows, self.pending)
+        self.rows, self.pending = [], []
+        return closed
+
+    def commit_shard(self, pending_path : str, rows : list, pending : list) -> List[DocumentManifest]:
+        """
+        Add a closed shard to the index and commit its pages. Returns the manifests that had pages committed.
+        """
+        if self.index is not None:
+            self.index.add_files(rows)
+        committed = []
+        for manifest, page_idx, truncated, route in pending:
+            manifest.commit_page(page_idx, truncated, route)
+            if manifest not in committed:
+                committed.append(manifest)
+        os.remove(pending_path)
+        return committed
+
+    def flush(self) -> List[DocumentManifest]:
+        """
+        Close the open shard, if there is one. Returns the manifests that had pages committed.
+        """
+        with self.lock:
+            if self.tar is None:
+                return []
+            closed = self.close_shard()
+        return self.commit_shard(*closed)
+
+class ShardSink(PageSink):
+    """
+    Writes every page of a document to a ShardWriter as soon as it is added, see PageSink
+
+    :param shard_writer: Writer shared by every document
+    :param doc_id: Identifier of the document
+    :param manifest: Manifest to commit pages to once they are in a closed shard
+    :param detach_captions: Move captions from the text into a media.json member (see PDFObject.save)
+    :param on_commit: Called with every manifest that had pages committed by a shard closing while a page of this
+        document was written, which can be the manifest of any document in the shard
+    """
+    def __init__(self, shard_writer : ShardWriter, doc_id : str, manifest : DocumentManifest = None, detach_captions : bool = False,
+                 on_commit : Callable[[DocumentManifest], None] = None, first_page : int = 0):
+        super().__init__(first_page)
+        self.shard_writer = shard_writer
+        self.doc_id = doc_id
+        self.manifest = manifest
+        self.detach_captions = detach_captions
+        self.on_commit = on_commit
+
+    def write_page(self, page_idx : int, page : PDFPage):
+        committed = self.shard_writer.write_page(page, self.doc_id, page_idx, self.manifest, self.detach_captions)
+        if self.on_commit is not None:
+            for manifest in committed:
+                self.on_commit(manifest)
@@ -0,0 +1,103 @@
+from PIL import Image
+from typing import List, Optional, Tuple
+import numpy as np
+import threading
+
+from mm_pdf.utils.routing_utils import ROUTE_BLANK, ROUTE_FIGURE_ONLY
+
+"""
+Cheap classification of rendered pages that don't need Nougat at all: separator pages, blank versos and full page
+figures or plates. Nougat returns nothing useful for them (empty output, or text it made up) and only spends its
+token budget getting there.
+Pages are classified from where their ink is:
+- Blank: almost no ink at all
+- Figure only: no lines of text outside of the regions PDFFigures2 found figures and their captions in, or without
+    any such regions, nearly all of the ink is in blocks too tall to be lines of text
+Lines of text are found from the row profile of the page (the amount of ink in every row of pixels): text is a run of
+inked rows about a line high, separated from the next by a gap.
+"""
+
+def ink_mask(img : Image.Image, threshold : int = 128) -> np.ndarray:
+    return np.asarray(img.convert("L")) < threshold
+
+def row_bands(mask : np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Start and end rows of every run of rows that have ink in them
+    """
+    inked = np.concatenate([[False], mask.any(axis = 1), [False]])
+    edges = np.flatnonzero(inked[1:] != inked[:-1])
+    return edges[::2], edges[1::2]
+
+class PageClassifier:
+    """
+    Finds pages that can skip Nougat, see the top of this file. Keeps a count of the pages of each kind.
+
+    :param blank_ink: Largest fraction of a page covered in ink for it to be blank
+    :param max_text_lines: Most lines of text a figure page can have outside of its figures (running headers and page numbers)
+    :param line_height: Range of heights of a line of text, as a fraction of the page height
+    :param min_figure_ink: Smallest fraction of the ink of a page that has to be in tall blocks for it to be a figure
+        page, when there are no figure regions for the page
+    :param margin: Figure regions are grown by this many PDF points, as PDFFigures2 draws them tightly around the figure
+    """
+    def __init__(self, blank_ink : float = 0.0005, max_text_lines : int = 2, line_height : Tuple[float, float] = (0.003, 0.03),
+                 min_figure_ink : float = 0.95, margin : float = 4):
+        self.blank_ink = blank_ink
+        self.max_text_lines = max_text_lines
+        self.line_height = line_height
+        self.min_figure_ink = min_figure_ink
+        self.margin = margin
+
+        self.lock = threading.Lock()
+        self.counts = {}
+
+    def bands(self, heights : np.ndarray, height : int) -> Tuple[np.ndarray, int]:
+        """
+        Which row bands are too tall to be a line of text, and how many are lines of text
+
+        :param heights: Heights of the row bands in pixels
+        :param height: Height of the page in pixels
+        """
+        tall = heights > self.line_height[1] * height
+        return tall, np.count_nonzero(~tall & (heights >= self.line_height[0] * height))
+
+    def classify(self, img : Image.Image, regions : List[Tuple[float, float, float, float]] = ()) -> Optional[str]:
+        """
+        ROUTE_BLANK or ROUTE_FIGURE_ONLY if the page doesn't need to be read, None if it does
+
+        :param regions: Boxes (x1, y1, x2, y2) in PDF points of the figures on the page and their captions
+        """
+        mask = ink_mask(img)
+        if mask.mean() <= self.blank_ink:
+            return ROUTE_BLANK
+
+        height = mask.shape[0]
+        if regions:
+            scale = img.info.get("scale", 96 / 72)
+            outside = mask.copy()
+            for x1, y1, x2, y2 in regions:
+                top, left = max(0, int((y1 - self.margin) * scale)), max(0, int((x1 - self.margin) * scale))
+                outside[top:int(np.ceil((y2 + self.margin) * scale)), left:int(np.ceil((x2 + self.margin) * scale))] = False
+            starts, ends = row_bands(outside)
+            tall, n_lines = self.bands(ends - starts, height)
+            # Anything left outside of the figures should be a few lines of text or specks and rules. A block too tall
+            # to be a line is text whose lines ran together next to the figure (or a figure PDFFigures2 missed).
+            return ROUTE_FIGURE_ONLY if not tall.any() and n_lines <= self.max_text_lines else None
+
+        starts, ends = row_bands(mask)
+        tall, n_lines = self.bands(ends - starts, height)
+        if n_lines > self.max_text_lines:
+            return None
+        row_ink = mask.sum(axis = 1)
+        tall_ink = sum(row_ink[start:end].sum() for start, end in zip(starts[tall], ends[tall]))
+        return ROUTE_FIGURE_ONLY if tall_ink >= self.min_figure_ink * row_ink.sum() else None
+
+    def __call__(self, img : Image.Image, regions : List[Tuple[float, float, float, float]] = ()) -> Optional[str]:
+        route = self.classify(img, regions)
+        with self.lock:
+            key = "read" if route is None else route
+            self.counts[key] = self.counts.get(key, 0) + 1
+        return route
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {"pages" : sum(self.counts.values()), "routes" : dict(sorted(self.counts.items()))}
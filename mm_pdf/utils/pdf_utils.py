@@ -1,4 +1,4 @@
-from ironpdf import PdfDocument
+import pypdfium2 as pdfium
 from PyPDF2 import PdfReader, PdfWriter
 import os
 from PIL import Image
@@ -6,6 +6,19 @@ import requests
 import subprocess
 import shutil
 import numpy as np
+import glob
+import hashlib
+import tempfile
+import json
+import time
+import threading
+from typing import Iterable, Iterator, List, Optional, Tuple
+
+from mm_pdf.utils.downloading_utils import url_to_filename
+from mm_pdf.utils.figure_utils import FigureRegistry
+from mm_pdf.utils.trace_utils import Tracer, NULL_TRACER
+
+pdfium_lock = threading.Lock() # For threads sharing a process with other threads that use pdfium, which is not thread safe
 
 def create_tmp_path(path):
     """
@@ -23,89 +36,306 @@ def img_tmp_copy(img):
     """
     return Image.fromarray(np.asarray(img))
 
-def load_pdf(pdf_path_or_url : str, tmp_path = "./tmp_pdf_images"):
-    create_tmp_path(tmp_path)
+def iter_pdf_pages(pdf_path_or_url, first_page : int = 0, last_page : int = None, dpi : int = 96) -> Iterator[Image.Image]:
+    """
+    Rasterize a PDF one page at a time, yielding each page as an RGB PIL image.
+    Pages are rendered straight into memory, so nothing is written to disk and only the page
+    currently being consumed needs to be held by the caller.
+    The text layer of each page is kept in img.info["text"], its number of characters in img.info["n_chars"] and
+    the number of pixels per PDF point in img.info["scale"]. img.info["render_seconds"] is how long the page took.
+    img.info["doc"] is the path or URL of the PDF (None for bytes) and img.info["page"] the index of the page in it.
+    pdfium is only called with pdfium_lock held, which is released while a page is being consumed.
 
-    if not os.path.isfile(pdf_path_or_url):
+    :param pdf_path_or_url: Path to a PDF file, URL of a PDF or the raw bytes of one
+    :param first_page: Index of the first page to render (0-indexed)
+    :param last_page: Index one past the last page to render. Renders until the end of the document if None.
+    :param dpi: Resolution to render pages at
+    """
+    doc = pdf_path_or_url if isinstance(pdf_path_or_url, str) else None
+    if isinstance(pdf_path_or_url, str) and not os.path.isfile(pdf_path_or_url):
         # Download the pdf file from the given URL
-        response = requests.get(pdf_path_or_url)
-        pdf_path = os.path.join(tmp_path, "downloaded.pdf")
-        with open(pdf_path, 'wb') as f:
-            f.write(response.content)
-    else:
-        pdf_path = pdf_path_or_url
-
-    pdf = PdfDocument.FromFile(pdf_path)
-    pdf.RasterizeToImageFiles(f"{tmp_path}/*.png",DPI=96)
+        pdf_path_or_url = requests.get(pdf_path_or_url).content
 
-    # Get every file ending with .png then sort by number (otherwise it'd be 1, 10, ... instead of 1, 2, ...)
-    img_paths = os.listdir(tmp_path)
-    img_paths = [path for path in img_paths if path.endswith(".png")]
-    img_paths.sort(key=lambda x: int(x.split('.')[0]))
-    img_paths = [os.path.join(tmp_path, path) for path in img_paths]
+    with pdfium_lock:
+        pdf = pdfium.PdfDocument(pdf_path_or_url)
+        n_pages = len(pdf)
+    try:
+        if last_page is None or last_page > n_pages:
+            last_page = n_pages
 
-    imgs = [Image.open(path).convert("RGB") for path in img_paths]
-    for img in imgs:
-        img.load()
+        for i in range(first_page, last_page):
+            start = time.perf_counter()
+            with pdfium_lock:
+                page = pdf[i]
+                bitmap = page.render(scale = dpi / 72)
+                # convert copies the pixels out of pdfium's buffer so the bitmap can be freed
+                img = bitmap.to_pil().convert("RGB")
+                bitmap.close()
+                textpage = page.get_textpage()
+                img.info["text"] = textpage.get_text_range()
+                img.info["n_chars"] = textpage.count_chars()
+                textpage.close()
+                page.close()
+            img.info["scale"] = dpi / 72 # Pixels per PDF point
+            img.info["render_seconds"] = time.perf_counter() - start
+            img.info["doc"] = doc
+            img.info["page"] = i
+            yield img
+    finally:
+        with pdfium_lock:
+            pdf.close()
 
-    shutil.rmtree(tmp_path)
-    return imgs
+def load_pdf(pdf_path_or_url : str, dpi : int = 96, first_page : int = 0, last_page : int = None):
+    """
+    Rasterize the pages of a PDF and return them as a list of RGB PIL images.
+    Prefer iter_pdf_pages when the pages can be consumed one at a time.
+    """
+    return list(iter_pdf_pages(pdf_path_or_url, first_page, last_page, dpi))
 
 # ==== FIGURE EXTRACTION ====
 
 # Uses Allenai PDFfigure2, refer to repository to get that setup
-def load_figures(pdf_path_or_url, tmp_path = "./tmp_pdf_figures"):
+class FigureExtractor:
     """
-    Given a PDF file, extracts all tables and figures and returns a dictionary
-    - The dictionary contains labels for the tables/figures of form "figure1" or "table2" as keys
-    - The values are np arrays (not PIL images, so that we can delete temp files without errors)
+    Long lived wrapper around PDFFigures2 that amortizes its startup cost over many documents.
+    - Running through sbt pays for sbt, the JVM and a compile check on every invocation, which costs many seconds per PDF
+    - Instead we run a prebuilt assembly jar (created with `sbt assembly` in the pdffigures2 folder) directly with java
+    - extract() runs a single batch invocation over any number of PDFs, figures are kept on disk until they are requested
+    - Calling the extractor on a PDF that wasn't extracted in a batch runs a batch of one
+    - With render = False PDFFigures2 only saves where every figure is, and figures are cropped from the pages that
+        are rendered for Nougat anyway (see PendingFigure), instead of PDFFigures2 rendering every figure's page again
+        and the PNGs being written, read back and copied
+
+    :param pdffigures_dir: Path to the pdffigures2 repository
+    :param jar_path: Path to the pdffigures2 assembly jar. If None, it is looked for in pdffigures_dir/target
+    :param use_sbt: Run through sbt instead of the jar. Also used as a fallback when no jar can be found.
+    :param work_dir: Folder for extracted figures. A fresh temporary folder is used if None.
+    :param tracer: Tracer recording how long every PDFFigures2 invocation takes
+    :param render: Have PDFFigures2 render figures. Figures are PendingFigures to crop from the rendered pages if False.
+    :param figure_dpi: Resolution of figures that aren't rendered by PDFFigures2. Figures are cropped from the pages if
+        these were rendered at this resolution or higher, and rendered on their own otherwise. Same as the pages if None.
     """
-    create_tmp_path(tmp_path)
+    main_class = "org.allenai.pdffigures2.FigureExtractorBatchCli"
+
+    def __init__(self, pdffigures_dir = "./pdffigures2", jar_path = None, use_sbt = False, work_dir = None, tracer : Tracer = None,
+                 render : bool = True, figure_dpi : Optional[int] = None):
+        self.pdffigures_dir = os.path.abspath(pdffigures_dir)
+
+        if jar_path is None and not use_sbt:
+            jars = glob.glob(os.path.join(self.pdffigures_dir, "target", "scala-*", "*assembly*.jar"))
+            if jars:
+                jar_path = jars[0]
+            else:
+                print(f"No pdffigures2 assembly jar found in {self.pdffigures_dir}, falling back to sbt. Run `sbt assembly` there to speed up figure extraction.")
+        self.jar_path = jar_path
+        self.use_sbt = use_sbt or jar_path is None
+
+        self.work_dir = os.path.abspath(work_dir) if work_dir is not None else tempfile.mkdtemp(prefix = "pdffigures_")
+        self.figure_dir = os.path.join(self.work_dir, "figures")
+        os.makedirs(self.figure_dir, exist_ok = True)
+
+        self.extracted = set() # Document names whose figures are waiting in figure_dir
+        self.tracer = tracer if tracer is not None else NULL_TRACER
+        self.render = render
+        self.figure_dpi = figure_dpi
+
+    @staticmethod
+    def doc_name(pdf_path : str) -> str:
+        """
+        Name used for a PDF inside of a batch. PDFFigures2 names its outputs [doc]-[Figure|Table][label]-[n].png,
+        so this needs to be unique and free of dashes.
+        """
+        return hashlib.sha1(os.path.abspath(pdf_path).encode()).hexdigest()[:16]
+
+    def run_batch(self, input_dir : str):
+        """
+        Run PDFFigures2 once over every PDF in input_dir
+        """
+        # -d also saves [doc].json describing every figure, which is where the page each figure is on comes from
+        args = [input_dir + "/", "-d", self.figure_dir + "/"]
+        if self.render:
+            args += ["-m", self.figure_dir + "/"]
+        with self.tracer.span("pdffigures2", documents = len(os.listdir(input_dir)), sbt = self.use_sbt):
+            if self.use_sbt:
+                sbt_command = f"sbt \"runMain {self.main_class} {' '.join(args)}\""
+                subprocess.run(sbt_command, shell = True, universal_newlines = True, cwd = self.pdffigures_dir)
+            else:
+                subprocess.run(["java", "-cp", self.jar_path, self.main_class] + args, universal_newlines = True)
+
+    def extract(self, pdf_paths : Iterable[str]):
+        """
+        Extract figures for all given PDFs with one PDFFigures2 invocation
+        """
+        input_dir = tempfile.mkdtemp(dir = self.work_dir)
+        names = []
+        for pdf_path in pdf_paths:
+            name = self.doc_name(pdf_path)
+            if name in self.extracted or name in names: # Done already or listed twice
+                continue
+            os.symlink(os.path.abspath(pdf_path), os.path.join(input_dir, name + ".pdf"))
+            names.append(name)
+
+        if names:
+            self.run_batch(input_dir)
+            self.extracted.update(names)
+        shutil.rmtree(input_dir)
+
+    def figure_data(self, name : str) -> List[dict]:
+        """
+        The data PDFFigures2 saved about every figure of a document, each as a dictionary with its "label" (the same as
+        its image file would be named by, i.e. figure1 or table2), the (0 indexed) "page" it is on, the "regions" the
+        figure and its caption take up in PDF points (the figure first) and the "file" its image was rendered to
+        (None if it wasn't). The data file is deleted.
+        """
+        data_path = os.path.join(self.figure_dir, name + ".json")
+        if not os.path.isfile(data_path):
+            return []
+        with open(data_path, "r") as f:
+            figures = json.load(f)
+        os.remove(data_path)
+
+        return [{
+            "label" : (figure["figType"] + figure["name"]).lower(),
+            "page" : figure["page"],
+            "regions" : [
+                (box["x1"], box["y1"], box["x2"], box["y2"])
+                for box in (figure.get("regionBoundary"), figure.get("captionBoundary")) if box is not None
+            ],
+            "file" : os.path.basename(figure["renderURL"]) if "renderURL" in figure else None
+        } for figure in figures]
+
+    def pending_figures(self, name : str, pdf_path : str) -> FigureRegistry:
+        """
+        Registry of the figures PDFFigures2 found in a document without rendering them. The data file is deleted.
+        """
+        registry = FigureRegistry()
+        for figure in self.figure_data(name):
+            box = figure["regions"][0]
+            registry.add(figure["label"], PendingFigure(pdf_path, figure["page"], box, self.figure_dpi), figure["page"], figure["regions"])
+        return registry
+
+    def __call__(self, pdf_path : str) -> FigureRegistry:
+        """
+        Returns the figures of a PDF, extracting it first if it wasn't part of a batch.
+        See load_figures for the format.
+        """
+        name = self.doc_name(pdf_path)
+        if name not in self.extracted:
+            self.extract([pdf_path])
+        self.extracted.discard(name)
+
+        if not self.render:
+            return self.pending_figures(name, pdf_path)
+        data = {figure["file"] : (figure["page"], figure["regions"]) for figure in self.figure_data(name) if figure["file"] is not None}
+        registry = FigureRegistry()
+
+        for file in sorted(os.listdir(self.figure_dir)): # Sorted so figures are always added in the same order
+            # Check if the file is a png image from this document
+            if file.startswith(name + "-") and file.endswith(".png"):
+                # Extract the figure/table name from the file name
+                fig_table_name = file.split('-')[1]
+                # Open the image file
+                img = Image.open(os.path.join(self.figure_dir, file))
+                # Add the image to the registry, along with its page and where it is on the page if known
+                page, regions = data.get(file, (None, []))
+                registry.add(fig_table_name.lower(), img_tmp_copy(img), page, regions)
+                img.close()
+                os.remove(os.path.join(self.figure_dir, file))
+
+        return registry
+
+    def close(self):
+        """
+        Delete the working folder and any figures that were never requested
+        """
+        shutil.rmtree(self.work_dir, ignore_errors = True)
+
+class PendingFigure:
+    """
+    A figure PDFFigures2 found without rendering it, to be cropped from its page once that is rendered (see crop_figures)
+
+    :param pdf_path: PDF the figure is in, to render it from if it's needed before its page is rendered
+    :param page: Page of pdf_path the figure is on (0 indexed)
+    :param box: Box (x1, y1, x2, y2) the figure takes up on the page, in PDF points from the top left corner
+    :param dpi: Resolution to render the figure at. Cropped from the page if the page has at least this resolution.
+    """
+    def __init__(self, pdf_path : str, page : int, box : Tuple[float, float, float, float], dpi : Optional[int] = None):
+        self.pdf_path = pdf_path
+        self.page = page
+        self.box = box
+        self.dpi = dpi
+
+    def crop(self, page_img : Image.Image) -> Image.Image:
+        """
+        Cut the figure out of the image of its page. Only the figure's pixels are copied.
+        """
+        scale = page_img.info.get("scale", 96 / 72)
+        if self.dpi is not None and self.dpi > scale * 72:
+            return self.render()
+        x1, y1, x2, y2 = self.box
+        left, top = max(0, int(x1 * scale)), max(0, int(y1 * scale))
+        right, bottom = min(page_img.width, int(round(x2 * scale))), min(page_img.height, int(round(y2 * scale)))
+        return page_img.crop((left, top, max(right, left + 1), max(bottom, top + 1)))
+
+    def render(self) -> Image.Image:
+        """
+        Render only the figure's part of its page, at dpi (or 96 DPI like the pages if None)
+        """
+        with pdfium_lock:
+            pdf = pdfium.PdfDocument(self.pdf_path)
+            try:
+                page = pdf[self.page]
+                width, height = page.get_size()
+                x1, y1, x2, y2 = self.box
+                # pdfium crops by the amount to cut off of the left, bottom, right and top of the page
+                bitmap = page.render(scale = (self.dpi or 96) / 72, crop = (x1, height - y2, width - x2, y1))
+                img = bitmap.to_pil().convert("RGB")
+                bitmap.close()
+                page.close()
+            finally:
+                pdf.close()
+        return img
+
+def crop_figures(registry : FigureRegistry, page : int, page_img : Image.Image):
+    """
+    Crop every figure on a page that is still a PendingFigure from the image of the page
+    """
+    for entry in registry.on_page(page):
+        if isinstance(entry.image, PendingFigure):
+            entry.image = entry.image.crop(page_img)
+
+def render_pending(images : List) -> List:
+    """
+    Render any figure that was matched before its page was rendered, so wasn't cropped yet
+    """
+    return [image.render() if isinstance(image, PendingFigure) else image for image in images]
+
+def load_figures(pdf_path_or_url, extractor : FigureExtractor = None):
+    """
+    Given a PDF file, extracts all tables and figures and returns them as a FigureRegistry
+    - Figures are labelled in the form "figure1" or "table2", along with the page they were found on
+    - The images are PIL images copied out of the extracted files, so that temp files can be deleted without errors
+
+    :param extractor: FigureExtractor to reuse. If None, a new one is created for this call only.
+    """
+    owns_extractor = extractor is None
+    if owns_extractor:
+        extractor = FigureExtractor()
 
     if not os.path.isfile(pdf_path_or_url):
         # Download the pdf file from the given URL
         response = requests.get(pdf_path_or_url)
-        pdf_path = os.path.join(tmp_path, "downloaded.pdf")
+        pdf_path = os.path.join(extractor.work_dir, url_to_filename(pdf_path_or_url))
         with open(pdf_path, 'wb') as f:
             f.write(response.content)
     else:
         pdf_path = pdf_path_or_url
 
-    tmp_pdf_path = "./tmp_pdf"
-    create_tmp_path(tmp_pdf_path)
-    shutil.copy(pdf_path, tmp_pdf_path)
-
-    pdf_path = f"../{tmp_pdf_path}/"
-    out_path = f"../{tmp_path}/"
-    wd = "./pdffigures2"
-
-    sbt_command = f"sbt \"runMain org.allenai.pdffigures2.FigureExtractorBatchCli {pdf_path} -m {out_path}\""
-    process = subprocess.Popen(sbt_command,
-                                      shell=True,
-                                      universal_newlines=True,
-                                      cwd=wd)
-    stdout, stderr = process.communicate()
-
-    # Delete tmp_pdf folder and its contents
-    shutil.rmtree(tmp_pdf_path)
-
-    # Create a dictionary to store the images
-    images_dict = {}
-
-    # Iterate over the files in the tmp_path
-    for file in os.listdir(tmp_path):
-        # Check if the file is a png image
-        if file.endswith(".png"):
-            # Extract the figure/table name from the file name
-            fig_table_name = file.split('-')[1]
-            # Open the image file
-            img = Image.open(os.path.join(tmp_path, file))
-            # Add the image to the dictionary
-            images_dict[fig_table_name.lower()] = img_tmp_copy(img)
-            img.close()
-
-    shutil.rmtree(tmp_path)
-    return images_dict
+    figures = extractor(pdf_path)
+
+    if owns_extractor:
+        extractor.close()
+    return figures
 
 def get_pdf_page_length(path : str):
     """
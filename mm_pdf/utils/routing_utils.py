@@ -0,0 +1,150 @@
+from typing import List, Optional, Tuple
+import threading
+import unicodedata
+import re
+
+"""
+Routing of pages between Nougat and the text layer of the PDF.
+Most PDFs are born-digital and many of their pages are plain prose, whose text layer is already everything Nougat
+would read from them at a tiny fraction of the cost. TextLayerRouter scores the text layer of a page with cheap
+heuristics and only lets it through when nothing on the page needs Nougat:
+- Math: any math symbol, Greek letter or mathematical alphanumeric (Nougat writes these as LaTeX)
+- Tables and display content: lines that are mostly numbers, or many very short lines (table cells, equations and
+    text inside figures all come out of the text layer as short lines)
+- Broken text: replacement or private use characters, control characters and too few letters all come from fonts
+    without a usable character map, and unusual word lengths from text layers with missing or extra spaces
+- Too little text, which covers scanned pages (no text layer) and pages that are mostly figures
+Every other page goes to Nougat.
+"""
+
+ROUTE_NOUGAT = "nougat"
+ROUTE_TEXT_LAYER = "text_layer"
+ROUTE_BLANK = "blank" # See page_classifier
+ROUTE_FIGURE_ONLY = "figure_only"
+
+# Math symbols that are also common in prose
+PROSE_SYMBOLS = set("+<>|~")
+
+def is_math_char(c : str) -> bool:
+    code = ord(c)
+    if 0x0370 <= code <= 0x03FF: # Greek
+        return True
+    if 0x1D400 <= code <= 0x1D7FF or 0x2100 <= code <= 0x214F: # Mathematical alphanumerics and letterlike symbols (i.e. ℝ)
+        return True
+    if 0x2070 <= code <= 0x209F: # Superscripts and subscripts
+        return True
+    return unicodedata.category(c) == "Sm" and c not in PROSE_SYMBOLS
+
+def is_bad_char(c : str) -> bool:
+    """
+    Characters that only show up in text layers that didn't decode properly
+    """
+    if c in "\r\n\t":
+        return False
+    return c == "\ufffd" or unicodedata.category(c) in ("Co", "Cc", "Cs")
+
+def is_numeric_line(line : str) -> bool:
+    tokens = line.split()
+    if len(tokens) < 3:
+        return False
+    numeric = sum(bool(re.fullmatch(r"[-+(]?[\d.,%]+[)%]?", token)) for token in tokens)
+    return numeric / len(tokens) >= 0.5
+
+def text_lines(text : str) -> List[str]:
+    return [line.strip() for line in text.replace("\r\n", "\n").replace("\r", "\n").split("\n") if line.strip()]
+
+def text_layer_to_markdown(text : str) -> str:
+    """
+    Reflow the text layer of a page into paragraphs, as Nougat writes them:
+    - Lines are joined with spaces, and words hyphenated across lines are put back together
+    - A line noticeably shorter than the lines around it ends a paragraph (or is a heading of its own), unless it
+        ends in a hyphen
+    - Lines that are only a number (page numbers) are dropped
+    """
+    lines = [line for line in text_lines(text) if not line.isdigit()]
+    if not lines:
+        return ""
+    # Width of a full line, ignoring the short last lines of paragraphs
+    full_width = sorted(len(line) for line in lines)[int(0.9 * (len(lines) - 1))]
+
+    paragraphs = []
+    current = ""
+    for line in lines:
+        if current.endswith("-") and line[:1].islower():
+            current = current[:-1] + line
+        else:
+            current = f"{current} {line}" if current else line
+        if len(line) < 0.75 * full_width and not line.endswith("-"):
+            paragraphs.append(current)
+            current = ""
+    if current:
+        paragraphs.append(current)
+    return "\n\n".join(paragraphs)
+
+class TextLayerRouter:
+    """
+    Decides for every page whether its text layer can be used as is, or whether it has to go through Nougat.
+    Keeps a count of the decisions made and the reasons pages were sent to Nougat.
+
+    :param min_chars: Pages with fewer characters in their text layer go to Nougat
+    :param max_math_chars: Pages with more math characters go to Nougat
+    :param max_numeric_lines: Largest fraction of lines that can be mostly numbers
+    :param max_short_lines: Largest fraction of lines that can be shorter than short_line characters
+    :param short_line: Length under which a line counts as short
+    :param min_alpha: Smallest fraction of the non whitespace characters that have to be letters
+    :param word_length: Range the average length of words has to be in
+    """
+    def __init__(self, min_chars : int = 500, max_math_chars : int = 0, max_numeric_lines : float = 0.05,
+                 max_short_lines : float = 0.25, short_line : int = 20, min_alpha : float = 0.7, word_length : Tuple[float, float] = (3, 10)):
+        self.min_chars = min_chars
+        self.max_math_chars = max_math_chars
+        self.max_numeric_lines = max_numeric_lines
+        self.max_short_lines = max_short_lines
+        self.short_line = short_line
+        self.min_alpha = min_alpha
+        self.word_length = word_length
+
+        self.lock = threading.Lock()
+        self.counts = {}
+
+    def reason(self, text : Optional[str]) -> Optional[str]:
+        """
+        Why a page with text layer text needs Nougat, or None if the text layer can be used
+        """
+        if not text or len(text.strip()) < self.min_chars:
+            return "too_little_text"
+        if sum(map(is_bad_char, text)):
+            return "bad_chars"
+        if sum(map(is_math_char, text)) > self.max_math_chars:
+            return "math"
+
+        lines = text_lines(text)
+        if sum(map(is_numeric_line, lines)) > self.max_numeric_lines * len(lines):
+            return "table"
+        # The last line of the page and of every paragraph can be short, but not many more
+        if sum(len(line) < self.short_line for line in lines) > self.max_short_lines * len(lines):
+            return "short_lines"
+
+        chars = "".join(text.split())
+        if sum(c.isalpha() for c in chars) < self.min_alpha * len(chars):
+            return "too_few_letters"
+        words = text.split()
+        if not self.word_length[0] <= sum(len(word) for word in words) / len(words) <= self.word_length[1]:
+            return "word_length"
+        return None
+
+    def __call__(self, text : Optional[str]) -> Optional[str]:
+        """
+        Markdown from the text layer of a page if it can be used instead of Nougat, otherwise None.
+
+        :param text: Text layer of the page, as set by iter_pdf_pages in img.info["text"]
+        """
+        reason = self.reason(text)
+        with self.lock:
+            key = ROUTE_TEXT_LAYER if reason is None else reason
+            self.counts[key] = self.counts.get(key, 0) + 1
+        return text_layer_to_markdown(text) if reason is None else None
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {"pages" : sum(self.counts.values()), "routes" : dict(sorted(self.counts.items()))}
@@ -0,0 +1,186 @@
+from typing import Iterable
+import threading
+import hashlib
+import socket
+import json
+import time
+import os
+
+"""
+Utilities for splitting the work of writing a dataset between several worker processes, on one machine
+or several machines sharing a filesystem:
+- Static sharding: every document is assigned to one of num_shards shards by a hash of its name
+- Dynamic claiming: workers take documents from a shared queue by atomically creating a lockfile for them
+- Every worker logs the documents it finished to its own manifest, which are merged into one afterwards
+"""
+
+def shard_of(name : str, num_shards : int) -> int:
+    """
+    Deterministically assign a name to a shard. Uses sha1 rather than hash() since the latter is salted per process.
+    """
+    return int(hashlib.sha1(name.encode()).hexdigest()[:16], 16) % num_shards
+
+def in_shard(name : str, num_shards : int, shard_id : int) -> bool:
+    return shard_of(name, num_shards) == shard_id
+
+def worker_name(shard_id : int = 0) -> str:
+    """
+    Name that is unique to this process across machines
+    """
+    return f"shard{shard_id}-{socket.gethostname()}-{os.getpid()}"
+
+class ClaimQueue:
+    """
+    Lets workers on a shared filesystem split documents between themselves without any coordinator.
+    Claiming a document creates [claim_dir]/[name].lock with O_EXCL, which only one worker can succeed at.
+    Claims of a crashed worker are taken over once they are older than stale_after seconds. A worker touches the
+    lockfiles of the documents it is still working on every refresh_every seconds, so long documents aren't taken over.
+
+    :param claim_dir: Folder shared by all workers to hold lockfiles
+    :param worker: Name of this worker, written into its lockfiles
+    :param stale_after: Seconds after which a claim that wasn't touched is assumed to belong to a dead worker
+    :param refresh_every: Seconds between touches of held claims, a quarter of stale_after if None
+    """
+    def __init__(self, claim_dir : str, worker : str, stale_after : float = 6 * 60 * 60, refresh_every : float = None):
+        self.claim_dir = claim_dir
+        self.worker = worker
+        self.stale_after = stale_after
+        self.refresh_every = refresh_every if refresh_every is not None else stale_after / 4
+        os.makedirs(claim_dir, exist_ok = True)
+
+        self.lock = threading.Lock()
+        self.held = set() # Claims this worker is still working on
+        self.stopping = threading.Event()
+        self.refresh_thread = None
+
+    def lock_path(self, name : str) -> str:
+        return os.path.join(self.claim_dir, f"{name}.lock")
+
+    def take_over(self, path : str):
+        """
+        Remove a claim if it is stale. Only one worker can take over any given stale claim.
+        """
+        try:
+            if time.time() - os.path.getmtime(path) <= self.stale_after:
+                return
+            # Renaming is atomic, so of all the workers that saw the claim as stale only one gets it. The others
+            # find it gone, or rename a fresh claim another worker just made, which is checked for below.
+            taken_path = f"{path}.{self.worker}-{threading.get_ident()}.stale"
+            os.rename(path, taken_path)
+        except FileNotFoundError:
+            return
+        if time.time() - os.path.getmtime(taken_path) <= self.stale_after:
+            # Put back the claim that turned out to be fresh, unless yet another worker claimed the document since
+            try:
+                os.link(taken_path, path)
+            except FileExistsError:
+                pass
+        os.remove(taken_path)
+
+    def claim(self, name : str) -> bool:
+        """
+        Try to claim a document, returns whether this worker now owns it
+        """
+        path = self.lock_path(name)
+        self.take_over(path)
+        try:
+            fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            return False
+        with os.fdopen(fd, "w") as f:
+            json.dump({"worker" : self.worker, "time" : time.time()}, f)
+
+        with self.lock:
+            self.held.add(name)
+            if self.refresh_thread is None:
+                self.refresh_thread = threading.Thread(target = self.refresh_loop, daemon = True)
+                self.refresh_thread.start()
+        return True
+
+    def refresh_loop(self):
+        while not self.stopping.wait(self.refresh_every):
+            with self.lock:
+                held = list(self.held)
+            for name in held:
+                try:
+                    os.utime(self.lock_path(name))
+                except FileNotFoundError:
+                    pass
+
+    def finish(self, name : str):
+        """
+        Stop touching the claim of a document that is done. The lockfile stays so no other worker claims it again.
+        """
+        with self.lock:
+            self.held.discard(name)
+
+    def release(self, name : str):
+        """
+        Give up a claim so another worker can take the document
+        """
+        self.finish(name)
+        try:
+            os.remove(self.lock_path(name))
+        except FileNotFoundError:
+            pass
+
+    def filter(self, names : Iterable[str]) -> Iterable[str]:
+        """
+        Lazily claim documents from names, yielding the ones this worker got
+        """
+        for name in names:
+            if self.claim(name):
+                yield name
+
+    def close(self):
+        """
+        Stop touching held claims, they go stale after stale_after seconds
+        """
+        self.stopping.set()
+        if self.refresh_thread is not None:
+            self.refresh_thread.join()
+
+class WorkerManifest:
+    """
+    Append-only log of the documents a single worker finished, one JSON object per line
+
+    :param manifest_dir: Folder holding the manifests of every worker
+    :param worker: Name of this worker
+    """
+    def __init__(self, manifest_dir : str, worker : str):
+        os.makedirs(manifest_dir, exist_ok = True)
+        self.worker = worker
+        self.path = os.path.join(manifest_dir, f"{worker}.jsonl")
+        self.lock = threading.Lock() # Documents can be finished by several writer threads
+
+    def log(self, doc_id : str, n_pages : int):
+        entry = {"doc" : doc_id, "n_pages" : n_pages, "worker" : self.worker, "time" : time.time()}
+        # Single small appends to a file only this worker writes to, so a crash loses at most the last line
+        with self.lock, open(self.path, "a") as f:
+            f.write(json.dumps(entry) + "\n")
+
+def merge_worker_manifests(manifest_dir : str, output_path : str) -> int:
+    """
+    Merge the manifests of every worker into a single JSONL file with one line per document, sorted by document.
+    If a document was finished more than once (i.e. after a stale claim was taken over) the latest entry is kept.
+    Returns the number of documents.
+    """
+    docs = {}
+    for fname in sorted(os.listdir(manifest_dir)):
+        if not fname.endswith(".jsonl"):
+            continue
+        with open(os.path.join(manifest_dir, fname), "r") as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError: # Partially written last line from a crashed worker
+                    continue
+                if entry["doc"] not in docs or entry["time"] > docs[entry["doc"]]["time"]:
+                    docs[entry["doc"]] = entry
+
+    tmp_path = output_path + ".tmp"
+    with open(tmp_path, "w") as f:
+        for doc_id in sorted(docs):
+            f.write(json.dumps(docs[doc_id]) + "\n")
+    os.replace(tmp_path, output_path)
+    return len(docs)
@@ -0,0 +1,174 @@
+from typing import Optional
+import threading
+import resource
+import json
+import time
+
+from mm_pdf.utils.data_utils import atomic_write
+
+"""
+Instrumentation of the pipeline. A Tracer records events (a stage, how long it took and anything else worth knowing,
+i.e. the page and the number of tokens generated) to a JSONL trace, and keeps running totals that are written as a
+Prometheus textfile (for node_exporter's textfile collector) summarizing the run.
+- Events pick up the fields bound to the thread that records them, so the document being worked on doesn't have to be
+    passed down to every function: with tracer.bind(doc = doc_id): ...
+- Recording an event only appends to a buffer, the trace is written every flush_every events
+- A disabled tracer (NULL_TRACER, used when none is given) does nothing at all
+"""
+
+class Span:
+    """
+    Times a block of code and records it as an event when the block ends. Fields can be added to the event inside
+    of the block through the dictionary the with statement returns.
+    """
+    def __init__(self, tracer : "Tracer", stage : str, fields : dict):
+        self.tracer = tracer
+        self.stage = stage
+        self.fields = fields
+
+    def __enter__(self) -> dict:
+        self.start = time.perf_counter()
+        return self.fields
+
+    def __exit__(self, *exc):
+        self.tracer.event(self.stage, time.perf_counter() - self.start, **self.fields)
+
+class NullSpan:
+    def __enter__(self) -> dict:
+        return {}
+
+    def __exit__(self, *exc):
+        pass
+
+class Bind:
+    def __init__(self, local : threading.local, fields : dict):
+        self.local = local
+        self.fields = fields
+
+    def __enter__(self):
+        self.previous = getattr(self.local, "fields", {})
+        self.local.fields = {**self.previous, **self.fields}
+
+    def __exit__(self, *exc):
+        self.local.fields = self.previous
+
+def peak_rss() -> dict:
+    """
+    Peak resident set size in bytes of this process, and of the largest of its finished child processes
+    """
+    # ru_maxrss is in kilobytes on Linux
+    return {
+        "self" : resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+        "children" : resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * 1024
+    }
+
+class Tracer:
+    """
+    Records events to a JSONL trace and a Prometheus summary, see the top of this file
+
+    :param path: JSONL file events are appended to. Events are only summarized if None.
+    :param prometheus_path: Prometheus textfile the summary is written to by write_summary. Not written if None.
+    :param enabled: Record nothing at all if False
+    :param flush_every: Number of events kept in memory before they are written to path
+    """
+    def __init__(self, path : str = None, prometheus_path : str = None, enabled : bool = True, flush_every : int = 256):
+        self.path = path
+        self.prometheus_path = prometheus_path
+        self.enabled = enabled
+        self.flush_every = flush_every
+
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.buffer = []
+        self.stage_seconds = {}
+        self.stage_calls = {}
+        self.counters = {} # (name, labels) to value
+        self.started = time.time()
+
+    def bind(self, **fields):
+        """
+        Add fields to every event recorded by this thread inside of a with block
+        """
+        if not self.enabled:
+            return NullSpan()
+        return Bind(self.local, fields)
+
+    def span(self, stage : str, **fields):
+        if not self.enabled:
+            return NullSpan()
+        return Span(self, stage, fields)
+
+    def event(self, stage : str, seconds : Optional[float] = None, **fields):
+        if not self.enabled:
+            return
+        record = {"time" : round(time.time(), 3), "stage" : stage, **getattr(self.local, "fields", {}), **fields}
+        if seconds is not None:
+            record["seconds"] = round(seconds, 6)
+        with self.lock:
+            if seconds is not None:
+                self.stage_seconds[stage] = self.stage_seconds.get(stage, 0) + seconds
+                self.stage_calls[stage] = self.stage_calls.get(stage, 0) + 1
+            if self.path is not None:
+                self.buffer.append(json.dumps(record))
+                if len(self.buffer) >= self.flush_every:
+                    self.flush_buffer()
+
+    def count(self, name : str, value : float = 1, **labels):
+        """
+        Add to a counter of the summary, i.e. count("tokens_generated", 120) or count("pages", route = "nougat")
+        """
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def flush_buffer(self):
+        """
+        Append buffered events to the trace. Must be called with the lock held.
+        """
+        if self.buffer:
+            with open(self.path, "a") as f:
+                f.write("\n".join(self.buffer) + "\n")
+            self.buffer = []
+
+    def summary(self) -> str:
+        """
+        The totals recorded so far in the Prometheus text format
+        """
+        lines = []
+        def metric(name, kind, help_text, values):
+            lines.extend([f"# HELP mm_pdf_{name} {help_text}", f"# TYPE mm_pdf_{name} {kind}"])
+            for labels, value in values:
+                label_text = ",".join(f'{key}="{label}"' for key, label in labels)
+                lines.append(f"mm_pdf_{name}{{{label_text}}} {value}" if label_text else f"mm_pdf_{name} {value}")
+
+        with self.lock:
+            metric("stage_seconds_total", "counter", "Wall time spent in each stage",
+                   [((("stage", stage),), round(seconds, 6)) for stage, seconds in sorted(self.stage_seconds.items())])
+            metric("stage_calls_total", "counter", "Number of times each stage ran",
+                   [((("stage", stage),), calls) for stage, calls in sorted(self.stage_calls.items())])
+            for name in sorted({name for name, _ in self.counters}):
+                metric(f"{name}_total", "counter", f"Total {name.replace('_', ' ')}",
+                       [(labels, value) for (counter, labels), value in sorted(self.counters.items()) if counter == name])
+            tokens = sum(value for (name, _), value in self.counters.items() if name == "tokens_generated")
+            decode_seconds = self.stage_seconds.get("decode", 0)
+        if decode_seconds:
+            metric("tokens_per_second", "gauge", "Tokens generated per second spent decoding", [((), round(tokens / decode_seconds, 3))])
+        metric("peak_rss_bytes", "gauge", "Peak resident set size", [((("process", process),), rss) for process, rss in peak_rss().items()])
+        metric("uptime_seconds", "gauge", "Time since the tracer was created", [((), round(time.time() - self.started, 3))])
+        return "\n".join(lines) + "\n"
+
+    def write_summary(self):
+        if not self.enabled:
+            return
+        with self.lock:
+            if self.path is not None:
+                self.flush_buffer()
+        if self.prometheus_path is not None:
+            atomic_write(self.prometheus_path, self.summary().encode())
+
+    def close(self):
+        self.write_summary()
+
+NULL_TRACER = Tracer(enabled = False)
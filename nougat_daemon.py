@@ -0,0 +1,70 @@
+from mm_pdf.pdf_processing import PDFProcessor
+from mm_pdf.daemon import PDFDaemon, DaemonClient, encode_image
+from mm_pdf.utils.trace_utils import Tracer
+
+import argparse
+import signal
+import json
+
+"""
+Keeps Nougat loaded between runs, for when jobs are too small to be worth loading the model for (see mm_pdf/daemon.py).
+Start the daemon once:
+    python -m nougat_daemon serve
+Then transcribe PDFs through it, printing their pages as they are done:
+    python -m nougat_daemon transcribe paper.pdf other.pdf
+    python -m nougat_daemon transcribe paper.pdf --json --figures > paper.jsonl
+"""
+
+socket_path = "./nougat.sock"
+max_wait = 0.05 # Seconds the daemon waits for pages of other requests to fill a batch
+trace_path = None # JSONL trace of the daemon, see mm_pdf/utils/trace_utils.py
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--socket", default = socket_path)
+    commands = parser.add_subparsers(dest = "command", required = True)
+    serve = commands.add_parser("serve", help = "Load Nougat and serve it until interrupted")
+    serve.add_argument("--model", default = "facebook/nougat-base")
+    serve.add_argument("--backend", default = "torch")
+    serve.add_argument("--device", default = None)
+    serve.add_argument("--batch-size", type = int, default = 8)
+    serve.add_argument("--max-tokens", type = int, default = 20000)
+    transcribe = commands.add_parser("transcribe", help = "Transcribe PDFs with a running daemon")
+    transcribe.add_argument("pdfs", nargs = "+")
+    transcribe.add_argument("--send", action = "store_true", help = "Send the PDFs' contents rather than their paths, for a daemon that can't read them")
+    transcribe.add_argument("--figures", action = "store_true", help = "Extract figures too (only written with --json)")
+    transcribe.add_argument("--json", action = "store_true", help = "Print every page as a line of JSON instead of its text")
+    args = parser.parse_args()
+
+    if args.command == "serve":
+        tracer = Tracer(trace_path) if trace_path is not None else None
+        pdf_processor = PDFProcessor(device = args.device, max_tokens_per_page = args.max_tokens, batch_size = args.batch_size,
+                                     model_name = args.model, backend = args.backend, tracer = tracer)
+        daemon = PDFDaemon(pdf_processor, args.socket, max_wait = max_wait)
+        # Blocked before the daemon's threads start so that they inherit it and only sigwait sees the signals
+        signal.pthread_sigmask(signal.SIG_BLOCK, [signal.SIGINT, signal.SIGTERM])
+        daemon.start()
+        print(f"Serving {args.model} on {args.socket}")
+        try:
+            signal.sigwait([signal.SIGINT, signal.SIGTERM])
+        finally:
+            daemon.close()
+            pdf_processor.figure_extractor.close()
+            if tracer is not None:
+                tracer.close()
+            print(f"Served {daemon.stats()}")
+    else:
+        client = DaemonClient(args.socket)
+        for pdf_path in args.pdfs:
+            pdf = pdf_path
+            if args.send:
+                with open(pdf_path, "rb") as f:
+                    pdf = f.read()
+            for page in client.transcribe(pdf, figures = args.figures):
+                if args.json:
+                    page["pdf"] = pdf_path
+                    if "figures" in page:
+                        page["figures"] = {label : encode_image(fig) for label, fig in page["figures"].items()}
+                    print(json.dumps(page))
+                else:
+                    print(page["text"] + "\n")
@@ -1,28 +1,400 @@
 import os
 from PIL import Image
+from contextlib import contextmanager
+import hashlib
+import tarfile
+import sqlite3
 import re
+import io
+
+try:
+    from torch.utils.data import IterableDataset, get_worker_info
+except ImportError: # Reading doesn't need torch, only plugging into a DataLoader does
+    IterableDataset = object
+    get_worker_info = lambda : None
+
+INDEX_FILENAME = ".index.sqlite"
 
 """
 This scripts provides a method to read from the resulting dataset created.
-It has no dependencies on anything else from this repository, allowing it to be plugged in 
-wherever it is needed. It returns the dataset as a dictionary. 
+It has no dependencies on anything else from this repository, allowing it to be plugged in
+wherever it is needed. It returns the dataset as a dictionary.
 The following assumptions are made:
 - Figures and tables are assumed to always be at the end of a page
 
 The dictionary has keys: (each dictionary represents a single doc)
     - text: The raw text of the document in pages (List[str])
-    - figure: Iterables of Triples of figures with their captions and page numbers 
-        - List[Tuple[int, str, Image]] or List[Tuple[int, str, str]] 
+    - figure: Iterables of Triples of figures with their captions and page numbers
+        - List[Tuple[int, str, Image]] or List[Tuple[int, str, str]]
         - Type changes depending on whether img_paths_only is called
     - table: Same data type as figures
+
+Datasets written in the packed format (a folder of tar shards, see mm_pdf/utils/packed_utils.py) are read too.
+Members of the shards are read in place by their offset, without extracting them.
+
+read_dataset loads everything up front. For large datasets use iter_dataset (or StreamingDataset with a torch
+DataLoader) instead, which yields one document or page at a time and only decodes images when asked to.
+If the dataset has an index (.index.sqlite, written by write_dataset.py) it is used to find documents and their
+files without listing folders, and read_page/iter_media use it to read single pages or all figures/tables directly.
 """
 
-def read_dataset(ds_path, train_test = None, img_paths_only = False):
+def read_packed(ds_path):
+    """
+    Group the members of every tar shard in ds_path by document.
+    Returns a dictionary mapping document ids to dictionaries that map file names (as they would be named in a
+    documents folder, i.e. 00000000.txt or 00000000-figure1.png) to (shard_path, member_name, offset, size).
+    Empty if ds_path holds no shards.
+    """
+    docs = {}
+    for shard in sorted(os.listdir(ds_path)):
+        if not shard.endswith(".tar"):
+            continue
+        shard_path = os.path.join(ds_path, shard)
+        with tarfile.open(shard_path, 'r') as tar:
+            for member in tar.getmembers():
+                if not member.isfile():
+                    continue
+                doc_id, name = member.name.split("/", 1)
+                if name.count(".") == 1 and name.endswith(".json"):
+                    continue # Per page metadata, the same information is in the other members names
+                # [page_id].[identifier].png -> [page_id]-[identifier].png
+                name = name[:8] + name[8:].replace(".", "-", 1) if name.count(".") > 1 else name
+                docs.setdefault(doc_id, {})[name] = (shard_path, member.name, member.offset_data, member.size)
+    return docs
+
+def read_bytes(source):
     """
-    Return dictionary of dataset given path to it.
+    Read a file given either its path or its location in a shard
+    """
+    if isinstance(source, str):
+        with open(source, 'rb') as f:
+            return f.read()
+    shard_path, _, offset, size = source
+    with open(shard_path, 'rb') as f:
+        f.seek(offset)
+        return f.read(size)
+
+class LazyImage:
+    """
+    Figure or table that is only read and decoded once load() is called. Holds no open file until then,
+    so any number of them can be kept around.
+    """
+    def __init__(self, source):
+        self.source = source
+
+    @property
+    def path(self):
+        """
+        Path to the image, or for packed datasets [shard_path]/[member_name]
+        """
+        return self.source if isinstance(self.source, str) else os.path.join(self.source[0], self.source[1])
+
+    def load(self):
+        img = Image.open(io.BytesIO(read_bytes(self.source)))
+        img.load()
+        return img
+
+    def __repr__(self):
+        return f"LazyImage({self.path})"
+
+def hash_fraction(doc_id, salt = ""):
+    """
+    Deterministic number in [0, 1) for a document. Uses sha1 rather than hash() since the latter is salted per process.
+    """
+    return int(hashlib.sha1((salt + doc_id).encode()).hexdigest()[:8], 16) / 2**32
+
+def in_split(doc_id, split, train_test = None):
+    """
+    Whether a document belongs to split ("train" or "test"). Documents are assigned by a hash of their id, so the
+    split is the same on every run and machine without listing the whole dataset first.
+
+    :param train_test: Training fraction. Set to none to put every document in the train split
+    """
+    if not train_test:
+        return split == "train"
+    return (hash_fraction(doc_id) < train_test) == (split == "train")
+
+@contextmanager
+def open_index(ds_path):
+    """
+    Read only connection to the index written alongside the dataset (see mm_pdf/utils/index_utils.py), None if there
+    is none. Closed when the with block is left.
+    """
+    index_path = os.path.join(ds_path, INDEX_FILENAME)
+    if not os.path.isfile(index_path):
+        yield None
+        return
+    index = sqlite3.connect(f"file:{index_path}?mode=ro", uri = True, check_same_thread = False)
+    try:
+        yield index
+    finally:
+        index.close()
+
+def index_files(ds_path, index, where, params = ()):
+    """
+    Files from the index matching an SQL condition, as a dictionary mapping their names to paths or locations in a shard
+    """
+    files = {}
+    for doc, name, shard, member, offset, size in index.execute(
+        f"SELECT doc, name, shard, member, offset, size FROM files WHERE {where}", params
+    ):
+        if shard is None:
+            files[name] = os.path.join(ds_path, doc, name)
+        else:
+            files[name] = (os.path.join(ds_path, shard), member, offset, size)
+    return files
+
+def list_documents(ds_path, index = None):
+    """
+    Returns a list of the ids of documents in the dataset and a lookup for their files to pass to document_files.
+    Uses the datasets index if one is given, otherwise shards are scanned or folders listed.
+
+    :param index: Connection from open_index
+    """
+    if index is not None:
+        return [row[0] for row in index.execute("SELECT doc FROM docs ORDER BY doc")], index
+    packed = read_packed(ds_path)
+    if packed:
+        return sorted(packed), packed
+    # Hidden entries hold bookkeeping from writing the dataset (claims, worker manifests), not documents
+    return sorted(entry.name for entry in os.scandir(ds_path) if entry.is_dir() and not entry.name.startswith(".")), None
+
+def document_files(ds_path, doc_id, lookup = None):
+    """
+    Map the names of a documents files to their paths or locations in a shard
+
+    :param lookup: Index or packed members from list_documents, the documents folder is listed if None
+    """
+    if isinstance(lookup, sqlite3.Connection):
+        return index_files(ds_path, lookup, "doc = ?", (doc_id,))
+    if lookup:
+        return lookup[doc_id]
+    doc_path = os.path.join(ds_path, doc_id)
+    return {fp : os.path.join(doc_path, fp) for fp in os.listdir(doc_path)}
+
+def extract_file_info(path):
+    """
+    Extract info from file names. Namely, the page number, the figure/table number, and whether page is text/figure/table
+    Returns a tuple (classification, page_num, num)
+        - classification is one of "text", "figure", "table"
+        - page_num is an int
+        - num is None if "text" otherwise an int, or a string for figures saved under their label (see page_identifier
+          in mm_pdf/utils/figure_utils.py), which no caption matches
+    """
+
+    base_path = os.path.basename(path)
+    page_num = int(base_path[:8])
+
+    if base_path.endswith(".txt"):
+        return ("text", page_num, None)
+    elif base_path.endswith(".png"):
+        if base_path[8:].startswith("-table"):
+            num = base_path[14:-4]
+            return ("table", page_num, int(num) if num.isdigit() else num)
+        elif base_path[8:].startswith("-figure"):
+            num = base_path[15:-4]
+            return ("figure", page_num, int(num) if num.isdigit() else num)
+    else:
+        raise ValueError("Invalid path for dataset")
+
+def extract_captions(page_text : str, valid_nums):
+    """
+    Separate page text from any captions near end
+
+    :param page_text: The full text from the page
+    :param valid_nums: List of ints representing the numbers for the captions we are still looking for
+    """
+    text = page_text
+
+    figure_table_pattern = re.compile(r"(Figure|Table) \d+: ")
+    matches = list(figure_table_pattern.finditer(text))
+
+    captions = {} # Dict mapping numbers to captions
+
+    for match in reversed(matches):
+        if not valid_nums: # Break early if no captions left to look for
+            break # May prevent cases where text is referencing some other caption and that results in text being cut short
+
+        caption = text[match.start():]
+        text = text[:match.start()]
+
+        num = int(caption[caption.find(" "):caption.find(":")]) # the number is between space and colon: Figure X:
+        if num in valid_nums:
+            captions[num] = caption
+
+    return text, captions
+
+def iter_pages(doc_files, img_paths_only = False):
+    """
+    Process a single document page by page, reading each page only once it is reached.
+    Yields dictionaries with keys:
+        - page : number of the page
+        - text : text of the page with captions removed
+        - figure : list of triples (page_num, caption, path or LazyImage) for figures whose caption is on this page
+        - table : same for tables
+
+    :param doc_files: Maps the names of the documents files to their paths or locations in a shard
+    """
+    # Only page text and images, skips the manifest, detached captions and any temporary files from an interrupted write
+    files = [fp for fp in doc_files if fp[:8].isdigit() and fp.endswith((".txt", ".png"))]
+
+    figure_queue = {}
+    table_queue = {}
+
+    # Sort so that digits stay in order
+    # images will always come before text
+    def custom_sort_key(file_path):
+        basename = os.path.basename(file_path)
+        digits = int(basename[:8])
+        is_txt = basename.endswith(".txt")
+        return (digits, is_txt)
+
+    files.sort(key=custom_sort_key)
+
+    def image(source):
+        img = LazyImage(source)
+        return img.path if img_paths_only else img
+
+    for file in files: # Iterating throughe very file for a document
+            (file_type, page_num, num) = extract_file_info(file)
+            if file_type == "text":
+                figures = []
+                tables = []
+                text_content = read_bytes(doc_files[file]).decode()
+                text_content, captions = extract_captions(
+                    text_content,
+                    list(figure_queue.keys()) + list(table_queue.keys()) # Combine keys
+                ) # Split text from instances of captions. Only look for captions corresponding to figures/tables already in queue
+                for key in captions: # Iterate over the found captions
+                    if key in figure_queue: # If the key corresponds to a figure, remove from queue and add to figures
+                        figures.append((page_num, captions[key], image(figure_queue[key])))
+                        del figure_queue[key]
+                    if key in table_queue: # Like-wise if table
+                        tables.append((page_num, captions[key], image(table_queue[key])))
+                        del table_queue[key]
+
+                yield {
+                    "page" : page_num,
+                    "text" : text_content,
+                    "figure" : figures,
+                    "table" : tables
+                }
+            elif file_type == "figure": # If its a figure or table, just add to queue until we find matching page
+                figure_queue[num] = doc_files[file]
+            elif file_type == "table":
+                table_queue[num] = doc_files[file]
+
+def process_document(doc_files, img_paths_only = False, reader = iter_pages):
+    """
+    Process a single document into its corresponding components.
+    Returns dictionary with keys:
+        - text : list of text from each page of the document
+        - figure : list of triples of all figures from the doc with (page_num, caption, path or LazyImage)
+        - table : list of triples of all tables (same format as figures)
+
+    :param reader: Reads the pages of a document from its files, iter_pages or the one of read_dataset_2
+    """
+    doc = {"text" : [], "figure" : [], "table" : []}
+    for page in reader(doc_files, img_paths_only):
+        doc["text"].append(page["text"])
+        doc["figure"] += page["figure"]
+        doc["table"] += page["table"]
+    return doc
+
+def iter_dataset(ds_path, split = "train", train_test = None, by_page = False, img_paths_only = False,
+                 num_workers = None, worker_id = None, reader = iter_pages):
+    """
+    Lazily iterate over a split of the dataset, yielding one document (see process_document) or one page
+    (see iter_pages, with an added "doc" key) at a time. Images are LazyImages that are decoded on load().
+
+    :param split: "train" or "test"
+    :param train_test: Training fraction. Set to none to return just the dataset as train split
+    :param by_page: Yield pages rather than whole documents
+    :param img_paths_only: Whether to return LazyImages or paths to them
+    :param num_workers: Split documents between this many workers (i.e. one per distributed rank).
+        Inside of a DataLoader worker, documents are further split between the DataLoaders workers.
+    :param worker_id: Which of the num_workers this is
+    :param reader: See process_document
+    """
+    num_workers = num_workers or 1
+    worker_id = worker_id or 0
+    worker_info = get_worker_info()
+    if worker_info is not None:
+        worker_id = worker_id * worker_info.num_workers + worker_info.id
+        num_workers = num_workers * worker_info.num_workers
+
+    with open_index(ds_path) as index:
+        doc_ids, lookup = list_documents(ds_path, index)
+        for doc_id in doc_ids:
+            if not in_split(doc_id, split, train_test):
+                continue
+            # Salted so that the assignment to workers is independent of the split
+            if int(hash_fraction(doc_id, "worker") * 2**32) % num_workers != worker_id:
+                continue
+
+            doc_files = document_files(ds_path, doc_id, lookup)
+            if by_page:
+                for page in reader(doc_files, img_paths_only):
+                    page["doc"] = doc_id
+                    yield page
+            else:
+                yield process_document(doc_files, img_paths_only, reader)
+
+def read_page(ds_path, doc_id, page_num, img_paths_only = False, reader = iter_pages):
+    """
+    Read a single page of a document, see iter_pages for what is returned (with an added "doc" key). With an index only that pages files are touched.
+    Only figures and tables from the same page are matched with its captions.
+    """
+    with open_index(ds_path) as index:
+        if index is not None:
+            doc_files = index_files(ds_path, index, "doc = ? AND page = ?", (doc_id, page_num))
+        else:
+            doc_files = {name : source for name, source in document_files(ds_path, doc_id, read_packed(ds_path)).items()
+                         if name[:8] == str(page_num).zfill(8)}
+    for page in reader(doc_files, img_paths_only):
+        page["doc"] = doc_id
+        return page
+    raise KeyError(f"No page {page_num} in document {doc_id}")
+
+def iter_media(ds_path, kind = "figure", img_paths_only = False, reader = iter_pages):
+    """
+    Iterate over every figure or table in the dataset as (doc_id, page_num, caption, image). Captions are matched the
+    same way as when reading whole documents, so a caption can be on a later page than its figure. With an index, only
+    documents holding a figure or table are read.
+
+    :param kind: "figure" or "table"
+    :param reader: See process_document
+    """
+    with open_index(ds_path) as index:
+        if index is None:
+            doc_ids, lookup = list_documents(ds_path)
+        else:
+            doc_ids = [row[0] for row in index.execute("SELECT DISTINCT doc FROM files WHERE kind = ? ORDER BY doc", (kind,))]
+            lookup = index
+        for doc_id in doc_ids:
+            for page in reader(document_files(ds_path, doc_id, lookup), img_paths_only):
+                for (page_num, caption, img) in page[kind]:
+                    yield (doc_id, page_num, caption, img)
+
+class StreamingDataset(IterableDataset):
+    """
+    iter_dataset as an IterableDataset, so a DataLoader with several workers splits documents between them.
+    Takes the same arguments as iter_dataset.
+    """
+    def __init__(self, ds_path, **kwargs):
+        self.ds_path = ds_path
+        self.kwargs = kwargs
+
+    def __iter__(self):
+        return iter_dataset(self.ds_path, **self.kwargs)
+
+def read_dataset(ds_path, train_test = None, img_paths_only = False, reader = iter_pages):
+    """
+    Return dictionary of dataset given path to it. Every image is decoded up front, see iter_dataset for large datasets.
 
     :param train_test: Training fraction. Set to none to return just the dataset as train split
     :param img_paths_only: Whether to return Images or paths to them
+    :param reader: See process_document
     """
 
     # Notes on directory structures:
@@ -31,146 +403,27 @@ def read_dataset(ds_path, train_test = None, img_paths_only = False):
     # Figures or tables are numbered by page they appear on along with suffix, i.e.:
     # 00000000-figure1.png or 00000000-table1.png
     # Captions for figures or tables appear at end of their corresponding page as "Figure 1: ..." or "Table 1: ..."
-    
+
     # Check if the file is a tar file
     if ds_path.endswith('.tar'):
-        import tarfile
         with tarfile.open(ds_path, 'r') as tar:
             tar.extractall()
 
         # Update ds_path to the extracted directory
         ds_path = os.path.splitext(ds_path)[0]
 
-    document_paths = os.listdir(ds_path)
-    if train_test:
-        doc_paths_train = document_paths[:int(train_test * len(document_paths))]
-        doc_paths_tests = document_paths[int(train_test * len(document_paths)):]
-    else:
-        doc_paths_train = document_paths
-        doc_paths_test = []
-
-    def extract_file_info(path):
-        """
-        Extract info from file names. Namely, the page number, the figure/table number, and whether page is text/figure/table
-        Returns a tuple (classification, page_num, num)
-            - classification is one of "text", "figure", "table"
-            - page_num is an int
-            - num is None if "text" otherwise an int
-        """
-
-        base_path = os.path.basename(path)
-        page_num = int(base_path[:8])
-        
-        if base_path.endswith(".txt"):
-            return ("text", page_num, None)
-        elif base_path.endswith(".png"):
-            if base_path[8:].startswith("-table"):
-                num = int(base_path[14:-4])
-                return ("table", page_num, num)
-            elif base_path[8:].startswith("-figure"):
-                num = int(base_path[15:-4])
-                return ("figure", page_num, num)
-        else:
-            raise ValueError("Invalid path for dataset")
-
-    def extract_captions(page_text : str, valid_nums):
-        """
-        Separate page text from any captions near end
-
-        :param page_text: The full text from the page
-        :param valid_nums: List of ints representing the numbers for the captions we are still looking for
-        """
-        text = page_text
-        
-        figure_table_pattern = re.compile(r"(Figure|Table) \d+: ")
-        matches = list(figure_table_pattern.finditer(text))
-
-        captions = {} # Dict mapping numbers to captions
-
-        for match in reversed(matches):
-            if not valid_nums: # Break early if no captions left to look for
-                break # May prevent cases where text is referencing some other caption and that results in text being cut short
-
-            caption = text[match.start():]
-            text = text[:match.start()]
-        
-            num = int(caption[caption.find(" "):caption.find(":")]) # the number is between space and colon: Figure X:
-            if num in valid_nums:
-                captions[num] = caption
-
-        return text, captions
-    
-    def process_document(doc_path):
-        """
-        Process a single document into its corresponding components.
-        Returns dictionary with keys:
-            - text : list of text from each page of the document
-            - figure : list of triples of all figures from the doc with (page_num, caption, path or image)
-            - table : list of triples of all tables (same format as figures)
-        """
-
-        pages = []
-        figures = []
-        tables = []
-
-        files = os.listdir(doc_path)
-        files = [os.path.join(doc_path, fp) for fp in files]
-
-        figure_queue = {}
-        table_queue = {}
-
-        # Sort so that digits stay in order
-        # images will always come before text
-        def custom_sort_key(file_path):
-            basename = os.path.basename(file_path)
-            digits = int(basename[:8])
-            is_txt = basename.endswith(".txt")
-            return (digits, is_txt)
-
-        files.sort(key=custom_sort_key)
-
-        for file in files: # Iterating throughe very file for a document
-                (file_type, page_num, num) = extract_file_info(file)
-                if file_type == "text":
-                    with open(file, 'r') as f:
-                        text_content = f.read()
-                        text_content, captions = extract_captions(
-                            text_content,
-                            list(figure_queue.keys()) + list(table_queue.keys()) # Combine keys
-                        ) # Split text from instances of captions. Only look for captions corresponding to figures/tables already in queue
-                        for key in captions: # Iterate over the found captions
-                            if key in figure_queue: # If the key corresponds to a figure, remove from queue and add to figures
-                                figure_path = figure_queue[key]
-                                figures.append((page_num, captions[key], figure_path if img_paths_only else Image.open(figure_path)))
-                                del figure_queue[key]
-                            if key in table_queue: # Like-wise if table
-                                table_path = table_queue[key]
-                                tables.append((page_num, captions[key], table_path if img_paths_only else Image.open(table_path)))
-                                del table_queue[key]
-
-                        pages.append(text_content)
-                elif file_type == "figure": # If its a figure or table, just add to queue until we find matching page
-                    figure_queue[num] = file
-                elif file_type == "table":
-                    table_queue[num] = file
-
-        return {
-            "text" : pages,
-            "figure" : figures,
-            "table" : tables
-        }
-
-    def process_subset(doc_paths):
+    def process_subset(split):
         res = []
 
-        for path in doc_paths: # Iterating through documents
-            res.append(
-                process_document(os.path.join(ds_path, path))
-            )
+        for doc in iter_dataset(ds_path, split, train_test, img_paths_only = img_paths_only, reader = reader): # Iterating through documents
+            if not img_paths_only:
+                for key in ("figure", "table"):
+                    doc[key] = [(page_num, caption, img.load()) for (page_num, caption, img) in doc[key]]
+            res.append(doc)
 
         return res
-    
+
     return {
-        "train" : process_subset(doc_paths_train),
-        "test" : process_subset(doc_paths_test)
-    }
\ No newline at end of file
+        "train" : process_subset("train"),
+        "test" : process_subset("test")
+    }
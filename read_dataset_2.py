@@ -1,80 +1,104 @@
 import os
 import json
-from PIL import Image
 
-def read_dataset(ds_path, train_test = None, img_paths_only = False):
-    """
-    Return dictionary of dataset given path to it.
+import read_dataset as base_reader
+# Finding and reading the files of documents is the same whether captions were detached or not
+from read_dataset import read_bytes, LazyImage
+
+"""
+Reads datasets whose captions were detached into [page_id]-media.json files (see detach_captions.py), either as a
+folder per document or in the packed format (a folder of tar shards, see mm_pdf/utils/packed_utils.py).
+read_dataset loads everything up front. For large datasets use iter_dataset (or StreamingDataset with a torch
+DataLoader) instead, which yields one document or page at a time and only decodes images when asked to.
+If the dataset has an index (.index.sqlite, written by write_dataset.py) it is used to find documents and their
+files without listing folders, and read_page/iter_media use it to read single pages or all figures/tables directly.
+Only how pages are read differs from read_dataset.py, everything else is shared with it.
+"""
 
-    :param train_test: Training fraction. Set to none to return just the dataset as train split
-    :param img_paths_only: Whether to return Images or paths to them
+def iter_pages(doc_files, img_paths_only = False):
     """
+    Process a single document page by page, reading each page only once it is reached.
+    Yields dictionaries with keys:
+        - page : number of the page
+        - text : text of the page
+        - figure : list of triples (page_num, caption, path or LazyImage) for figures on this page
+        - table : same for tables
 
-    document_paths = os.listdir(ds_path)
-    if train_test:
-        doc_paths_train = document_paths[:int(train_test * len(document_paths))]
-        doc_paths_tests = document_paths[int(train_test * len(document_paths)):]
-    else:
-        doc_paths_train = document_paths
-        doc_paths_test = []
+    :param doc_files: Maps the names of the documents files to their paths or locations in a shard
+    """
+    # Only page files, skips the manifest and any temporary files from an interrupted write
+    files = [fp for fp in doc_files if fp[:8].isdigit() and not fp.endswith(".tmp")]
 
-    def process_document(doc_path):
-        """
-        Process a single document into its corresponding components.
-        Returns dictionary with keys:
-            - text : list of text from each page of the document
-            - figure : list of triples of all figures from the doc with (page_num, caption, path or image)
-            - table : list of triples of all tables (same format as figures)
-        """
+    # Sort so that digits stay in order
+    def custom_sort_key(file_path):
+        basename = os.path.basename(file_path)
+        digits = int(basename[:8])
+        is_txt = basename.endswith(".txt")
+        return (digits, is_txt)
 
-        pages = []
-        figures = []
-        tables = []
+    files.sort(key=custom_sort_key)
 
-        files = os.listdir(doc_path)
-        files = [os.path.join(doc_path, fp) for fp in files]
+    def image(source):
+        img = LazyImage(source)
+        return img.path if img_paths_only else img
 
-        # Sort so that digits stay in order
-        def custom_sort_key(file_path):
-            basename = os.path.basename(file_path)
-            digits = int(basename[:8])
-            is_txt = basename.endswith(".txt")
-            return (digits, is_txt)
+    figures = []
+    tables = []
+    for file in files: # Iterating through every file for a document
+        if file.endswith(".txt"): # Comes after the media of its page
+            yield {
+                "page" : int(file[:8]),
+                "text" : read_bytes(doc_files[file]).decode(),
+                "figure" : figures,
+                "table" : tables
+            }
+            figures = []
+            tables = []
+        elif file.endswith("-media.json"):
+            media_content = json.loads(read_bytes(doc_files[file]))
+            for figure in media_content["figures"]:
+                figure_path = doc_files.get(f"{file[:8]}-figure{figure['id']}.png")
+                if figure_path is not None: # Captions can be found without PDFFigures2 having found their figure
+                    figures.append((int(file[:8]), figure["caption"], image(figure_path)))
+            for table in media_content["tables"]:
+                table_path = doc_files.get(f"{file[:8]}-table{table['id']}.png")
+                if table_path is not None:
+                    tables.append((int(file[:8]), table["caption"], image(table_path)))
 
-        files.sort(key=custom_sort_key)
+def process_document(doc_files, img_paths_only = False):
+    """
+    See read_dataset.process_document
+    """
+    return base_reader.process_document(doc_files, img_paths_only, iter_pages)
 
-        for file in files: # Iterating through every file for a document
-            if file.endswith(".txt"):
-                with open(file, 'r') as f:
-                    text_content = f.read()
-                    pages.append(text_content)
-            elif file.endswith("-media.json"):
-                with open(file, 'r') as f:
-                    media_content = json.load(f)
-                    for figure in media_content["figures"]:
-                        figure_path = os.path.join(doc_path, f"{os.path.basename(file)[:8]}-figure{figure['id']}.png")
-                        figures.append((int(os.path.basename(file)[:8]), figure["caption"], figure_path if img_paths_only else Image.open(figure_path)))
-                    for table in media_content["tables"]:
-                        table_path = os.path.join(doc_path, f"{os.path.basename(file)[:8]}-table{table['id']}.png")
-                        tables.append((int(os.path.basename(file)[:8]), table["caption"], table_path if img_paths_only else Image.open(table_path)))
+def iter_dataset(ds_path, split = "train", train_test = None, by_page = False, img_paths_only = False,
+                 num_workers = None, worker_id = None):
+    """
+    See read_dataset.iter_dataset
+    """
+    return base_reader.iter_dataset(ds_path, split, train_test, by_page, img_paths_only, num_workers, worker_id, iter_pages)
 
-        return {
-            "text" : pages,
-            "figure" : figures,
-            "table" : tables
-        }
+def read_page(ds_path, doc_id, page_num, img_paths_only = False):
+    """
+    See read_dataset.read_page
+    """
+    return base_reader.read_page(ds_path, doc_id, page_num, img_paths_only, iter_pages)
 
-    def process_subset(doc_paths):
-        res = []
+def iter_media(ds_path, kind = "figure", img_paths_only = False):
+    """
+    See read_dataset.iter_media
+    """
+    return base_reader.iter_media(ds_path, kind, img_paths_only, iter_pages)
 
-        for path in doc_paths: # Iterating through documents
-            res.append(
-                process_document(os.path.join(ds_path, path))
-            )
+class StreamingDataset(base_reader.StreamingDataset):
+    """
+    See read_dataset.StreamingDataset
+    """
+    def __iter__(self):
+        return iter_dataset(self.ds_path, **self.kwargs)
 
-        return res
-    
-    return {
-        "train" : process_subset(doc_paths_train),
-        "test" : process_subset(doc_paths_test)
-    }
+def read_dataset(ds_path, train_test = None, img_paths_only = False):
+    """
+    See read_dataset.read_dataset
+    """
+    return base_reader.read_dataset(ds_path, train_test, img_paths_only, iter_pages)
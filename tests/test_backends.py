@@ -0,0 +1,55 @@
+import pytest
+import torch
+from transformers import VisionEncoderDecoderModel, VisionEncoderDecoderConfig, DonutSwinConfig, MBartConfig
+
+from mm_pdf.pdf_processing import PDFProcessor
+from mm_pdf.utils.backend_utils import load_model
+from benchmarks.synthetic import stub_nougat
+
+@pytest.fixture(scope = "module")
+def tiny_nougat(tmp_path_factory) -> str:
+    """
+    Randomly initialized model shaped like Nougat (a Swin encoder and an MBart decoder), small enough to load quickly
+    """
+    encoder = DonutSwinConfig(image_size = [64, 48], patch_size = 4, embed_dim = 8, depths = [1, 1], num_heads = [1, 1], window_size = 4)
+    decoder = MBartConfig(vocab_size = 32, d_model = 16, decoder_layers = 1, decoder_attention_heads = 2, decoder_ffn_dim = 32,
+                          max_position_embeddings = 64, is_decoder = True, add_cross_attention = True, add_final_layer_norm = True)
+    torch.manual_seed(0)
+    model = VisionEncoderDecoderModel(VisionEncoderDecoderConfig.from_encoder_decoder_configs(encoder, decoder))
+    for config in (model.config, model.generation_config):
+        config.decoder_start_token_id, config.pad_token_id, config.eos_token_id = 0, 1, 2
+    path = str(tmp_path_factory.mktemp("models") / "tiny-nougat")
+    model.save_pretrained(path)
+    return path
+
+def decode(pdf_processor : PDFProcessor):
+    torch.manual_seed(1)
+    sequences, truncated = pdf_processor.generate(torch.rand(2, 3, 64, 48))
+    assert len(sequences) == 2 and len(truncated) == 2
+    assert all(len(sequence) <= 1 + pdf_processor.max_tokens_per_page for sequence in sequences)
+
+@pytest.mark.parametrize("backend", ["torch", "int8"])
+def test_backend_loads(tiny_nougat, backend):
+    _, processor = stub_nougat()
+    pdf_processor = PDFProcessor(device = "cpu", model_name = tiny_nougat, backend = backend, processor = processor, max_tokens_per_page = 8)
+    linear = pdf_processor.model.decoder.model.decoder.layers[0].fc1
+    assert isinstance(linear, torch.ao.nn.quantized.dynamic.Linear) == (backend == "int8")
+    assert pdf_processor.dtype == torch.float32 and pdf_processor.cache_settings()["backend"] == backend
+    decode(pdf_processor)
+
+def test_onnx_backend(tiny_nougat, tmp_path):
+    pytest.importorskip("optimum.onnxruntime")
+    _, processor = stub_nougat()
+    onnx_path = str(tmp_path / "onnx")
+    pdf_processor = PDFProcessor(device = "cpu", model_name = tiny_nougat, backend = "onnx", onnx_path = onnx_path,
+                                 processor = processor, max_tokens_per_page = 8)
+    decode(pdf_processor)
+    # The export is reused
+    decode(PDFProcessor(device = "cpu", model_name = "unused", backend = "onnx", onnx_path = onnx_path,
+                        processor = processor, max_tokens_per_page = 8))
+
+def test_unknown_backend(tiny_nougat):
+    with pytest.raises(ValueError):
+        load_model(tiny_nougat, "tensorrt", "cpu")
+    with pytest.raises(ValueError):
+        load_model(tiny_nougat, "int8", "cuda")
@@ -0,0 +1,43 @@
+from PIL import Image
+
+from mm_pdf.pdf_processing import PDFProcessor
+from mm_pdf.utils.pdf_utils import load_pdf
+from benchmarks.synthetic import synthetic_pdf, stub_nougat
+
+def make_processor(**kwargs) -> PDFProcessor:
+    model, processor = stub_nougat()
+    return PDFProcessor(device = "cpu", model = model, processor = processor, **kwargs)
+
+def page_image(text : str) -> Image.Image:
+    img = Image.new("RGB", (8, 8), "white")
+    img.info["text"] = text # What the stub model transcribes the page to
+    return img
+
+def test_batched_matches_single(tmp_path):
+    path = str(tmp_path / "doc.pdf")
+    synthetic_pdf(path, 5, seed = 4, table_prob = 0, figure_prob = 0)
+    pages = load_pdf(path)
+    pdf_processor = make_processor(batch_size = 5, decode_window = 16)
+    single = [pdf_processor.call_nougat(page) for page in pages]
+    batched = pdf_processor.call_nougat(pages)
+    assert batched == single
+    assert all(text.split() == page.info["text"].split() for text, page in zip(batched, pages))
+
+def test_finished_pages_leave_batch():
+    pdf_processor = make_processor(batch_size = 3, decode_window = 4)
+    model = pdf_processor.model
+    batch_sizes = []
+    generate = model.generate
+    def recording_generate(encoder_outputs, decoder_input_ids, **kwargs):
+        batch_sizes.append(decoder_input_ids.shape[0])
+        return generate(encoder_outputs, decoder_input_ids, **kwargs)
+    model.generate = recording_generate
+
+    # Pages of 2, 6 and 14 tokens (words and end of sequence)
+    texts = ["a", "b c d e f", "g h i j k l m n o p q r s"]
+    pixel_values = pdf_processor.processor([page_image(text) for text in texts]).pixel_values
+    sequences, truncated = pdf_processor.generate(pixel_values)
+    assert truncated == [False, False, False]
+    assert [pdf_processor.processor.batch_decode([sequence])[0] for sequence in sequences] == texts
+    # Windows of 4 tokens, the short pages drop out once they reach their end of sequence
+    assert batch_sizes == [3, 2, 1, 1]
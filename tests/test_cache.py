@@ -0,0 +1,61 @@
+from PIL import Image
+
+from mm_pdf.utils.cache_utils import PageCache
+
+SETTINGS = {"model" : "nougat", "max_new_tokens" : 100}
+
+def page(color):
+    return Image.new("RGB", (20, 30), color)
+
+def test_hit_and_miss(tmp_path):
+    cache = PageCache(str(tmp_path / "cache.sqlite"))
+    assert cache.get(page("red"), SETTINGS) is None
+    cache.put(page("red"), SETTINGS, "Red page")
+    assert cache.get(page("red"), SETTINGS) == "Red page"
+    # Another page, or the same page under other settings, misses
+    assert cache.get(page("blue"), SETTINGS) is None
+    assert cache.get(page("red"), {**SETTINGS, "max_new_tokens" : 200}) is None
+    assert cache.stats() == {"hits" : 1, "misses" : 3, "entries" : 1, "bytes" : 8}
+    cache.close()
+
+    # Entries outlive the process that wrote them
+    cache = PageCache(str(tmp_path / "cache.sqlite"))
+    assert cache.get(page("red"), SETTINGS) == "Red page"
+    cache.close()
+
+def test_invalidate(tmp_path):
+    cache = PageCache(str(tmp_path / "cache.sqlite"))
+    new_settings = {**SETTINGS, "model" : "nougat-small"}
+    cache.put(page("red"), SETTINGS, "Old")
+    cache.put(page("red"), new_settings, "New")
+    cache.invalidate(new_settings)
+    assert cache.get(page("red"), SETTINGS) is None and cache.get(page("red"), new_settings) == "New"
+    cache.invalidate()
+    assert cache.get(page("red"), new_settings) is None and cache.total_bytes == 0
+    cache.close()
+
+def test_eviction_by_size(tmp_path, monkeypatch):
+    cache = PageCache(str(tmp_path / "cache.sqlite"), max_bytes = 25)
+    for i, color in enumerate(("red", "green", "blue")):
+        monkeypatch.setattr("mm_pdf.utils.cache_utils.time.time", lambda: float(i))
+        cache.put(page(color), SETTINGS, color[0] * 8)
+    assert cache.total_bytes == cache.size() == 24
+    # Reading red makes green the least recently used
+    monkeypatch.setattr("mm_pdf.utils.cache_utils.time.time", lambda: 3.0)
+    assert cache.get(page("red"), SETTINGS) == "rrrrrrrr"
+    monkeypatch.setattr("mm_pdf.utils.cache_utils.time.time", lambda: 4.0)
+    cache.put(page("white"), SETTINGS, "w" * 8)
+    assert cache.get(page("green"), SETTINGS) is None
+    assert cache.get(page("red"), SETTINGS) is not None and cache.get(page("blue"), SETTINGS) is not None
+    assert cache.total_bytes == cache.size() == 24
+    cache.close()
+
+def test_replace(tmp_path):
+    cache = PageCache(str(tmp_path / "cache.sqlite"), max_bytes = 20)
+    cache.put(page("blue"), SETTINGS, "b" * 10)
+    # Putting the same page again replaces its text rather than adding to the total
+    for length in (8, 4, 6):
+        cache.put(page("red"), SETTINGS, "r" * length)
+    assert cache.total_bytes == cache.size() == 16
+    assert cache.get(page("red"), SETTINGS) == "r" * 6 and cache.get(page("blue"), SETTINGS) == "b" * 10
+    cache.close()
@@ -0,0 +1,53 @@
+import json
+import time
+import os
+
+from mm_pdf.utils import shard_utils
+from mm_pdf.utils.shard_utils import ClaimQueue
+
+def owner(queue, name):
+    with open(queue.lock_path(name)) as f:
+        return json.load(f)["worker"]
+
+def test_stale_claim_taken_over(tmp_path):
+    a = ClaimQueue(str(tmp_path), "a", stale_after = 60)
+    b = ClaimQueue(str(tmp_path), "b", stale_after = 60)
+    assert a.claim("doc.pdf")
+    assert not b.claim("doc.pdf")
+    # Worker a died long ago
+    a.close()
+    os.utime(a.lock_path("doc.pdf"), (0, 0))
+    assert b.claim("doc.pdf")
+    assert owner(b, "doc.pdf") == "b"
+    assert os.listdir(tmp_path) == ["doc.pdf.lock"]
+    b.close()
+
+def test_fresh_claim_put_back(tmp_path, monkeypatch):
+    a = ClaimQueue(str(tmp_path), "a", stale_after = 60)
+    b = ClaimQueue(str(tmp_path), "b", stale_after = 60)
+    assert a.claim("doc.pdf")
+    # b saw an old claim that a has just replaced by the time b renames it
+    real_time = time.time
+    calls = []
+    def fake_time():
+        calls.append(None)
+        return real_time() + 3600 if len(calls) == 1 else real_time()
+    monkeypatch.setattr(shard_utils.time, "time", fake_time)
+    b.take_over(a.lock_path("doc.pdf"))
+    monkeypatch.undo()
+    assert owner(a, "doc.pdf") == "a"
+    assert os.listdir(tmp_path) == ["doc.pdf.lock"]
+    a.close()
+
+def test_held_claims_kept_fresh(tmp_path):
+    a = ClaimQueue(str(tmp_path), "a", stale_after = 0.5, refresh_every = 0.05)
+    b = ClaimQueue(str(tmp_path), "b", stale_after = 0.5)
+    assert a.claim("book.pdf")
+    time.sleep(1)
+    # Still being worked on, so not stale however long it takes
+    assert not b.claim("book.pdf")
+    a.finish("book.pdf")
+    time.sleep(1)
+    assert b.claim("book.pdf")
+    a.close()
+    b.close()
@@ -0,0 +1,105 @@
+import threading
+import socket
+import pytest
+import json
+import time
+
+from mm_pdf.daemon import PDFDaemon, DaemonClient
+from mm_pdf.pdf_processing import PDFProcessor
+from mm_pdf.utils.pdf_utils import load_pdf
+from benchmarks.synthetic import synthetic_pdf, stub_nougat
+
+def test_daemon(tmp_path):
+    paths = [str(tmp_path / "a.pdf"), str(tmp_path / "b.pdf")]
+    synthetic_pdf(paths[0], 5, seed = 1)
+    synthetic_pdf(paths[1], 3, seed = 2)
+    model, processor = stub_nougat()
+    pdf_processor = PDFProcessor(device = "cpu", batch_size = 4, model = model, processor = processor)
+    expected = [pdf_processor.call_nougat(load_pdf(path)) for path in paths]
+
+    socket_path = str(tmp_path / "nougat.sock")
+    # Long enough a wait that pages of both clients end up in the same batch
+    with PDFDaemon(pdf_processor, socket_path, max_wait = 1) as daemon:
+        client = DaemonClient(socket_path, timeout = 60)
+        results = {}
+        def transcribe(i, pdf):
+            results[i] = list(client.transcribe(pdf))
+        threads = [threading.Thread(target = transcribe, args = (0, paths[0])),
+                   threading.Thread(target = transcribe, args = (1, open(paths[1], "rb").read()))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        for i in range(2):
+            assert [page["page"] for page in results[i]] == list(range(len(expected[i])))
+            assert [page["text"] for page in results[i]] == expected[i]
+        assert daemon.stats()["mixed_batches"] >= 1
+
+        pages = list(client.transcribe(paths[0], first_page = 2, last_page = 4))
+        assert [page["text"] for page in pages] == expected[0][2:4]
+        with pytest.raises(RuntimeError, match = "missing.pdf"):
+            list(client.transcribe(str(tmp_path / "missing.pdf")))
+
+def test_daemon_failing_page(tmp_path):
+    path = str(tmp_path / "a.pdf")
+    synthetic_pdf(path, 3, seed = 1)
+    model, processor = stub_nougat()
+    pdf_processor = PDFProcessor(device = "cpu", batch_size = 4, model = model, processor = processor)
+    calls = []
+    def page_classifier(img, regions):
+        calls.append(img)
+        if len(calls) == 2:
+            raise ValueError("bad page")
+        return None
+    pdf_processor.page_classifier = page_classifier
+
+    socket_path = str(tmp_path / "nougat.sock")
+    with PDFDaemon(pdf_processor, socket_path, max_wait = 0.5):
+        client = DaemonClient(socket_path, timeout = 60)
+        with pytest.raises(RuntimeError, match = "bad page"):
+            list(client.transcribe(path))
+        # Only the request the page belonged to failed, the daemon is still decoding
+        assert [page["page"] for page in client.transcribe(path)] == [0, 1, 2]
+
+def test_daemon_client_disconnects(tmp_path):
+    paths = [str(tmp_path / "long.pdf"), str(tmp_path / "gone.pdf")]
+    synthetic_pdf(paths[0], 12, seed = 1)
+    synthetic_pdf(paths[1], 12, seed = 2)
+    model, processor = stub_nougat(step_seconds = 0.002)
+    pdf_processor = PDFProcessor(device = "cpu", batch_size = 2, model = model, processor = processor)
+    decoded = []
+    transcribe = pdf_processor.transcribe
+    def recording_transcribe(imgs):
+        decoded.extend(img.info["doc"] for img in imgs)
+        return transcribe(imgs)
+    pdf_processor.transcribe = recording_transcribe
+
+    socket_path = str(tmp_path / "nougat.sock")
+    with PDFDaemon(pdf_processor, socket_path, max_wait = 0.1) as daemon:
+        connections = []
+        submit = daemon.submit
+        def recording_submit(message, connection):
+            connections.append(connection)
+            return submit(message, connection)
+        daemon.submit = recording_submit
+
+        client = DaemonClient(socket_path, timeout = 60)
+        long_pages = []
+        thread = threading.Thread(target = lambda: long_pages.extend(client.transcribe(paths[0])))
+        thread.start()
+        deadline = time.monotonic() + 30
+        while not decoded and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+        # A client that hangs up once its request is accepted, while the queue is full of the other client's pages
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.connect(socket_path)
+            sock.sendall((json.dumps({"id" : "gone", "path" : paths[1]}) + "\n").encode())
+            assert json.loads(sock.makefile("rb").readline())["type"] == "accepted"
+        assert connections[1].requests[0].done.wait(timeout = 10)
+
+        thread.join()
+        # The other client is still served, and none of the pages of the one that went away are decoded
+        assert [page["page"] for page in long_pages] == list(range(12))
+        assert decoded.count(paths[0]) == 12 and paths[1] not in decoded
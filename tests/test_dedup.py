@@ -0,0 +1,74 @@
+import json
+
+import numpy as np
+from PIL import Image, ImageDraw
+
+from mm_pdf.pdf_processing import PDFProcessor
+from mm_pdf.utils.dedup_utils import PageDeduplicator, page_hash, hamming
+from mm_pdf.utils.pdf_utils import iter_pdf_pages
+from benchmarks.synthetic import synthetic_pdf, stub_nougat
+
+SETTINGS = {"model" : "nougat"}
+
+def page(seed, stamp = False):
+    """
+    A page of random blocks of ink, optionally with a small stamp in a corner like the arXiv id of another version
+    """
+    rng = np.random.default_rng(seed)
+    blocks = (rng.random((32, 24)) < 0.5).repeat(33, axis = 0).repeat(34, axis = 1)
+    img = Image.fromarray(np.where(blocks, 0, 255).astype(np.uint8)).convert("RGB")
+    if stamp:
+        ImageDraw.Draw(img).rectangle((0, 0, 140, 140), fill = "gray")
+    return img
+
+def test_near_duplicate_found(tmp_path):
+    dedup = PageDeduplicator(str(tmp_path / "dedup.sqlite"), threshold = 6)
+    h = dedup.hash(page(0))
+    dedup.add(h, SETTINGS, "Page text", "a.pdf", 3)
+    near = dedup.hash(page(0, stamp = True))
+    assert 0 < hamming(h, near) <= 6
+    text, page_id, distance = dedup.find(near, SETTINGS)
+    assert text == "Page text" and distance == hamming(h, near)
+    # Only under the same settings
+    assert dedup.find(near, {"model" : "other"}) is None
+    dedup.close()
+
+def test_distinct_page_missed(tmp_path):
+    dedup = PageDeduplicator(str(tmp_path / "dedup.sqlite"), threshold = 6)
+    dedup.add(dedup.hash(page(0)), SETTINGS, "Page text")
+    assert hamming(page_hash(page(0)), page_hash(page(1))) > 6
+    assert dedup.find(dedup.hash(page(1)), SETTINGS) is None
+    dedup.close()
+
+def test_blank_pages_never_deduplicated(tmp_path):
+    dedup = PageDeduplicator(str(tmp_path / "dedup.sqlite"), min_bits = 16)
+    blank = Image.new("RGB", (816, 1056), "white")
+    ImageDraw.Draw(blank).text((400, 1000), "12", fill = "black")
+    h = dedup.hash(blank)
+    assert not dedup.usable(h)
+    dedup.add(h, SETTINGS, "12")
+    assert dedup.find(h, SETTINGS) is None and dedup.stats()["indexed"] == 0
+    dedup.close()
+
+def test_reuse_reported(tmp_path):
+    pdf_path = str(tmp_path / "doc.pdf")
+    synthetic_pdf(pdf_path, 2, seed = 1, table_prob = 0, figure_prob = 0)
+    stats_path = str(tmp_path / "dedup.jsonl")
+    dedup = PageDeduplicator(str(tmp_path / "dedup.sqlite"), stats_path = stats_path)
+    model, processor = stub_nougat()
+    pdf_processor = PDFProcessor(device = "cpu", batch_size = 2, model = model, processor = processor, dedup = dedup)
+    first, second = iter_pdf_pages(pdf_path)
+    pdf_processor.transcribe([first])
+    # The same page again, as part of another document and next to a copy of itself
+    copy = first.copy()
+    copy.info.update(doc = "other.pdf", page = 7)
+    pdf_processor.transcribe([copy, second, copy.copy()])
+
+    # Written as they happen, not once the deduplicator is closed
+    with open(stats_path) as f:
+        entries = [json.loads(line) for line in f]
+    assert [(entry["doc"], entry["page"], entry["matched_doc"], entry["matched_page"]) for entry in entries] == [
+        ("other.pdf", 7, pdf_path, 0), ("other.pdf", 7, pdf_path, 0)
+    ]
+    assert dedup.stats()["reused"] == 2
+    dedup.close()
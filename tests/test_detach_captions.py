@@ -0,0 +1,39 @@
+import os
+import json
+
+from mm_pdf.utils.data_utils import DocumentManifest, DETACHED_MARKER
+from detach_captions import process_document
+
+def write_page(doc_path, manifest, page_idx):
+    with open(os.path.join(doc_path, f"{page_idx:08d}.txt"), "w") as f:
+        f.write(f"Text of page {page_idx}\nFigure {page_idx + 1}: A caption")
+    manifest.commit_page(page_idx)
+
+def test_partial_document(tmp_path):
+    doc_path = str(tmp_path / "doc")
+    os.makedirs(doc_path)
+    manifest = DocumentManifest(doc_path)
+    manifest.n_pages = 3
+    for page_idx in range(2):
+        write_page(doc_path, manifest, page_idx)
+    # Still being written, so left alone for a later run
+    assert process_document(doc_path) is None
+    assert not os.path.exists(os.path.join(doc_path, DETACHED_MARKER))
+
+    write_page(doc_path, manifest, 2)
+    manifest.mark_complete()
+    assert process_document(doc_path)
+    for page_idx in range(3):
+        with open(os.path.join(doc_path, f"{page_idx:08d}.txt")) as f:
+            assert f.read() == f"Text of page {page_idx}\n"
+        with open(os.path.join(doc_path, f"{page_idx:08d}-media.json")) as f:
+            assert json.load(f)["figures"] == [{"id" : page_idx + 1, "caption" : f"Figure {page_idx + 1}: A caption"}]
+    assert process_document(doc_path) is False
+
+def test_document_without_manifest(tmp_path):
+    doc_path = str(tmp_path / "doc")
+    os.makedirs(doc_path)
+    with open(os.path.join(doc_path, "00000000.txt"), "w") as f:
+        f.write("Text\nTable 1: A caption")
+    assert process_document(doc_path)
+    assert os.path.exists(os.path.join(doc_path, DETACHED_MARKER))
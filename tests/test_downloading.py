@@ -0,0 +1,128 @@
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import threading
+import time
+import os
+import pytest
+
+from mm_pdf.utils.downloading_utils import Downloader, InvalidPDFError, url_to_filename
+
+PDF_BYTES = b"%PDF-1.4\n" + bytes(range(256)) * 4096 + b"\n%%EOF\n"
+
+class Handler(BaseHTTPRequestHandler):
+    """
+    Serves a few paths that misbehave in different ways. Every request is logged on the server.
+    """
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        self.server.requests.append((self.path, self.headers.get("Range")))
+        n_requests = sum(path == self.path for path, _ in self.server.requests)
+
+        if self.path == "/flaky.pdf" and n_requests <= 2:
+            self.send_response(503)
+            self.end_headers()
+        elif self.path == "/missing.pdf":
+            self.send_response(404)
+            self.end_headers()
+        elif self.path == "/page.html":
+            self.send_body(b"<html>not a pdf</html>")
+        elif self.path == "/truncated.pdf" and n_requests == 1:
+            # Promise the whole file but hang up halfway through
+            self.send_response(200)
+            self.send_header("Content-Length", str(len(PDF_BYTES)))
+            self.send_header("ETag", '"v1"')
+            self.end_headers()
+            self.wfile.write(PDF_BYTES[:len(PDF_BYTES) // 2])
+            self.wfile.flush()
+            self.close_connection = True
+        else:
+            range_header = self.headers.get("Range")
+            if range_header and self.headers.get("If-Range") == '"v1"':
+                start = int(range_header[len("bytes="):-1])
+                self.send_body(PDF_BYTES[start:], status = 206)
+            else:
+                self.send_body(PDF_BYTES)
+
+    def send_body(self, body, status = 200):
+        self.send_response(status)
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("ETag", '"v1"')
+        self.end_headers()
+        self.wfile.write(body)
+
+@pytest.fixture
+def server():
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    httpd.requests = []
+    thread = threading.Thread(target = httpd.serve_forever, daemon = True)
+    thread.start()
+    yield httpd
+    httpd.shutdown()
+
+def url(server, path):
+    return f"http://127.0.0.1:{server.server_address[1]}{path}"
+
+def test_download(server, tmp_path):
+    downloader = Downloader(str(tmp_path), backoff = 0)
+    path = downloader.fetch(url(server, "/paper.pdf"))
+
+    assert open(path, "rb").read() == PDF_BYTES
+    assert os.listdir(tmp_path) == [url_to_filename(url(server, "/paper.pdf"))]
+
+    # Already present, so no second request
+    downloader.fetch(url(server, "/paper.pdf"))
+    assert len(server.requests) == 1
+
+def test_retries_with_backoff(server, tmp_path):
+    path = Downloader(str(tmp_path), backoff = 0).fetch(url(server, "/flaky.pdf"))
+    assert open(path, "rb").read() == PDF_BYTES
+    assert len(server.requests) == 3
+
+def test_gives_up(server, tmp_path):
+    with pytest.raises(Exception):
+        Downloader(str(tmp_path), backoff = 0).fetch(url(server, "/missing.pdf"))
+    assert len(server.requests) == 1 # 404 isn't worth retrying
+    assert os.listdir(tmp_path) == []
+
+def test_rejects_non_pdf(server, tmp_path):
+    with pytest.raises(InvalidPDFError):
+        Downloader(str(tmp_path), backoff = 0).fetch(url(server, "/page.html"))
+    assert os.listdir(tmp_path) == []
+
+def test_resumes_partial_download(server, tmp_path):
+    path = Downloader(str(tmp_path), backoff = 0).fetch(url(server, "/truncated.pdf"))
+
+    assert open(path, "rb").read() == PDF_BYTES
+    # Second request only asks for what the first one didn't deliver
+    assert server.requests[0][1] is None
+    resumed_from = int(server.requests[1][1][len("bytes="):-1])
+    assert 0 < resumed_from <= len(PDF_BYTES) // 2
+    assert not any(fname.endswith((".part", ".validator")) for fname in os.listdir(tmp_path))
+
+def test_download_all_streams_and_skips_failures(server, tmp_path):
+    urls = [url(server, f"/paper.pdf?{i}") for i in range(6)] + [url(server, "/page.html")]
+    paths = list(Downloader(str(tmp_path), backoff = 0, requests_per_second = 1000).download_all(urls))
+
+    assert len(paths) == 6
+    assert all(open(path, "rb").read() == PDF_BYTES for path in paths)
+
+def test_download_all_submits_before_yielding(server, tmp_path):
+    urls = [url(server, f"/paper.pdf?{i}") for i in range(4)]
+    with open(tmp_path / url_to_filename(urls[0]), "wb") as f:
+        f.write(PDF_BYTES)
+    paths = Downloader(str(tmp_path), backoff = 0, requests_per_second = 1000).download_all(urls)
+    assert next(paths) == os.path.join(str(tmp_path), url_to_filename(urls[0]))
+    # The rest download while the consumer is still busy with the cached paper
+    deadline = time.monotonic() + 10
+    while len(server.requests) < 3 and time.monotonic() < deadline:
+        time.sleep(0.05)
+    assert len(server.requests) == 3
+    assert len(list(paths)) == 3
+
+def test_rate_limit(server, tmp_path):
+    downloader = Downloader(str(tmp_path), requests_per_second = 10)
+    start = time.monotonic()
+    list(downloader.download_all([url(server, f"/paper.pdf?{i}") for i in range(4)]))
+    # First request goes out immediately, the next three are spaced by 0.1s
+    assert time.monotonic() - start >= 0.3
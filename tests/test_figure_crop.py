@@ -0,0 +1,86 @@
+import threading
+import json
+import os
+import numpy as np
+from PIL import Image
+
+from mm_pdf.pdf_processing import PDFProcessor
+from mm_pdf.utils.pdf_utils import FigureExtractor, PendingFigure, load_pdf, iter_pdf_pages, pdfium_lock
+from benchmarks.synthetic import synthetic_pdf, stub_nougat
+
+# The bar chart synthetic_pdf draws first on the first page, in PDF points from the top left corner
+FIGURE_BOX = (72, 88, 340, 248)
+
+def extractor_with_data(tmp_path, pdf_path, **kwargs) -> FigureExtractor:
+    """
+    FigureExtractor holding the data PDFFigures2 would save for the synthetic PDF, without running it
+    """
+    extractor = FigureExtractor(use_sbt = True, work_dir = str(tmp_path / "figures"), render = False, **kwargs)
+    name = extractor.doc_name(pdf_path)
+    box = dict(zip(("x1", "y1", "x2", "y2"), FIGURE_BOX))
+    caption = {"x1" : 72, "y1" : 258, "x2" : 400, "y2" : 270}
+    with open(os.path.join(extractor.figure_dir, name + ".json"), "w") as f:
+        json.dump([{"name" : "1", "figType" : "Figure", "page" : 0, "caption" : "Figure 1: ...",
+                    "regionBoundary" : box, "captionBoundary" : caption}], f)
+    extractor.extracted.add(name)
+    return extractor
+
+def test_crop(tmp_path):
+    path = str(tmp_path / "doc.pdf")
+    synthetic_pdf(path, 1, seed = 1, table_prob = 0, figure_prob = 1)
+    page = load_pdf(path)[0]
+    figure = PendingFigure(path, 0, FIGURE_BOX)
+    crop = figure.crop(page)
+    assert abs(crop.width - 268 * 96 / 72) <= 1 and abs(crop.height - 160 * 96 / 72) <= 1
+    assert (np.asarray(crop) < 200).any() # Holds the bars
+
+    # Rendered on its own when the page's resolution is too low
+    figure.dpi = 192
+    rendered = figure.crop(page)
+    assert abs(rendered.width - 268 * 192 / 72) <= 1 and abs(rendered.height - 160 * 192 / 72) <= 1
+
+def test_process_crops_figures(tmp_path):
+    path = str(tmp_path / "doc.pdf")
+    synthetic_pdf(path, 2, seed = 1, table_prob = 0, figure_prob = 1)
+    extractor = extractor_with_data(tmp_path, path)
+    registry = extractor(path)
+    assert isinstance(registry.entries[0].image, PendingFigure)
+    assert registry.regions(0) == [FIGURE_BOX, (72, 258, 400, 270)]
+
+    model, processor = stub_nougat()
+    pdf_processor = PDFProcessor(device = "cpu", model = model, processor = processor, figure_extractor = extractor)
+    pdf_obj = pdf_processor.process(load_pdf(path), registry)
+    assert pdf_obj.pages[0].image_identifiers == ["figure1"]
+    assert abs(pdf_obj.pages[0].images[0].width - 268 * 96 / 72) <= 1
+
+def test_rendered_figures_get_their_data(tmp_path):
+    path = str(tmp_path / "doc.pdf")
+    synthetic_pdf(path, 1, seed = 1, table_prob = 0, figure_prob = 1)
+    extractor = FigureExtractor(use_sbt = True, work_dir = str(tmp_path / "figures"))
+    name = extractor.doc_name(path)
+    png_path = os.path.join(extractor.figure_dir, f"{name}-Figure1-1.png")
+    Image.new("RGB", (20, 10), "red").save(png_path)
+    box = dict(zip(("x1", "y1", "x2", "y2"), FIGURE_BOX))
+    with open(os.path.join(extractor.figure_dir, name + ".json"), "w") as f:
+        # The table wasn't rendered, so there is no image for it
+        json.dump([{"name" : "1", "figType" : "Figure", "page" : 0, "regionBoundary" : box, "renderURL" : png_path},
+                   {"name" : "1", "figType" : "Table", "page" : 0, "regionBoundary" : box}], f)
+    extractor.extracted.add(name)
+
+    registry = extractor(path)
+    assert [(entry.label, entry.page, entry.image.size) for entry in registry.entries] == [("figure1", 0, (20, 10))]
+    assert registry.regions(0) == [FIGURE_BOX]
+    assert os.listdir(extractor.figure_dir) == []
+
+def test_rendering_shares_pdfium_lock(tmp_path):
+    path = str(tmp_path / "doc.pdf")
+    synthetic_pdf(path, 2, seed = 1, table_prob = 0, figure_prob = 1)
+    pages = []
+    # Figures being cropped or rendered in another thread hold the lock
+    with pdfium_lock:
+        thread = threading.Thread(target = lambda: pages.extend(iter_pdf_pages(path)))
+        thread.start()
+        thread.join(0.5)
+        assert thread.is_alive() and not pages
+    thread.join()
+    assert len(pages) == 2
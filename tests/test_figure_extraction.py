@@ -0,0 +1,52 @@
+import os
+
+from mm_pdf.pdf_processing import PDFProcessor
+from mm_pdf.pipeline import WritePipeline
+from mm_pdf.utils.pdf_utils import FigureExtractor
+from benchmarks.synthetic import synthetic_pdf, stub_nougat
+
+class RecordingExtractor(FigureExtractor):
+    """
+    Records the documents of every PDFFigures2 run, which finds no figures, instead of running it
+    """
+    def __init__(self, tmp_path):
+        super().__init__(use_sbt = True, work_dir = str(tmp_path / "figures"), render = False)
+        self.runs = []
+
+    def run_batch(self, input_dir : str):
+        names = sorted(fname[:-len(".pdf")] for fname in os.listdir(input_dir))
+        for name in names:
+            with open(os.path.join(self.figure_dir, name + ".json"), "w") as f:
+                f.write("[]")
+        self.runs.append(names)
+
+def make_pdfs(tmp_path, n : int):
+    paths = []
+    for i in range(n):
+        paths.append(str(tmp_path / f"doc{i}.pdf"))
+        synthetic_pdf(paths[-1], 2, seed = i, table_prob = 0, figure_prob = 0)
+    return paths
+
+def test_one_run_per_batch(tmp_path):
+    paths = make_pdfs(tmp_path, 3)
+    extractor = RecordingExtractor(tmp_path)
+    extractor.extract(paths)
+    assert extractor.runs == [sorted(extractor.doc_name(path) for path in paths)]
+
+    # Documents of the batch are read from its output, only new ones are extracted
+    for path in paths:
+        assert len(extractor(path).entries) == 0
+    extractor.extract(paths[:2] + [str(tmp_path / "doc0.pdf")])
+    assert len(extractor.runs) == 2 and extractor.runs[1] == sorted(extractor.doc_name(path) for path in paths[:2])
+    assert extractor.extracted == set(extractor.runs[1])
+
+def test_pipeline_batches_figures(tmp_path):
+    paths = make_pdfs(tmp_path, 5)
+    extractor = RecordingExtractor(tmp_path)
+    model, processor = stub_nougat()
+    pdf_processor = PDFProcessor(device = "cpu", batch_size = 2, model = model, processor = processor, figure_extractor = extractor)
+    pipeline = WritePipeline(pdf_processor, chunk_size = 1, figure_batch_size = 4, rasterize_workers = 1, writer_workers = 1)
+    pipeline([(path, str(tmp_path / "out" / os.path.basename(path)[:-4])) for path in paths])
+    # Ranges of a document count towards the batch size but the document is only extracted once
+    assert [len(run) for run in extractor.runs] == [2, 2, 1]
+    assert sorted(name for run in extractor.runs for name in run) == sorted(extractor.doc_name(path) for path in paths)
@@ -0,0 +1,92 @@
+from PIL import Image
+
+from mm_pdf.utils.figure_utils import FigureRegistry, normalize_label, strip_decimal, page_identifier
+from mm_pdf.utils.data_utils import PDFPage, FolderSink
+from mm_pdf.pdf_processing import soft_extract_from_dict
+import read_dataset
+import read_dataset_2
+
+def registry(*figures):
+    reg = FigureRegistry()
+    for label, page in figures:
+        reg.add(label, label, page) # Use the label as the image so matches are easy to check
+    return reg
+
+def test_labels():
+    assert normalize_label("Figure 01.2:") == "figure1.2"
+    assert normalize_label("table10") == "table10"
+    assert strip_decimal("figure1.2") == "figure2"
+    assert strip_decimal("tablea.3") == "table3"
+    assert strip_decimal("figure2") is None
+
+def test_exact_match_wins_over_decimal():
+    reg = registry(("figure1.2", 0), ("figure2", 5))
+    assert reg.take("figure2", 0).label == "figure2"
+    # figure2 is used up, so the next figure2 read by Nougat is taken to be a misread figure1.2
+    assert reg.take("figure2", 0).label == "figure1.2"
+    assert reg.take("figure2", 0) is None
+
+def test_decimal_label_matched():
+    reg = registry(("figure1.2", 3))
+    assert reg.take_all(["figure2"], 3) == (["figure2"], ["figure1.2"])
+    assert len(reg) == 0
+
+def test_collisions_resolved_by_page():
+    reg = registry(("figure1.2", 3), ("figure2.2", 20), ("figure3.2", 41))
+    assert reg.take("figure2", 40).label == "figure3.2"
+    assert reg.take("figure2", 4).label == "figure1.2"
+    assert reg.take("figure2", 0).label == "figure2.2"
+
+def test_ties_are_deterministic():
+    # Equally far from page 5, the earlier page wins regardless of the order they were added in
+    for figures in [(("figure1.2", 3), ("figure2.2", 7)), (("figure2.2", 7), ("figure1.2", 3))]:
+        assert registry(*figures).take("figure2", 5).label == "figure1.2"
+    # Known pages win over unknown ones
+    assert registry(("figure1.2", None), ("figure2.2", 50)).take("figure2", 0).label == "figure2.2"
+
+def test_repeated_identifier_matched_once():
+    reg = registry(("figure2", 1), ("figure1.2", 1))
+    assert reg.take_all(["figure2", "figure2"], 1) == (["figure2"], ["figure2"])
+    assert reg.remaining() == {"figure1.2" : "figure1.2"}
+
+def test_figures_by_page():
+    reg = registry(("figure1", 1), ("figure2", 3), ("table1", 1))
+    assert [entry.label for entry in reg.on_page(1)] == ["figure1", "table1"]
+    assert reg.on_page(2) == []
+    # Figures taken by a lookup are still on their page, but no longer handed out for it
+    reg.take("figure1", 1)
+    assert len(reg.on_page(1)) == 2
+    assert reg.take_page(1) == (["table1"], ["table1"])
+
+def test_page_identifier():
+    assert page_identifier("Figure 1.2") == "figure2"
+    assert page_identifier("Table 3") == "table3"
+    # Taken identifiers aren't renumbered into one that could be another figures caption
+    assert page_identifier("Figure 3.2", ["figure2"]) == "figure3.2"
+    assert page_identifier("Figure 3", ["figure3"]) == "figure3-2"
+    assert page_identifier("Figure 3", ["figure3", "figure3-2"]) == "figure3-3"
+    assert page_identifier("Table A") == "tablea"
+
+def test_figure_only_page_round_trip(tmp_path):
+    reg = FigureRegistry()
+    reg.add("Figure1.2", Image.new("RGB", (20, 20), "red"), 5)
+    reg.add("Figure3.2", Image.new("RGB", (20, 20), "blue"), 5)
+    reg.add("TableA", Image.new("RGB", (20, 20), "green"), 5)
+    img_ids, imgs = reg.take_page(5)
+    assert img_ids == ["figure2", "figure3.2", "tablea"]
+
+    sink = FolderSink(str(tmp_path / "doc"), first_page = 5)
+    sink.add(PDFPage("", img_ids, imgs, route = "figure_only"))
+    sink.add(PDFPage("Text.\n\nFigure 2: A plot of the results.\n\nFigure 3: A different figure.", [], []))
+    pages = list(read_dataset.iter_dataset(str(tmp_path), by_page = True))
+    assert [page["page"] for page in pages] == [5, 6]
+    # The caption on the next page finds the figure of the figure only page, and Figure 3 isn't given figure3.2
+    assert [(page_num, caption) for page_num, caption, _ in pages[1]["figure"]] == [(6, "Figure 2: A plot of the results.\n\n")]
+    assert pages[1]["figure"][0][2].load().getpixel((0, 0)) == (255, 0, 0)
+    # Neither reader trips over figures saved under their label
+    assert [len(page["figure"]) for page in read_dataset_2.iter_dataset(str(tmp_path), by_page = True)] == [0, 0]
+
+def test_soft_extract_from_dict():
+    d = {"figure1.2" : "a", "table1" : "b", "Figure3" : "c"}
+    assert soft_extract_from_dict(d, ["figure2", "table1", "figure3", "figure9"]) == (["figure2", "table1", "figure3"], ["a", "b", "c"])
+    assert d == {}
@@ -0,0 +1,42 @@
+import torch
+from PIL import Image, ImageDraw
+
+from mm_pdf.utils.generation_utils import RepetitionStoppingCriteria, estimate_token_budget, MIN_TOKEN_BUDGET
+
+def looping(prefix_length, unit, length):
+    prefix = list(range(100, 100 + prefix_length))
+    return prefix + [unit[i % len(unit)] for i in range(length - prefix_length)]
+
+def test_stops_loops_only():
+    stopper = RepetitionStoppingCriteria(check_every = 1)
+    normal = list(range(1000, 1512))
+    loop = looping(200, [7, 8, 9, 10, 11], 512)
+    stop = stopper(torch.tensor([normal, loop]), None)
+    assert stop.tolist() == [False, True]
+    assert stopper.stopped.tolist() == [False, True]
+
+def test_short_repetition_kept():
+    # A short run, like the rule under a table header, isn't a loop
+    stopper = RepetitionStoppingCriteria(check_every = 1)
+    ids = list(range(1000, 1400)) + [5] * 50
+    assert not stopper(torch.tensor([ids]), None).any()
+
+def test_trim_keeps_one_copy():
+    stopper = RepetitionStoppingCriteria()
+    unit = [7, 8, 9, 10, 11]
+    ids = torch.tensor(looping(200, unit, 600) + [1, 1, 1])
+    trimmed = stopper.trim(ids, pad_token_id = 1)
+    assert trimmed.tolist() == looping(200, unit, 205)
+    normal = torch.tensor(list(range(1000, 1600)))
+    assert stopper.trim(normal).tolist() == normal.tolist()
+
+def test_token_budget():
+    assert estimate_token_budget(Image.new("RGB", (816, 1056), "white"), 20000) == MIN_TOKEN_BUDGET
+    assert estimate_token_budget(Image.new("RGB", (816, 1056), "white"), 20000, n_chars = 3000) == 3000
+    assert estimate_token_budget(Image.new("RGB", (816, 1056), "white"), 2000, n_chars = 3000) == 2000
+
+    page = Image.new("RGB", (816, 1056), "white")
+    draw = ImageDraw.Draw(page)
+    for line in range(60):
+        draw.rectangle((60, 40 + line * 16, 760, 48 + line * 16), fill = "black")
+    assert estimate_token_budget(page, 20000) > MIN_TOKEN_BUDGET
@@ -0,0 +1,89 @@
+import os
+import time
+import sqlite3
+
+import pytest
+from PIL import Image
+
+from mm_pdf.utils.data_utils import PDFPage
+from mm_pdf.utils.index_utils import DatasetIndex, merge_index_fragments, INDEX_FILENAME
+from mm_pdf.utils.packed_utils import ShardWriter
+import read_dataset
+from read_dataset import read_page
+
+def write_doc(ds_path, doc_id, text):
+    os.makedirs(os.path.join(ds_path, doc_id), exist_ok = True)
+    with open(os.path.join(ds_path, doc_id, "00000000.txt"), "w") as f:
+        f.write(text)
+
+def test_merge_fragments(tmp_path):
+    ds_path = str(tmp_path)
+    for worker, docs in (("a", ["doc1", "doc2"]), ("b", ["doc2", "doc3"])):
+        index = DatasetIndex(ds_path, worker)
+        for doc_id in docs:
+            write_doc(ds_path, doc_id, f"{doc_id} by {worker}")
+            index.add_folder(doc_id)
+        index.close()
+        time.sleep(0.01) # Fragment b is the newer one
+    # Workers never touch the index of the dataset itself
+    assert not os.path.exists(os.path.join(ds_path, INDEX_FILENAME))
+
+    assert merge_index_fragments(ds_path) == {"docs" : 3, "pages" : 3, "figures" : 0, "tables" : 0}
+    assert read_page(ds_path, "doc2", 0)["text"] == "doc2 by b"
+    # Merging again changes nothing
+    assert merge_index_fragments(ds_path)["docs"] == 3
+
+def test_shard_rows(tmp_path):
+    ds_path = str(tmp_path)
+    index = DatasetIndex(ds_path)
+    writer = ShardWriter(ds_path, shard_size = 2**12, index = index)
+    # A name long enough to need an extended header
+    for doc_id in ("doc", "d" * 120):
+        for page_idx in range(3):
+            page = PDFPage(f"page {page_idx} of {doc_id}", ["figure1"], [Image.new("RGB", (40, 30), "red")])
+            writer.write_page(page, doc_id, page_idx)
+    writer.flush()
+    rows = lambda: index.conn.execute("SELECT * FROM files ORDER BY doc, name").fetchall()
+    written = rows()
+    assert len(written) == 2 * 3 * 2 # Text and figure of every page
+    # The rows collected while writing are the ones read back from the closed shards
+    index.rebuild()
+    assert rows() == written
+    assert read_page(ds_path, "d" * 120, 2)["text"] == "page 2 of " + "d" * 120
+    index.close()
+
+def test_media_with_and_without_index(tmp_path, monkeypatch):
+    ds_path = str(tmp_path)
+    write_doc(ds_path, "doc1", "Text")
+    files = {
+        # Caption on the page after its figure
+        "00000000-figure1.png" : None, "00000001.txt" : "More text.\n\nFigure 1: Results.",
+        "00000002-figure2.png" : None, "00000002.txt" : "Figure 2: A plot.",
+    }
+    for name, text in files.items():
+        path = os.path.join(ds_path, "doc1", name)
+        if text is None:
+            Image.new("RGB", (10, 10), "red").save(path)
+        else:
+            with open(path, "w") as f:
+                f.write(text)
+    write_doc(ds_path, "doc2", "No figures")
+
+    media = lambda: [(doc, page, caption) for doc, page, caption, _ in read_dataset.iter_media(ds_path)]
+    without_index = media()
+    assert without_index == [("doc1", 1, "Figure 1: Results."), ("doc1", 2, "Figure 2: A plot.")]
+    DatasetIndex(ds_path).rebuild()
+
+    connections = []
+    real_connect = sqlite3.connect
+    def connect(*args, **kwargs):
+        connections.append(real_connect(*args, **kwargs))
+        return connections[-1]
+    monkeypatch.setattr(read_dataset.sqlite3, "connect", connect)
+    assert media() == without_index
+    assert read_page(ds_path, "doc1", 2)["figure"][0][1] == "Figure 2: A plot."
+    # One connection per call, and none left open
+    assert len(connections) == 2
+    for connection in connections:
+        with pytest.raises(sqlite3.ProgrammingError):
+            connection.execute("SELECT 1")
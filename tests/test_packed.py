@@ -0,0 +1,48 @@
+import os
+
+import pytest
+from PIL import Image
+
+from mm_pdf.utils.data_utils import PDFPage, DocumentManifest
+from mm_pdf.utils.index_utils import DatasetIndex
+from mm_pdf.utils.packed_utils import ShardWriter
+
+def write_pages(writer, manifest, pages):
+    for page_idx in pages:
+        page = PDFPage(f"Page {page_idx}", ["figure1"], [Image.new("RGB", (40, 30), "red")])
+        writer.write_page(page, "doc", page_idx, manifest)
+
+def test_commit_after_crash(tmp_path, monkeypatch):
+    ds_path = str(tmp_path)
+    manifest = DocumentManifest(str(tmp_path / ".docs" / "doc"))
+    manifest.n_pages = 4
+    writer = ShardWriter(ds_path, shard_size = 2**12, prefix = "w0", index = DatasetIndex(ds_path))
+    # The writer dies between moving a shard into place and committing its pages
+    def crash(*args):
+        raise KeyboardInterrupt
+    monkeypatch.setattr(writer, "commit_shard", crash)
+    with pytest.raises(KeyboardInterrupt):
+        write_pages(writer, manifest, range(4))
+    shards = sorted(fname for fname in os.listdir(ds_path) if fname.endswith(".tar"))
+    assert shards == ["w0-000000.tar"]
+    assert DocumentManifest(manifest.path).pages_done == set()
+
+    # The next writer commits them instead of the pages being written into a second shard
+    index = DatasetIndex(ds_path)
+    ShardWriter(ds_path, shard_size = 2**12, prefix = "w0", index = index)
+    resumed = DocumentManifest(manifest.path)
+    assert resumed.pages_done and not os.path.exists(os.path.join(ds_path, "w0-000000.tar.pending"))
+    assert index.stats()["pages"] == len(resumed.pages_done)
+
+def test_uncommitted_shard_dropped(tmp_path):
+    ds_path = str(tmp_path)
+    manifest = DocumentManifest(str(tmp_path / ".docs" / "doc"))
+    writer = ShardWriter(ds_path, shard_size = 2**30, prefix = "w0")
+    write_pages(writer, manifest, range(2))
+    # Died before the shard was moved into place, its pages get written again
+    writer.tar.close()
+    with open(os.path.join(ds_path, "w0-000000.tar.pending"), "w") as f:
+        f.write("{}")
+    ShardWriter(ds_path, prefix = "w0")
+    assert os.listdir(ds_path) == ["w0-000000.tar.tmp"]
+    assert DocumentManifest(manifest.path).pages_done == set()
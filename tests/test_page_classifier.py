@@ -0,0 +1,59 @@
+from PIL import Image, ImageDraw
+
+from mm_pdf.utils.page_classifier import PageClassifier
+from mm_pdf.utils.figure_utils import FigureRegistry
+
+SIZE = (816, 1056) # Letter at 96 dpi
+
+def page(text_lines = 0, figure = None, page_number = True):
+    img = Image.new("RGB", SIZE, "white")
+    draw = ImageDraw.Draw(img)
+    for line in range(text_lines):
+        draw.rectangle((96, 96 + line * 18, 720, 106 + line * 18), fill = "black")
+    if figure is not None:
+        draw.rectangle(figure, outline = "black", width = 3)
+        draw.line(figure, fill = "black", width = 3)
+    if page_number:
+        draw.rectangle((400, 1000, 416, 1010), fill = "black")
+    return img
+
+def test_blank():
+    classifier = PageClassifier()
+    assert classifier(page()) == "blank"
+    assert classifier(page(page_number = False)) == "blank"
+    assert classifier.stats() == {"pages" : 2, "routes" : {"blank" : 2}}
+
+def test_text_is_read():
+    classifier = PageClassifier()
+    assert classifier(page(text_lines = 40)) is None
+    # Text around a figure is still read, whether the figure region is known or not
+    assert classifier(page(text_lines = 20, figure = (96, 500, 720, 900))) is None
+    assert classifier(page(text_lines = 20, figure = (96, 500, 720, 900)), [(72, 375, 540, 675)]) is None
+
+def test_figure_only():
+    classifier = PageClassifier()
+    assert classifier(page(figure = (96, 96, 720, 900))) == "figure_only"
+    # A caption and the page number outside of the figure region are fine
+    img = page(text_lines = 2, figure = (96, 200, 720, 900))
+    assert classifier(img, [(72, 150, 540, 675), (72, 60, 540, 90)]) == "figure_only"
+    # Or a single line of text along with the page number, but no more
+    assert classifier(page(text_lines = 1, figure = (96, 200, 720, 900)), [(72, 150, 540, 675)]) == "figure_only"
+    assert classifier(img, [(72, 150, 540, 675)]) is None
+
+def test_text_beside_figure():
+    classifier = PageClassifier()
+    img = page(figure = (96, 200, 400, 900))
+    # A paragraph next to the figure whose lines run together into a single block of ink
+    ImageDraw.Draw(img).rectangle((450, 200, 720, 400), fill = "black")
+    assert classifier(img, [(72, 150, 300, 675)]) is None
+    assert classifier(page(figure = (96, 200, 400, 900)), [(72, 150, 300, 675)]) == "figure_only"
+
+def test_take_page():
+    registry = FigureRegistry()
+    registry.add("figure1", "a", 2, [(0, 0, 10, 10)])
+    registry.add("figure2", "b", 2, [(0, 20, 10, 30)])
+    registry.add("figure3", "c", 3)
+    assert registry.take("figure2", 2).label == "figure2"
+    assert registry.regions(2) == [(0, 0, 10, 10), (0, 20, 10, 30)]
+    assert registry.take_page(2) == (["figure1"], ["a"])
+    assert registry.take_page(2) == ([], [])
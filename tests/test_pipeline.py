@@ -0,0 +1,179 @@
+import threading
+import pytest
+import os
+
+from mm_pdf.pdf_processing import PDFProcessor
+from mm_pdf.pipeline import WritePipeline
+from mm_pdf.utils.data_utils import DocumentManifest, FolderSink, atomic_write
+from mm_pdf.utils.pdf_utils import FigureExtractor, load_pdf
+from benchmarks.synthetic import synthetic_pdf, stub_nougat
+
+def make_pipeline(**kwargs) -> WritePipeline:
+    model, processor = stub_nougat()
+    pdf_processor = PDFProcessor(device = "cpu", batch_size = 2, model = model, processor = processor)
+    return WritePipeline(pdf_processor, rasterize_workers = 1, writer_workers = 1, ignore_images = True, **kwargs)
+
+def test_page_ranges(tmp_path):
+    pdf_path = str(tmp_path / "book.pdf")
+    synthetic_pdf(pdf_path, 5, seed = 2, table_prob = 0, figure_prob = 0)
+    output_dir = str(tmp_path / "book")
+    pipeline = make_pipeline(chunk_size = 2)
+
+    items = pipeline.split(pdf_path, output_dir)
+    assert [(item.pdf_path, item.first_page, item.last_page) for item in items] == [(pdf_path, 0, 2), (pdf_path, 2, 4), (pdf_path, 4, 5)]
+    assert [item.is_first for item in items] == [True, False, False]
+
+    pipeline([(pdf_path, output_dir)])
+    manifest = DocumentManifest(output_dir)
+    assert manifest.complete and manifest.pages_done == set(range(5))
+    # Pages are numbered within the whole document, not within their range
+    for page_idx, page in enumerate(load_pdf(pdf_path)):
+        with open(os.path.join(output_dir, f"{page_idx:08d}.txt")) as f:
+            assert f.read().split() == page.info["text"].split()
+
+def test_page_ranges_resume(tmp_path):
+    pdf_path = str(tmp_path / "book.pdf")
+    synthetic_pdf(pdf_path, 5, seed = 2, table_prob = 0, figure_prob = 0)
+    output_dir = str(tmp_path / "book")
+    manifest = DocumentManifest(output_dir)
+    manifest.n_pages = 5
+    for page_idx in (0, 1, 3):
+        manifest.commit_page(page_idx)
+
+    items = make_pipeline(chunk_size = 2).split(pdf_path, output_dir)
+    # The first range is done and only the unwritten page of the second is redone
+    assert [(item.first_page, item.last_page) for item in items] == [(2, 3), (4, 5)]
+    assert items[0].is_first
+
+def test_resume_skips_committed_pages(tmp_path):
+    pdf_path = str(tmp_path / "book.pdf")
+    synthetic_pdf(pdf_path, 5, seed = 2, table_prob = 0, figure_prob = 0)
+    output_dir = str(tmp_path / "book")
+    os.makedirs(output_dir)
+    manifest = DocumentManifest(output_dir)
+    manifest.n_pages = 5
+    for page_idx in (0, 1, 3):
+        atomic_write(os.path.join(output_dir, f"{page_idx:08d}.txt"), b"written before")
+        manifest.commit_page(page_idx)
+
+    pipeline = make_pipeline(chunk_size = 2)
+    pipeline([(pdf_path, output_dir)])
+    # Only the pages the first run didn't commit are decoded
+    assert len(pipeline.pdf_processor.processor.sequences) == 2
+    for page_idx, page in enumerate(load_pdf(pdf_path)):
+        with open(os.path.join(output_dir, f"{page_idx:08d}.txt")) as f:
+            text = f.read()
+        if page_idx in (0, 1, 3):
+            assert text == "written before"
+        else:
+            assert text.split() == page.info["text"].split()
+    assert DocumentManifest(output_dir).complete
+
+def test_atomic_write(tmp_path, monkeypatch):
+    path = str(tmp_path / "page.txt")
+    atomic_write(path, b"old")
+    def crash(fd):
+        raise OSError("crashed")
+    monkeypatch.setattr(os, "fsync", crash)
+    with pytest.raises(OSError):
+        atomic_write(path, b"new")
+    # A write that doesn't finish leaves the old contents in place
+    with open(path, "rb") as f:
+        assert f.read() == b"old"
+    monkeypatch.undo()
+    atomic_write(path, b"new")
+    with open(path, "rb") as f:
+        assert f.read() == b"new"
+
+def test_folder_sink(tmp_path):
+    pdf_path = str(tmp_path / "doc.pdf")
+    synthetic_pdf(pdf_path, 3, seed = 3, table_prob = 0, figure_prob = 0)
+    output_dir = str(tmp_path / "doc")
+    written = []
+    sink = FolderSink(output_dir, on_commit = lambda manifest: written.append(sorted(manifest.pages_done)))
+
+    model, processor = stub_nougat()
+    pdf_processor = PDFProcessor(device = "cpu", batch_size = 2, model = model, processor = processor)
+    assert pdf_processor(pdf_path, ignore_images = True, first_page = 1, sink = sink) is sink
+    # Every page is written as soon as it is done rather than once the document is
+    assert written == [[1], [1, 2]]
+    assert sink.n_pages == 2 and sink.routes == {"nougat" : 2} and not hasattr(sink, "pages")
+    assert sorted(fname for fname in os.listdir(output_dir) if fname.endswith(".txt")) == ["00000001.txt", "00000002.txt"]
+
+def test_save_range(tmp_path):
+    pdf_path = str(tmp_path / "doc.pdf")
+    synthetic_pdf(pdf_path, 4, seed = 3, table_prob = 0, figure_prob = 0)
+    output_dir = str(tmp_path / "doc")
+    model, processor = stub_nougat()
+    pdf_processor = PDFProcessor(device = "cpu", batch_size = 2, model = model, processor = processor)
+    # A range saved on its own keeps the page ids of the whole document
+    pdf_processor(pdf_path, ignore_images = True, first_page = 2).save(output_dir)
+    assert sorted(fname for fname in os.listdir(output_dir) if fname.endswith(".txt")) == ["00000002.txt", "00000003.txt"]
+    assert DocumentManifest(output_dir).pages_done == {2, 3} and not DocumentManifest(output_dir).complete
+    # Saving the rest of the document completes it
+    pdf_processor(pdf_path, ignore_images = True, last_page = 2).save(output_dir, complete = True)
+    manifest = DocumentManifest(output_dir)
+    assert manifest.complete and manifest.n_pages == 4 and manifest.pages_done == {0, 1, 2, 3}
+
+def test_manifest_journal(tmp_path):
+    output_dir = str(tmp_path / "doc")
+    manifest = DocumentManifest(output_dir)
+    manifest.n_pages = 10
+    for page_idx in range(7):
+        manifest.commit_page(page_idx, truncated = page_idx == 5, route = "nougat")
+    # Pages 5 and 6 are only in the journal, and an interrupted append left half a line behind
+    with open(os.path.join(output_dir, DocumentManifest.journal_filename), "a") as f:
+        f.write('{"page": 7, "trunc')
+    resumed = DocumentManifest(output_dir)
+    assert resumed.n_pages == 10 and resumed.pages_done == set(range(7)) and resumed.truncated == {5}
+    assert resumed.routes == {page_idx : "nougat" for page_idx in range(7)} and not resumed.all_done()
+
+    for page_idx in range(7, 10):
+        resumed.commit_page(page_idx)
+    assert resumed.all_done()
+    resumed.mark_complete()
+    assert sorted(os.listdir(output_dir)) == ["manifest.json"]
+    assert DocumentManifest(output_dir).complete
+
+def test_stages_overlap(tmp_path):
+    paths = []
+    for i in range(3):
+        paths.append(str(tmp_path / f"doc{i}.pdf"))
+        synthetic_pdf(paths[-1], 2, seed = i, table_prob = 0, figure_prob = 0)
+    extracted = threading.Event()
+    class Extractor(FigureExtractor):
+        def run_batch(self, input_dir):
+            for fname in os.listdir(input_dir):
+                with open(os.path.join(self.figure_dir, fname[:-len(".pdf")] + ".json"), "w") as f:
+                    f.write("[]")
+            if self.doc_name(paths[-1]) + ".pdf" in os.listdir(input_dir):
+                extracted.set()
+
+    model, processor = stub_nougat()
+    generate = model.generate
+    overlapped = []
+    inference_thread = []
+    def waiting_generate(*args, **kwargs):
+        if not overlapped:
+            inference_thread.append(threading.get_ident())
+            # Figures of the last document are extracted while the first one is still being decoded
+            overlapped.append(extracted.wait(timeout = 30))
+        return generate(*args, **kwargs)
+    model.generate = waiting_generate
+
+    extractor = Extractor(use_sbt = True, work_dir = str(tmp_path / "figures"), render = False)
+    pdf_processor = PDFProcessor(device = "cpu", batch_size = 2, model = model, processor = processor, figure_extractor = extractor)
+    pipeline = WritePipeline(pdf_processor, figure_batch_size = 1, rasterize_workers = 1, writer_workers = 1)
+    saved = []
+    save = pipeline.save
+    def recording_save(sink, doc, page_idx, page):
+        saved.append(threading.get_ident())
+        save(sink, doc, page_idx, page)
+    pipeline.save = recording_save
+
+    pipeline([(path, str(tmp_path / "out" / f"doc{i}")) for i, path in enumerate(paths)])
+    assert overlapped == [True]
+    # Pages are written by the writer threads, not by the thread running inference
+    assert len(saved) == 6 and inference_thread[0] not in saved
+    for i in range(3):
+        assert DocumentManifest(str(tmp_path / "out" / f"doc{i}")).complete
@@ -0,0 +1,22 @@
+from mm_pdf.pdf_processing import PDFProcessor
+from mm_pdf.replica_pool import ReplicaPool, split_cores
+from mm_pdf.utils.figure_utils import FigureRegistry
+from mm_pdf.utils.pdf_utils import load_pdf
+from benchmarks.synthetic import synthetic_pdf, stub_nougat
+
+def test_split_cores():
+    assert split_cores(list(range(8)), 3) == [[0, 1, 2], [3, 4, 5], [6, 7]]
+    assert split_cores([0, 1], 3) == [[0], [1], [0]]
+
+def test_replicas_match_in_process(tmp_path):
+    path = str(tmp_path / "doc.pdf")
+    synthetic_pdf(path, 7, seed = 3)
+    pages = load_pdf(path)
+    model, processor = stub_nougat()
+    pdf_processor = PDFProcessor(device = "cpu", batch_size = 2, model = model, processor = processor)
+    expected = pdf_processor.call_nougat(pages)
+
+    with ReplicaPool(pdf_processor, 2) as pool:
+        pdf_processor.replicas = pool
+        pdf_obj = pdf_processor.process(pages, FigureRegistry())
+    assert [page.text for page in pdf_obj.pages] == expected
@@ -0,0 +1,34 @@
+import textwrap
+
+from mm_pdf.utils.routing_utils import TextLayerRouter, text_layer_to_markdown
+
+PARAGRAPH = ("Most of the documents in the corpus are born digital, and the text layer of a page of plain prose holds "
+             "everything that would be read from it. Reading it directly is far cheaper than running the model. ") * 4
+
+def page(*paragraphs):
+    return "\r\n".join(line for paragraph in paragraphs for line in textwrap.wrap(paragraph, 90))
+
+def test_prose_routed():
+    router = TextLayerRouter()
+    assert router.reason(page(PARAGRAPH, PARAGRAPH)) is None
+    assert router(page(PARAGRAPH, PARAGRAPH)) is not None
+    assert router.stats() == {"pages" : 1, "routes" : {"text_layer" : 1}}
+
+def test_hard_pages():
+    router = TextLayerRouter()
+    assert router.reason(None) == "too_little_text"
+    assert router.reason("Chapter 3") == "too_little_text"
+    assert router.reason(page(PARAGRAPH, "where α ≤ 1 holds for every x.", PARAGRAPH)) == "math"
+    assert router.reason(page(PARAGRAPH, PARAGRAPH) + "�") == "bad_chars"
+    table = "\r\n".join(f"Model {i} 0.{i}1 0.{i}2 0.{i}3" for i in range(6))
+    assert router.reason(page(PARAGRAPH) + "\r\n" + table) == "table"
+    cells = "\r\n".join(f"cell {i}" for i in range(20))
+    assert router.reason(page(PARAGRAPH) + "\r\n" + cells) == "short_lines"
+
+def test_markdown_reflow():
+    text = "Introduction\r\nThe text layer of a page is split into lines that are all about as long as each\r\nother, and words are some-\r\ntimes split. Short lines end a paragraph.\r\nA new paragraph starts here and keeps going for about as long as the\r\nlines above it do.\r\n12"
+    assert text_layer_to_markdown(text) == (
+        "Introduction\n\n"
+        "The text layer of a page is split into lines that are all about as long as each other, and words are sometimes split. Short lines end a paragraph.\n\n"
+        "A new paragraph starts here and keeps going for about as long as the lines above it do."
+    )
@@ -0,0 +1,50 @@
+import os
+import json
+
+from PIL import Image
+
+import read_dataset_2
+
+def write_dataset(ds_path, n_docs):
+    """
+    Dataset with detached captions: every document has two pages, the second with a figure and its caption
+    """
+    for i in range(n_docs):
+        doc_path = os.path.join(ds_path, f"doc{i}")
+        os.makedirs(doc_path)
+        for page, text in enumerate((f"First page of {i}", f"Second page of {i}")):
+            with open(os.path.join(doc_path, f"{page:08d}.txt"), "w") as f:
+                f.write(text)
+        Image.new("RGB", (10, 10), (i, 0, 0)).save(os.path.join(doc_path, "00000001-figure1.png"))
+        with open(os.path.join(doc_path, "00000001-media.json"), "w") as f:
+            json.dump({"figures" : [{"id" : 1, "caption" : f"Figure 1: Of {i}"}], "tables" : [], "text_length" : 0}, f)
+
+def doc_ids(pages):
+    return {page["doc"] for page in pages}
+
+def test_splits(tmp_path):
+    ds_path = str(tmp_path)
+    write_dataset(ds_path, 20)
+    train = list(read_dataset_2.iter_dataset(ds_path, "train", 0.7, by_page = True))
+    test = list(read_dataset_2.iter_dataset(ds_path, "test", 0.7, by_page = True))
+    # Every document is in exactly one split, the same one on every run
+    assert doc_ids(train) | doc_ids(test) == {f"doc{i}" for i in range(20)}
+    assert not doc_ids(train) & doc_ids(test)
+    assert doc_ids(read_dataset_2.iter_dataset(ds_path, "train", 0.7, by_page = True)) == doc_ids(train)
+    assert 0 < len(doc_ids(test)) < 20
+
+    # Images are only decoded on load
+    page = next(page for page in train if page["figure"])
+    page_num, caption, img = page["figure"][0]
+    i = int(page["doc"][3:])
+    assert (page_num, caption) == (1, f"Figure 1: Of {i}")
+    assert img.load().getpixel((0, 0)) == (i, 0, 0)
+
+def test_workers(tmp_path):
+    ds_path = str(tmp_path)
+    write_dataset(ds_path, 12)
+    shares = [doc_ids(read_dataset_2.StreamingDataset(ds_path, by_page = True, num_workers = 3, worker_id = worker_id))
+              for worker_id in range(3)]
+    # Workers split the documents between them without overlap
+    assert set.union(*shares) == {f"doc{i}" for i in range(12)}
+    assert sum(len(share) for share in shares) == 12
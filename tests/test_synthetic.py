@@ -0,0 +1,25 @@
+from mm_pdf.pdf_processing import PDFProcessor
+from mm_pdf.utils.pdf_utils import load_pdf, get_pdf_page_length
+from benchmarks.synthetic import synthetic_pdf, stub_nougat
+
+def test_synthetic_pdf(tmp_path):
+    path = str(tmp_path / "doc.pdf")
+    synthetic_pdf(path, 3, seed = 1)
+    assert get_pdf_page_length(path) == 3
+    pages = load_pdf(path)
+    assert all(page.info["n_chars"] > 500 for page in pages)
+
+    # Same seed, same document
+    synthetic_pdf(str(tmp_path / "again.pdf"), 3, seed = 1)
+    assert open(path, "rb").read() == open(tmp_path / "again.pdf", "rb").read()
+
+def test_stub_reads_text_layer(tmp_path):
+    path = str(tmp_path / "doc.pdf")
+    synthetic_pdf(path, 2, seed = 1, table_prob = 0, figure_prob = 1)
+    pages = load_pdf(path)
+    model, processor = stub_nougat()
+    # A small window so pages take several calls to generate
+    pdf_processor = PDFProcessor(device = "cpu", decode_window = 16, model = model, processor = processor)
+    texts = pdf_processor.call_nougat(pages)
+    assert texts[0].split() == pages[0].info["text"].split()
+    assert "Figure 1:" in texts[0]
@@ -0,0 +1,41 @@
+import json
+
+from mm_pdf.pdf_processing import PDFProcessor
+from mm_pdf.utils.figure_utils import FigureRegistry
+from mm_pdf.utils.pdf_utils import load_pdf
+from mm_pdf.utils.trace_utils import Tracer
+from benchmarks.synthetic import synthetic_pdf, stub_nougat
+
+def test_trace(tmp_path):
+    path = str(tmp_path / "doc.pdf")
+    synthetic_pdf(path, 3, seed = 1)
+    trace_path = tmp_path / "trace.jsonl"
+    metrics_path = tmp_path / "metrics.prom"
+    tracer = Tracer(str(trace_path), str(metrics_path))
+    model, processor = stub_nougat()
+    pdf_processor = PDFProcessor(device = "cpu", model = model, processor = processor, tracer = tracer)
+    with tracer.bind(doc = "doc"):
+        pdf_processor.process(load_pdf(path), FigureRegistry())
+    tracer.close()
+
+    events = [json.loads(line) for line in open(trace_path)]
+    assert all(event["doc"] == "doc" for event in events)
+    pages = [event for event in events if event["stage"] == "page"]
+    assert [event["page"] for event in pages] == [0, 1, 2]
+    assert all(event["tokens"] > 0 for event in pages)
+    decode = [event for event in events if event["stage"] == "decode"]
+    assert sum(event["tokens"] for event in decode) == sum(event["tokens"] for event in pages)
+    assert sum(event["stage"] == "rasterize" for event in events) == 3
+
+    metrics = open(metrics_path).read()
+    assert 'mm_pdf_stage_seconds_total{stage="decode"}' in metrics
+    assert 'mm_pdf_pages_total{route="nougat"} 3' in metrics
+    assert "mm_pdf_peak_rss_bytes" in metrics
+
+def test_disabled(tmp_path):
+    tracer = Tracer(str(tmp_path / "trace.jsonl"), str(tmp_path / "metrics.prom"), enabled = False)
+    with tracer.bind(doc = "doc"), tracer.span("stage") as span:
+        span["tokens"] = 1
+    tracer.event("page", page = 0)
+    tracer.close()
+    assert not list(tmp_path.iterdir())
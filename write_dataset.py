@@ -1,81 +1,224 @@
-from mm_pdf.utils.downloading_utils import download_if_not_present, get_id_without_ext
+from mm_pdf.utils.downloading_utils import Downloader, get_id_without_ext, url_to_filename
 from mm_pdf.pdf_processing import PDFProcessor
-from mm_pdf.utils import pdf_utils
-from mm_pdf.utils.data_utils import PDFObject, join_pdf_objects
-
+from mm_pdf.pipeline import WritePipeline
+from mm_pdf.replica_pool import ReplicaPool
+from mm_pdf.utils import pdf_utils, shard_utils
+from mm_pdf.utils.cache_utils import PageCache
+from mm_pdf.utils.dedup_utils import PageDeduplicator
+from mm_pdf.utils.data_utils import DocumentManifest
+from mm_pdf.utils.packed_utils import ShardWriter
+from mm_pdf.utils.index_utils import DatasetIndex, merge_index_fragments
+from mm_pdf.utils.routing_utils import TextLayerRouter
+from mm_pdf.utils.page_classifier import PageClassifier
+from mm_pdf.utils.trace_utils import Tracer
+
+import argparse
 import tarfile
+import shutil
+import socket
 import os
 import joblib
 from tqdm import tqdm
-import shutil
 
 """
 This is the main script to create a multimodal dataset from a list of URLs to PDFs
-1. PDFs are downloaded into the cache directory from a file with URLs. 
-2. During processing, memory overflows are possible, so the papers are chunked in order to only scan 
-certain numbers of pages at once.
+1. PDFs are downloaded into the cache directory from a file with URLs, concurrently with processing. 
+2. During processing, memory overflows are possible, so long papers are read chunk_size pages at a time, straight
+from the original PDF. Figure extraction, page rendering, Nougat and saving are overlapped
+by a pipeline (see mm_pdf/pipeline.py).
 3. Output goes into write path with a different folder for every PDF. Each folder has text files
 for each page in the PDF independently (numbered accordingly). Figures and tables have a naming
-convention to match them with the pages they are from.
+convention to match them with the pages they are from. Pages are written as soon as they are done and
+recorded in a manifest.json, so an interrupted run picks up from the first page that wasn't written.
+4. Several workers can split the corpus, either statically with --num-shards/--shard-id or dynamically with --claim
+(or both). Each logs finished documents to its own manifest, run with --merge-manifests to combine them.
+5. With packed_output, pages are instead appended to tar shards of about shard_size bytes in the write path
+(see mm_pdf/utils/packed_utils.py), which is far easier on filesystems than millions of small files.
+The manifests of documents then live under [write_path]/.docs.
+6. Every finished document (or closed shard) is added to the index fragment of its worker, which are merged into an
+index in [write_path]/.index.sqlite that readers use to find pages, figures and tables without listing folders.
+A worker running alone merges its fragment when it's done, otherwise --merge-manifests merges every workers fragment
+along with their manifests. Run with --rebuild-index to recreate the index from the files of a dataset.
+7. With trace, every stage of every page and document is recorded to [write_path]/.trace-[worker].jsonl, and totals
+(time per stage, tokens per second, peak memory) to [write_path]/.metrics-[worker].prom for Prometheus' textfile collector.
+8. On CPU, replicas > 1 runs that many copies of Nougat in their own processes, each pinned to its share of the cores
+and sharing one copy of the weights, with pages spread over them (see mm_pdf/replica_pool.py).
 """
 
 
 cache_dir = "./paper_cache"
 write_path = "output_dataset"
-chunk_size = 50 # For PDFs with many pages like books, split into this size
+chunk_size = 50 # For PDFs with many pages like books, pages rendered and transcribed at a time
+figure_batch_size = 64 # How many PDFs to run through a single PDFFigures2 invocation
+rasterize_workers = 2 # Processes rendering pages while Nougat runs
+writer_workers = 2 # Threads saving finished documents
+queue_size = 4 # Max documents (or ranges of pages) waiting between two stages, bounds memory use
+# SQLite files can only be shared by processes on the same machine, so every machine gets its own cache and dedup index
+cache_path = f"./nougat_cache-{socket.gethostname()}.sqlite" # Transcriptions are cached here by page content, set to None to disable
+cache_max_bytes = 2**30
+# Index of page hashes used to reuse transcriptions of near duplicate pages, off by default as a near duplicate can still
+# differ in a few words. Set to e.g. f"./page_dedup-{socket.gethostname()}.sqlite" to enable.
+dedup_path = None
+dedup_threshold = 6 # Pages whose hashes differ in at most this many of 256 bits are treated as duplicates
+scratch_dir = "./scratch" # Temporary files, each worker uses its own subfolder
+download_workers = 8 # Concurrent downloads
+download_rate = 4 # Max requests per second to any one host
+packed_output : bool = False # Write tar shards rather than a folder per document
+shard_size = 2**30 # Target size in bytes of each tar shard
+detach_captions : bool = False # Write captions into [page]-media.json as pages are saved, instead of running detach_captions.py after
+adaptive_budget : bool = False # Give each page a token budget based on how much text it holds, instead of the maximum
+text_layer_routing : bool = False # Use the text layer of pages that are plain prose instead of running Nougat on them
+skip_empty_pages : bool = True # Leave blank and figure only pages empty instead of running Nougat on them
+backend = "torch" # How Nougat is run: "torch", "int8" (quantized, CPU only) or "onnx" (ONNX Runtime, needs optimum)
+onnx_path = "./nougat_onnx" # Where the ONNX export of Nougat is kept for the onnx backend
+crop_figures : bool = False # Crop figures from the pages rendered for Nougat rather than have PDFFigures2 render them again
+figure_dpi = None # Render figures on their own at this DPI when it's higher than the pages' (96), rather than cropping them
+replicas = 1 # Processes decoding pages side by side on CPU, each on its own share of the cores
+trace : bool = True # Record timings, tokens and memory use of every stage, see mm_pdf/utils/trace_utils.py
 tar_result : bool = False
 
 if __name__ == "__main__":
-    # Step 1: Iterate through paper_urls and download anything not already present
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--num-shards", type = int, default = 1, help = "Split the corpus into this many shards by hash of the paper")
+    parser.add_argument("--shard-id", type = int, default = 0, help = "Which shard this worker processes")
+    parser.add_argument("--claim", action = "store_true", help = "Claim papers through lockfiles in the output folder, so any number of workers can share a shard")
+    parser.add_argument("--merge-manifests", action = "store_true", help = "Only merge the per-worker manifests into one and exit")
+    parser.add_argument("--rebuild-index", action = "store_true", help = "Only recreate the index of the dataset from its files and exit")
+    args = parser.parse_args()
+
+    claim_dir = os.path.join(write_path, ".claims")
+    worker_manifest_dir = os.path.join(write_path, ".workers")
+    if args.merge_manifests:
+        n_docs = shard_utils.merge_worker_manifests(worker_manifest_dir, os.path.join(write_path, ".manifest.jsonl"))
+        print(f"Merged manifests for {n_docs} documents")
+        print(f"Merged index: {merge_index_fragments(write_path)}")
+        exit()
+    if args.rebuild_index:
+        index = DatasetIndex(write_path)
+        index.rebuild()
+        print(f"Rebuilt index: {index.stats()}")
+        exit()
+
+    worker = shard_utils.worker_name(args.shard_id)
+    def in_shard(paper):
+        return shard_utils.in_shard(get_id_without_ext(paper), args.num_shards, args.shard_id)
+
+    # Step 1: Download anything in this shard from paper_urls that isn't already present. Downloads run in the
+    # background and each paper is handed to the pipeline as soon as it arrives.
     with open('paper_urls.txt', 'r') as file:
-        for url in file:
-            url = url.strip()
-            download_if_not_present(url, cache_dir)
-
-    # Step 2: Iterate through the papers in cache dir
-    pdf_processor = PDFProcessor()
-    for paper in tqdm(os.listdir(cache_dir)):
-        # Skip non-pdf files (i.e. skip tmp folders)
-        if not paper.endswith(".pdf"):
-            continue
-
-        output_dir = f"{write_path}/{get_id_without_ext(paper)}"
-        if os.path.exists(output_dir) and any(fname.endswith('.txt') for fname in os.listdir(output_dir)):
-            continue
-        path = os.path.join(cache_dir, paper)
-
-        # Check if it's too large
-        if pdf_utils.get_pdf_page_length(path) <= chunk_size:
-            pdf_obj : PDFObject = pdf_processor(path)
-            pdf_obj.save(output_dir)
-        else:
-            # Create a tmp directory that chunks the PDF into chunk_size PDFs
-            tmp_path = f"{cache_dir}/pdf_chunks"
-            pdf_utils.create_tmp_path(tmp_path)
-            pdf_utils.split_pdf(path, tmp_path, chunk_size)
-
-            pdf_objs = []
-            for chunk in os.listdir(tmp_path):
-                chunk_path = os.path.join(tmp_path, chunk)
-                pdf_objs.append(pdf_processor(chunk_path))
-
-            # Join then save
-            pdf_obj = join_pdf_objects(pdf_objs)
-            pdf_obj.save(output_dir)
-
-            # Remove the temp dir
-            shutil.rmtree(tmp_path)
+        urls = [url.strip() for url in file if url.strip() and in_shard(url_to_filename(url.strip()))]
+    downloader = Downloader(cache_dir, max_workers = download_workers, requests_per_second = download_rate)
+
+    def find_papers():
+        """
+        Downloaded papers as they arrive, followed by any other PDFs that were put in the cache dir by hand
+        """
+        seen = set()
+        for path in downloader.download_all(urls):
+            seen.add(os.path.basename(path))
+            yield os.path.basename(path)
+        for paper in sorted(os.listdir(cache_dir)):
+            # Skip non-pdf files (i.e. partial downloads)
+            if paper.endswith(".pdf") and paper not in seen and in_shard(paper):
+                yield paper
+
+    def doc_dir(paper):
+        """
+        Folder holding a papers pages (or with packed output, only its manifest)
+        """
+        if packed_output:
+            return f"{write_path}/.docs/{get_id_without_ext(paper)}"
+        return f"{write_path}/{get_id_without_ext(paper)}"
+
+    # Step 2: Skip papers that are already done. Documents are only done once their manifest says so,
+    # partially written ones are resumed
+    papers = (
+        paper for paper in find_papers()
+        if not DocumentManifest(doc_dir(paper)).complete
+    )
+
+    claims = None
+    claimed = {} # Document id to the paper claimed for it, until the document is done
+    if args.claim:
+        # Claimed lazily as the pipeline asks for the next paper, so fast workers end up taking more
+        claims = shard_utils.ClaimQueue(claim_dir, worker)
+        def claim_papers(papers):
+            for paper in claims.filter(papers):
+                claimed[get_id_without_ext(paper)] = paper
+                yield paper
+        papers = claim_papers(papers)
+
+    # Step 3: Process papers. Figure extraction, rasterization, Nougat and saving all run concurrently
+    # Every worker gets its own scratch folder so several can run side by side
+    worker_scratch_dir = os.path.join(scratch_dir, worker)
+    worker_manifest = shard_utils.WorkerManifest(worker_manifest_dir, worker)
+
+    tracer = Tracer(os.path.join(write_path, f".trace-{worker}.jsonl"), os.path.join(write_path, f".metrics-{worker}.prom"), enabled = trace)
+    figure_extractor = pdf_utils.FigureExtractor(work_dir = os.path.join(worker_scratch_dir, "figures"), tracer = tracer,
+                                                 render = not crop_figures, figure_dpi = figure_dpi)
+    cache = PageCache(cache_path, cache_max_bytes) if cache_path is not None else None
+    # Reused pages are reported in [write_path]/.dedup-[worker].jsonl as they happen
+    dedup = PageDeduplicator(dedup_path, dedup_threshold, stats_path = os.path.join(write_path, f".dedup-{worker}.jsonl")) if dedup_path is not None else None
+    router = TextLayerRouter() if text_layer_routing else None
+    page_classifier = PageClassifier() if skip_empty_pages else None
+    pdf_processor = PDFProcessor(figure_extractor = figure_extractor, cache = cache, dedup = dedup, adaptive_budget = adaptive_budget,
+                                 router = router, page_classifier = page_classifier, backend = backend, onnx_path = onnx_path,
+                                 tracer = tracer)
+    if replicas > 1:
+        pdf_processor.replicas = ReplicaPool(pdf_processor, replicas)
+    # Workers on other machines may be writing to the same dataset, so this worker only writes its own index fragment
+    index = DatasetIndex(write_path, worker)
+    # Shards are prefixed with the worker name so workers never write to the same shard
+    shard_writer = ShardWriter(write_path, shard_size, prefix = worker, index = index) if packed_output else None
+
+    def on_complete(manifest):
+        doc_id = os.path.basename(manifest.path)
+        if not packed_output: # Packed documents are indexed as their shards are closed
+            index.add_folder(doc_id, manifest.path)
+        worker_manifest.log(doc_id, manifest.n_pages)
+        if doc_id in claimed:
+            claims.finish(claimed.pop(doc_id)) # Its claim no longer needs to be kept fresh
+
+    pipeline = WritePipeline(
+        pdf_processor,
+        chunk_size = chunk_size,
+        figure_batch_size = figure_batch_size,
+        rasterize_workers = rasterize_workers,
+        writer_workers = writer_workers,
+        queue_size = queue_size,
+        on_complete = on_complete,
+        shard_writer = shard_writer,
+        detach_captions = detach_captions
+    )
+    pipeline(
+        (os.path.join(cache_dir, paper), doc_dir(paper))
+        for paper in tqdm(papers)
+    )
+
+    figure_extractor.close()
+    if claims is not None:
+        claims.close()
+    if pdf_processor.replicas is not None:
+        pdf_processor.replicas.close()
+    tracer.close()
+    shutil.rmtree(worker_scratch_dir, ignore_errors = True)
+    if cache is not None:
+        print(f"Nougat cache: {cache.stats()}")
+        cache.close()
+    if dedup is not None:
+        print(f"Page dedup: {dedup.stats()}")
+        dedup.close()
+    if router is not None:
+        print(f"Text layer routing: {router.stats()}")
+    if page_classifier is not None:
+        print(f"Skipped pages: {page_classifier.stats()}")
+    index.close()
+    if args.num_shards == 1 and not args.claim:
+        # No other worker can be writing to the dataset
+        print(f"Index: {merge_index_fragments(write_path)}")
 
     if tar_result:
         tar_path = write_path + ".tar"
         if not os.path.exists(tar_path):
             with tarfile.open(tar_path, "w:gz") as tar:
                 tar.add(write_path, arcname=os.path.basename(write_path))
-            
-
-
-
-
-
-
-